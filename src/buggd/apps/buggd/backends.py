@@ -0,0 +1,262 @@
+"""
+This module provides the storage backends that the sync thread uploads data to.
+
+Each backend implements the UploadBackend interface. The sync loop therefore doesn't
+care where the data ends up, and can be run against a local stand-in for tests and
+benchmarks.
+
+* GCSBackend uploads to a Google Cloud Storage bucket. This is the default.
+* S3Backend uploads to any S3-compatible object store. It needs boto3.
+* LocalBackend copies into a local directory. It can inject latency, bandwidth limits
+  and failures to stand in for a cellular link.
+
+The backend is chosen by the ``upload_backend`` key in the ``device`` section of the
+config file.
+"""
+
+import os
+import json
+import time
+import random
+import base64
+import shutil
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+BACKEND_GCS = 'gcs'
+BACKEND_S3 = 's3'
+BACKEND_LOCAL = 'local'
+
+
+class UploadError(Exception):
+    """ Exception raised when a backend fails to store an object """
+
+
+class UploadBackend:
+    """
+    Interface for somewhere to upload data to
+
+    Hashes are passed around as the dict stored in the checksum sidecar, i.e.
+    base64 'crc32c' and 'md5' as used by GCS.
+    """
+
+    name = None
+
+    def upload_file(self, local_path, remote_path, hashes=None):
+        """
+        Upload a file. If hashes are given the backend should have the server verify them.
+        Must raise an exception if the upload didn't succeed.
+        """
+        raise NotImplementedError
+
+    def upload_bytes(self, data, remote_path, content_type=None):
+        """ Upload an in-memory object. Must raise an exception if the upload didn't succeed. """
+        raise NotImplementedError
+
+    def get_remote_hashes(self, remote_path):
+        """ Return the hashes of an existing object, or None if it doesn't exist """
+        raise NotImplementedError
+
+
+class GCSBackend(UploadBackend):
+    """ Uploads to a Google Cloud Storage bucket using the service account in the config file """
+
+    name = BACKEND_GCS
+
+    def __init__(self, config_path):
+        from google.cloud import storage
+
+        # Get credentials from JSON file
+        self.client = storage.Client.from_service_account_json(config_path)
+
+        # Find the right GCS bucket
+        bugg_device_conf = json.load(open(config_path))['device']
+        self.bucket = self.client.bucket(bugg_device_conf['gcs_bucket_name'])
+
+    def upload_file(self, local_path, remote_path, hashes=None):
+        upload_f = self.bucket.blob(remote_path)
+
+        if hashes is not None:
+            # The server rejects the upload if the data it receives doesn't match these, and
+            # as they're already known there's no need for the client to compute them again
+            upload_f.crc32c = hashes['crc32c']
+            upload_f.md5_hash = hashes['md5']
+            upload_f.upload_from_filename(filename=local_path, checksum=None)
+        else:
+            upload_f.upload_from_filename(filename=local_path)
+
+    def upload_bytes(self, data, remote_path, content_type=None):
+        self.bucket.blob(remote_path).upload_from_string(data, content_type=content_type)
+
+    def get_remote_hashes(self, remote_path):
+        existing = self.bucket.get_blob(remote_path)
+        if existing is None:
+            return None
+        return {'crc32c': existing.crc32c, 'md5': existing.md5_hash}
+
+
+class S3Backend(UploadBackend):
+    """
+    Uploads to an S3-compatible object store
+
+    Config keys (in the device section):
+        s3_bucket_name: The bucket to upload to
+        s3_endpoint_url: Endpoint of the store, if not AWS
+        s3_access_key_id, s3_secret_access_key: Credentials
+        s3_region: Region name, if needed
+    """
+
+    name = BACKEND_S3
+
+    def __init__(self, config_path):
+        try:
+            import boto3
+        except ImportError as e:
+            raise ImportError('The S3 upload backend requires boto3 to be installed') from e
+
+        conf = json.load(open(config_path))['device']
+        self.bucket_name = conf['s3_bucket_name']
+        self.client = boto3.client('s3',
+                                   endpoint_url=conf.get('s3_endpoint_url'),
+                                   aws_access_key_id=conf.get('s3_access_key_id'),
+                                   aws_secret_access_key=conf.get('s3_secret_access_key'),
+                                   region_name=conf.get('s3_region'))
+
+    def upload_file(self, local_path, remote_path, hashes=None):
+        kwargs = {}
+        if hashes is not None:
+            # S3 verifies Content-MD5 and the CRC32C checksum against the body it receives
+            kwargs['ContentMD5'] = hashes['md5']
+            kwargs['ChecksumCRC32C'] = hashes['crc32c']
+
+        with open(local_path, 'rb') as f:
+            self.client.put_object(Bucket=self.bucket_name, Key=remote_path, Body=f, **kwargs)
+
+    def upload_bytes(self, data, remote_path, content_type=None):
+        kwargs = {'ContentType': content_type} if content_type else {}
+        self.client.put_object(Bucket=self.bucket_name, Key=remote_path, Body=data, **kwargs)
+
+    def get_remote_hashes(self, remote_path):
+        try:
+            head = self.client.head_object(Bucket=self.bucket_name, Key=remote_path, ChecksumMode='ENABLED')
+        except self.client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+        # The ETag of a single-part upload is the hex MD5 of the object
+        md5 = None
+        etag = head.get('ETag', '').strip('"')
+        if len(etag) == 32 and '-' not in etag:
+            md5 = base64.b64encode(bytes.fromhex(etag)).decode('ascii')
+        return {'crc32c': head.get('ChecksumCRC32C'), 'md5': md5}
+
+
+class LocalBackend(UploadBackend):
+    """
+    Stores objects in a local directory, standing in for a real bucket in tests and benchmarks
+
+    Args:
+        root_dir: Directory to store objects in
+        latency_s: Delay added to every request, to model the round trip time
+        bandwidth_bytes_per_s: Upload bandwidth in bytes per second, or None for unlimited
+        failure_rate: Probability (0-1) that a request fails
+        seed: Seed for the failure injection, so runs are repeatable
+        sleep: Function used to wait, so the delays can run on a simulated clock
+    """
+
+    name = BACKEND_LOCAL
+
+    META_SUFFIX = '.meta.json'
+
+    def __init__(self, root_dir, latency_s=0, bandwidth_bytes_per_s=None, failure_rate=0, seed=None, sleep=time.sleep):
+        self.root_dir = root_dir
+        self.latency_s = latency_s
+        self.bandwidth_bytes_per_s = bandwidth_bytes_per_s
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.sleep = sleep
+
+        self.requests = 0
+        self.failures = 0
+        self.bytes_uploaded = 0
+
+    def _request(self, n_bytes):
+        """ Model the cost of a request, and fail it if the dice say so """
+        self.requests += 1
+        delay = self.latency_s
+        if self.bandwidth_bytes_per_s:
+            delay += n_bytes / self.bandwidth_bytes_per_s
+        if delay > 0:
+            self.sleep(delay)
+
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            self.failures += 1
+            raise UploadError('Injected upload failure')
+
+    def _path(self, remote_path):
+        return os.path.join(self.root_dir, remote_path)
+
+    def _store(self, write, remote_path, n_bytes, hashes):
+        self._request(n_bytes)
+
+        dst = self._path(remote_path)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        write(dst + '.part')
+
+        # Verify the data like the server would
+        md5 = hashlib.md5()
+        with open(dst + '.part', 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                md5.update(chunk)
+        md5 = base64.b64encode(md5.digest()).decode('ascii')
+        if hashes is not None and hashes['md5'] != md5:
+            os.remove(dst + '.part')
+            raise UploadError('MD5 mismatch uploading {}'.format(remote_path))
+
+        os.replace(dst + '.part', dst)
+        with open(dst + self.META_SUFFIX, 'w', encoding='utf-8') as f:
+            json.dump({'md5': md5, 'crc32c': hashes['crc32c'] if hashes else None}, f)
+
+        self.bytes_uploaded += n_bytes
+
+    def upload_file(self, local_path, remote_path, hashes=None):
+        self._store(lambda dst: shutil.copyfile(local_path, dst), remote_path, os.path.getsize(local_path), hashes)
+
+    def upload_bytes(self, data, remote_path, content_type=None):
+        def write(dst):
+            with open(dst, 'wb') as f:
+                f.write(data)
+        self._store(write, remote_path, len(data), None)
+
+    def get_remote_hashes(self, remote_path):
+        self._request(0)
+        try:
+            with open(self._path(remote_path) + self.META_SUFFIX, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+
+def make_backend(config_path):
+    """
+    Create the upload backend named in the config file (GCS if not specified)
+
+    Args:
+        config_path: Path to the config file
+    """
+
+    conf = json.load(open(config_path))['device']
+    backend = conf.get('upload_backend', BACKEND_GCS)
+
+    if backend == BACKEND_GCS:
+        return GCSBackend(config_path)
+    if backend == BACKEND_S3:
+        return S3Backend(config_path)
+    if backend == BACKEND_LOCAL:
+        return LocalBackend(conf['local_upload_dir'])
+
+    raise ValueError('Unknown upload backend {}'.format(backend))
@@ -0,0 +1,190 @@
+"""
+This module packs small files in the upload directory into a single compressed archive.
+
+On a cellular link every upload costs at least one full HTTPS round trip, so uploading
+rotated logs and other small files one by one spends most of the modem-on time waiting.
+Instead, once per sync cycle, files under a size threshold are packed into a tar.gz
+archive along with a manifest describing them. The archive is uploaded as one object,
+and the originals are only deleted once that upload has been confirmed.
+"""
+
+import io
+import os
+import json
+import time
+import tarfile
+import logging
+from datetime import datetime
+
+from .utils import discover_serial
+from .checksums import is_sidecar, is_partial, get_sidecar_path, PART_SUFFIX
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Directory (under the upload directory) where archives are staged before upload
+BUNDLE_DIR_NAME = 'bundles'
+
+# Files smaller than this are bundled rather than uploaded individually
+BUNDLE_MAX_FILE_BYTES = 256 * 1024
+
+# Ignore files modified more recently than this, as they may still be being written
+BUNDLE_MIN_FILE_AGE_S = 60
+
+# Cap the number of files in one archive so a large backlog is spread over several cycles
+BUNDLE_MAX_FILES = 1000
+
+# Times to start the archive again if a file is deleted while it is being packed
+BUNDLE_ATTEMPTS = 3
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def get_bundle_dir(upload_dir):
+    """ Return the path of the directory that archives are staged in """
+    return os.path.join(upload_dir, BUNDLE_DIR_NAME)
+
+
+def find_small_files(upload_dir, max_bytes=BUNDLE_MAX_FILE_BYTES, min_age_s=BUNDLE_MIN_FILE_AGE_S,
+                     max_files=BUNDLE_MAX_FILES):
+    """
+    Find files in the upload directory that are small enough to be bundled
+
+    Returns:
+        A list of (local_path, remote_path, size) tuples
+    """
+
+    bundle_dir = get_bundle_dir(upload_dir)
+    now = time.time()
+    found = []
+
+    for root, subdirs, files in os.walk(upload_dir):
+        # Never bundle the archives themselves
+        subdirs[:] = [d for d in subdirs if os.path.join(root, d) != bundle_dir]
+
+        for local_f in files:
+            local_path = os.path.join(root, local_f)
+
+            # Hashed data files are uploaded individually so the server can verify them
+            if is_sidecar(local_path) or is_partial(local_path) or os.path.exists(get_sidecar_path(local_path)):
+                continue
+
+            try:
+                st = os.stat(local_path)
+            except FileNotFoundError:
+                continue
+
+            if st.st_size > max_bytes or now - st.st_mtime < min_age_s:
+                continue
+
+            found.append((local_path, local_path[len(upload_dir)+1:], st.st_size))
+            if len(found) >= max_files:
+                return found
+
+    return found
+
+
+def clean_stale_bundles(upload_dir):
+    """
+    Remove archives left over from a previous cycle whose upload didn't complete.
+    The originals are only deleted after a confirmed upload, so they are still on
+    disk and will be bundled again.
+    """
+
+    bundle_dir = get_bundle_dir(upload_dir)
+    if not os.path.isdir(bundle_dir):
+        return
+
+    for f in os.listdir(bundle_dir):
+        logger.info('Removing stale bundle {}'.format(f))
+        os.remove(os.path.join(bundle_dir, f))
+
+
+def create_bundle(upload_dir, files):
+    """
+    Pack files into a single compressed archive with a manifest
+
+    Args:
+        upload_dir: The top level of the upload directory
+        files: A list of (local_path, remote_path, size) tuples, as returned by find_small_files()
+
+    Returns:
+        The path of the archive, which is under the upload directory
+    """
+
+    bundle_dir = get_bundle_dir(upload_dir)
+    os.makedirs(bundle_dir, exist_ok=True)
+
+    created = datetime.utcnow()
+    bundle_name = 'bundle_{}_{}.tar.gz'.format(discover_serial(), created.strftime('%Y%m%d_%H%M%S'))
+    bundle_path = os.path.join(bundle_dir, bundle_name)
+    part_path = bundle_path + PART_SUFFIX
+
+    manifest = {
+        'created': created.isoformat()[:-3] + 'Z',
+        'files': [{'path': remote_path, 'bytes': size} for _, remote_path, size in files],
+    }
+    manifest_bytes = json.dumps(manifest, separators=(',', ':')).encode('utf-8')
+
+    with tarfile.open(part_path, 'w:gz') as tar:
+        # Write the manifest first so it can be read without decompressing the whole archive
+        info = tarfile.TarInfo(MANIFEST_NAME)
+        info.size = len(manifest_bytes)
+        info.mtime = int(time.time())
+        tar.addfile(info, fileobj=io.BytesIO(manifest_bytes))
+
+        for local_path, remote_path, _ in files:
+            tar.add(local_path, arcname=remote_path, recursive=False)
+
+    # Only give the archive its final name once it is complete
+    os.rename(part_path, bundle_path)
+
+    logger.info('Bundled {} files into {} ({} bytes)'.format(len(files), bundle_path, os.path.getsize(bundle_path)))
+
+    return bundle_path
+
+
+def bundle_small_files(upload_dir, max_bytes=BUNDLE_MAX_FILE_BYTES, min_age_s=BUNDLE_MIN_FILE_AGE_S):
+    """
+    Run the batching stage for one sync cycle
+
+    Other threads prune old logs and profiles from the upload directory, so a file can go
+    between being found and being packed. The files are then found and packed again.
+
+    Returns:
+        (bundle_path, files) where bundle_path is None if there was nothing to bundle
+    """
+
+    for _ in range(BUNDLE_ATTEMPTS):
+        clean_stale_bundles(upload_dir)
+
+        files = find_small_files(upload_dir, max_bytes=max_bytes, min_age_s=min_age_s)
+
+        # A single file gains nothing from being bundled
+        if len(files) < 2:
+            return None, []
+
+        try:
+            return create_bundle(upload_dir, files), files
+        except FileNotFoundError as e:
+            logger.info('{} was deleted while it was being bundled'.format(e.filename))
+
+    # They are uploaded one by one instead
+    clean_stale_bundles(upload_dir)
+    return None, []
+
+
+def remove_bundled_files(bundle_path, files):
+    """
+    Delete the archive and the original files it contains.
+    Only call this once the archive upload has been confirmed.
+    """
+
+    for local_path, _, _ in files:
+        try:
+            os.remove(local_path)
+        except FileNotFoundError:
+            logger.warning('Bundled file {} already removed'.format(local_path))
+
+    os.remove(bundle_path)
+
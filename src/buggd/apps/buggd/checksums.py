@@ -0,0 +1,168 @@
+"""
+This module computes CRC32C and MD5 hashes of data files as they are written.
+
+ffmpeg encodes each segment into the working directory. The encoded file is then
+streamed into the data directory, and both hashes are computed on the same pass, so the
+SD card copy never has to be read back. The hashes are kept in a small JSON sidecar
+next to the data file. The uploader sends them with the upload so the server can verify
+it, and uses them after a crash to tell whether a file already reached the bucket.
+
+The data file is written under a temporary name and only renamed once it and its
+sidecar are complete. The uploader therefore never sees a partially written file.
+
+The sidecar also carries the segment's trace (see tracing.py), so it survives a reboot
+between staging and upload.
+"""
+
+import os
+import json
+import base64
+import hashlib
+import logging
+import google_crc32c
+
+from .tracing import tracer
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+SIDECAR_SUFFIX = '.hashes.json'
+PART_SUFFIX = '.part'
+
+COPY_CHUNK_BYTES = 1024 * 1024
+
+
+def get_sidecar_path(path):
+    """ Return the path of the sidecar holding the hashes for a data file """
+    return path + SIDECAR_SUFFIX
+
+
+def is_sidecar(path):
+    """ Check if a path is a hash sidecar """
+    return path.endswith(SIDECAR_SUFFIX)
+
+
+def is_partial(path):
+    """ Check if a path is a data file that is still being written """
+    return path.endswith(PART_SUFFIX)
+
+
+def read_sidecar(path):
+    """
+    Read the hashes for a data file
+
+    Returns:
+        A dict with 'crc32c', 'md5' (both base64, as used by GCS), 'bytes' and the
+        segment's 'trace' if it was traced, or None if there is no valid sidecar
+    """
+
+    try:
+        with open(get_sidecar_path(path), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, json.JSONDecodeError) as e:
+        logger.warning('Could not read hash sidecar for {}: {}'.format(path, e))
+        return None
+
+
+def write_sidecar(path, hashes):
+    """ Atomically write the hashes for a data file to its sidecar """
+    sidecar_path = get_sidecar_path(path)
+    with open(sidecar_path + PART_SUFFIX, 'w', encoding='utf-8') as f:
+        json.dump(hashes, f, separators=(',', ':'))
+    os.replace(sidecar_path + PART_SUFFIX, sidecar_path)
+
+
+def mark_upload_started(path, hashes):
+    """
+    Record in the sidecar that an upload of this file has begun. If buggd dies between
+    the upload and deleting the local file, this tells the next sync cycle that the file
+    may already be in the bucket.
+    """
+
+    if not hashes.get('upload_started'):
+        hashes['upload_started'] = True
+        write_sidecar(path, hashes)
+
+
+def remove_with_sidecar(path):
+    """ Delete a data file and then its sidecar """
+    os.remove(path)
+    if os.path.exists(get_sidecar_path(path)):
+        os.remove(get_sidecar_path(path))
+
+
+def is_orphaned_sidecar(path):
+    """ Check if a sidecar has outlived its data file, e.g. after a crash during deletion """
+    primary = path[:-len(SIDECAR_SUFFIX)]
+    return is_sidecar(path) and not os.path.exists(primary) and not os.path.exists(primary + PART_SUFFIX)
+
+
+def remove_orphaned_sidecar(path):
+    """
+    Delete a sidecar that has outlived its data file
+
+    A sidecar listed before its data file was uploaded has usually gone with it already,
+    which isn't an error.
+
+    Returns:
+        True if a sidecar was deleted
+    """
+    if not is_orphaned_sidecar(path):
+        return False
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def stage_with_checksums(src_path, dst_path):
+    """
+    Move a freshly encoded file into the data directory, computing its hashes as it is written
+
+    Args:
+        src_path: The encoded file in the working directory. This is removed afterwards.
+        dst_path: The final path of the file in the data directory
+
+    Returns:
+        The dict of hashes that was written to the sidecar
+    """
+
+    crc = google_crc32c.Checksum()
+    md5 = hashlib.md5()
+    n_bytes = 0
+
+    part_path = dst_path + PART_SUFFIX
+    with open(src_path, 'rb') as f_in, open(part_path, 'wb') as f_out:
+        while True:
+            chunk = f_in.read(COPY_CHUNK_BYTES)
+            if not chunk:
+                break
+            crc.update(chunk)
+            md5.update(chunk)
+            f_out.write(chunk)
+            n_bytes += len(chunk)
+        f_out.flush()
+        os.fsync(f_out.fileno())
+
+    hashes = {
+        'crc32c': base64.b64encode(crc.digest()).decode('ascii'),
+        'md5': base64.b64encode(md5.digest()).decode('ascii'),
+        'bytes': n_bytes,
+    }
+
+    # Segments are named after the file they're encoded from, less the extension
+    segment = os.path.splitext(os.path.basename(dst_path))[0]
+    tracer.mark(segment, 'staged')
+    trace = tracer.get(segment)
+    if trace is not None:
+        hashes['trace'] = trace
+
+    # Sidecar first, so a data file never exists without its hashes
+    write_sidecar(dst_path, hashes)
+    os.rename(part_path, dst_path)
+    os.remove(src_path)
+
+    return hashes
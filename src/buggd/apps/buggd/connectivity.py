@@ -0,0 +1,203 @@
+"""
+This module keeps track of whether the device has a working internet connection.
+
+Probes are deliberately cheap, because every byte goes over a metered cellular link:
+
+* 'http' (the default) sends a HEAD request to a generate_204 endpoint. This costs a
+  few hundred bytes and also catches captive portals and broken DNS.
+* 'tcp' just opens a TCP connection to the upload endpoint.
+
+The result is cached, so the LEDs and the sync loop can read the last known state
+without probing again. While waiting for a connection, probes back off exponentially.
+If NetworkManager is available, its state changes are followed through ``nmcli monitor``.
+A wait then ends as soon as NetworkManager reports connectivity, without waiting for
+the next probe.
+"""
+
+import time
+import socket
+import logging
+import threading
+import subprocess
+import requests
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+PROBE_HTTP = 'http'
+PROBE_TCP = 'tcp'
+
+PROBE_URL = 'http://connectivitycheck.gstatic.com/generate_204'
+PROBE_ADDR = ('storage.googleapis.com', 443)
+PROBE_TIMEOUT_S = 2
+
+# How long a probe result is trusted for
+CACHE_MAX_AGE_S = 30
+
+# Backoff between probes while waiting for a connection
+BACKOFF_INITIAL_S = 0.5
+BACKOFF_MAX_S = 8
+
+# How long nmcli monitor is given to exit when stopped, before it is killed
+NM_STOP_TIMEOUT_S = 5
+
+
+class ConnectivityMonitor:
+    """
+    Probes for and caches the state of the internet connection
+
+    Args:
+        probe: PROBE_HTTP or PROBE_TCP
+        probe_url: URL that returns HTTP 204 when reachable, for PROBE_HTTP
+        probe_addr: (host, port) to connect to, for PROBE_TCP
+        max_age_s: How long a probe result is trusted for
+    """
+
+    def __init__(self, probe=PROBE_HTTP, probe_url=PROBE_URL, probe_addr=PROBE_ADDR, max_age_s=CACHE_MAX_AGE_S):
+        self.probe_type = probe
+        self.probe_url = probe_url
+        self.probe_addr = probe_addr
+        self.max_age_s = max_age_s
+
+        self.lock = threading.Lock()
+        self.connected = False
+        self.checked_t = None
+
+        # Set whenever NetworkManager reports a change, to cut a wait short
+        self.nm_changed = threading.Event()
+        self.nm_thread = None
+        self.nm_proc = None
+
+    @property
+    def is_connected(self):
+        """ The last known state, without probing """
+        return self.connected
+
+    def _update(self, connected):
+        with self.lock:
+            if connected != self.connected:
+                logger.info('Internet connection {}'.format('up' if connected else 'down'))
+            self.connected = connected
+            self.checked_t = time.monotonic()
+
+    def probe(self, timeout=PROBE_TIMEOUT_S):
+        """ Probe the connection now, update the cache and return the result """
+        try:
+            if self.probe_type == PROBE_TCP:
+                with socket.create_connection(self.probe_addr, timeout=timeout):
+                    connected = True
+            else:
+                # Anything but a 204 (e.g. a captive portal's 200) means we're not really online
+                response = requests.head(self.probe_url, timeout=timeout, allow_redirects=False)
+                connected = response.status_code == 204
+                if not connected:
+                    logger.debug('Connectivity probe returned status %s', response.status_code, extra={'rate_limit': True})
+        except (OSError, requests.RequestException) as e:
+            logger.debug('Connectivity probe failed: %s', e, extra={'rate_limit': True})
+            connected = False
+
+        self._update(connected)
+        return connected
+
+    def invalidate(self):
+        """ Forget the cached state, e.g. because the modem has been powered off """
+        with self.lock:
+            self.checked_t = None
+            self.connected = False
+
+    def check(self, max_age_s=None, timeout=PROBE_TIMEOUT_S):
+        """
+        Return the connection state, only probing if the cached result is older than max_age_s
+        """
+        max_age_s = self.max_age_s if max_age_s is None else max_age_s
+        if self.checked_t is not None and time.monotonic() - self.checked_t < max_age_s:
+            return self.connected
+        return self.probe(timeout=timeout)
+
+    def wait(self, timeout_s, probe_timeout=PROBE_TIMEOUT_S, verbose=False):
+        """
+        Wait for a connection, probing with exponential backoff
+
+        Returns:
+            True if connected before timeout_s elapsed
+        """
+
+        deadline = time.monotonic() + timeout_s
+        delay = BACKOFF_INITIAL_S
+        n_try = 0
+
+        while True:
+            n_try += 1
+            self.nm_changed.clear()
+            if self.probe(timeout=probe_timeout):
+                return True
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            if verbose:
+                logger.info('No internet connection on try {}, next try in {:.1f}s'.format(n_try, min(delay, remaining)),
+                            extra={'rate_limit': True})
+
+            # Sleep until the next probe, or until NetworkManager says something changed
+            self.nm_changed.wait(min(delay, remaining))
+            delay = min(delay * 2, BACKOFF_MAX_S)
+
+    def start_nm_monitor(self):
+        """
+        Follow NetworkManager's connectivity state in the background, if nmcli is available
+        """
+
+        if self.nm_thread is not None:
+            return
+
+        try:
+            proc = subprocess.Popen(['nmcli', 'monitor'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf8')
+        except OSError as e:
+            logger.info('Not following NetworkManager state: {}'.format(e))
+            return
+
+        self.nm_proc = proc
+        self.nm_thread = threading.Thread(target=self._nm_monitor, args=(proc,), daemon=True)
+        self.nm_thread.start()
+
+    def stop_nm_monitor(self):
+        """ Stop following NetworkManager, ending nmcli monitor """
+        proc, thread = self.nm_proc, self.nm_thread
+        if proc is None:
+            return
+
+        proc.terminate()
+        try:
+            proc.wait(NM_STOP_TIMEOUT_S)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        if thread is not None:
+            thread.join(NM_STOP_TIMEOUT_S)
+
+    def _nm_monitor(self, proc):
+        """ Parse ``nmcli monitor`` output, e.g. "Connectivity is now 'full'" """
+        for line in proc.stdout:
+            line = line.strip()
+            if 'Connectivity is now' in line:
+                logger.debug('NetworkManager: %s', line)
+                # Only 'full' is trusted as connected; anything else means the last probe result is stale
+                if "'full'" in line:
+                    self._update(True)
+                else:
+                    self.invalidate()
+                self.nm_changed.set()
+            elif 'is now in the' in line or 'disconnected' in line:
+                logger.debug('NetworkManager: %s', line)
+                self.nm_changed.set()
+
+        # Reap it, so it doesn't stay a zombie, and let the monitor be started again
+        proc.stdout.close()
+        proc.wait()
+        self.nm_proc = None
+        self.nm_thread = None
+
+
+# Shared by the sync loop, the LEDs and anything else that wants to know if we're online
+connectivity = ConnectivityMonitor()
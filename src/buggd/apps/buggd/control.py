@@ -0,0 +1,252 @@
+"""
+This module lets other processes query and drive the running daemon.
+
+buggd holds the soundcard and modem drivers, and their lock files, for as long as it runs,
+so soundcardctl and modemctl can't open them while it is recording. Instead, buggd serves
+a Unix domain socket at CONTROL_SOCKET, and the tools send their commands there when
+buggd is running.
+
+The socket lives in a directory only root can write to, so no other user can bind its
+path first. The daemon and the tools also check that the socket is owned by root or by
+themselves. Anything else is not treated as buggd: the daemon replaces it, and the tools
+refuse to talk to it.
+
+The protocol is one line of JSON each way per command:
+
+    -> {"cmd": "gain", "args": {"gain": 12}}
+    <- {"ok": true, "result": null}
+    <- {"ok": false, "error": "Gain must be between 0 and 20"}
+
+A command that the daemon can't carry out, but that could be done by opening the
+hardware directly (e.g. the gain of a sensor without a soundcard), replies with
+``"unavailable": true``. The client raises ControlUnavailable for that, as it does when
+buggd isn't running at all, so the tools fall back to the hardware.
+
+This module only uses the standard library, so the tools can import it without the daemon.
+"""
+
+import os
+import json
+import socket
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+CONTROL_SOCKET = os.environ.get('BUGGD_CONTROL_SOCKET', '/run/buggd/buggd.sock')
+
+# The socket's directory, if it has to be created. Only its owner can add files to it.
+SOCKET_DIR_MODE = 0o755
+
+# The owner and group can send commands
+SOCKET_MODE = 0o660
+
+# How long a client waits for a reply. Modem queries can take several AT command timeouts.
+CLIENT_TIMEOUT_S = 30
+
+# Longest request line accepted
+MAX_REQUEST_BYTES = 64 * 1024
+
+LISTEN_BACKLOG = 4
+
+
+class ControlError(Exception):
+    """ The daemon couldn't carry out a command """
+    pass
+
+
+class ControlUnavailable(ControlError):
+    """ The daemon isn't running, or can't carry out the command, so the hardware should be used directly """
+    pass
+
+
+class ControlServer:
+    """
+    Serves commands on a Unix domain socket, each on its own thread
+
+    Handlers are called with the request's args as keyword arguments. What they return
+    must be JSON serialisable. An exception becomes an error reply.
+    """
+
+    def __init__(self):
+        self.handlers = {}
+        self.sock = None
+        self.path = None
+
+    def register(self, cmd, handler):
+        """ Handle a command, replacing any handler it already has """
+        self.handlers[cmd] = handler
+
+    def start(self, path=None):
+        """
+        Start serving, unless another daemon is serving the socket already
+
+        Returns:
+            True if serving
+        """
+        self.stop()
+        path = path or CONTROL_SOCKET
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), mode=SOCKET_DIR_MODE, exist_ok=True)
+
+            # A socket left by a previous run is removed, as is one another user put there.
+            # One of ours that answers is another daemon.
+            if os.path.lexists(path):
+                if is_trusted(path) and is_running(path):
+                    logger.error('Another buggd is serving {}, so not serving control commands'.format(path))
+                    sock.close()
+                    return False
+                if not is_trusted(path):
+                    logger.warning('Removing {}, which is owned by another user'.format(path))
+                os.remove(path)
+
+            sock.bind(path)
+            os.chmod(path, SOCKET_MODE)
+            sock.listen(LISTEN_BACKLOG)
+        except OSError as e:
+            logger.error('Could not serve control commands on {}: {}'.format(path, e))
+            sock.close()
+            return False
+
+        self.sock = sock
+        self.path = path
+        threading.Thread(target=self._accept, args=(sock,), name='control', daemon=True).start()
+        logger.info('Serving control commands on {}'.format(path))
+        return True
+
+    def stop(self):
+        """ Stop serving and remove the socket. Commands already being handled finish. """
+        if self.sock is None:
+            return
+
+        # Shutting the socket down wakes the thread blocked in accept
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self.sock = None
+
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def _accept(self, sock):
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except OSError:
+                # Stopped
+                return
+            threading.Thread(target=self._serve, args=(conn,), name='control-conn', daemon=True).start()
+
+    def _serve(self, conn):
+        """ Answer each line sent on a connection until the client closes it """
+        with conn:
+            conn.settimeout(CLIENT_TIMEOUT_S)
+            try:
+                with conn.makefile('rwb') as f:
+                    while True:
+                        line = f.readline(MAX_REQUEST_BYTES)
+                        if not line:
+                            return
+                        f.write(json.dumps(self.handle(line), separators=(',', ':')).encode('utf-8') + b'\n')
+                        f.flush()
+            except OSError as e:
+                logger.debug('Control connection closed: {}'.format(e))
+
+    def handle(self, line):
+        """ Carry out one request line, returning the reply """
+        try:
+            request = json.loads(line)
+            cmd = request['cmd']
+            args = request.get('args') or {}
+            if not isinstance(cmd, str) or not isinstance(args, dict):
+                raise TypeError('cmd must be a string, and args an object')
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return {'ok': False, 'error': 'Malformed request'}
+
+        handler = self.handlers.get(cmd)
+        if handler is None:
+            return {'ok': False, 'error': 'Unknown command {}'.format(cmd)}
+
+        logger.info('Control command {} {}'.format(cmd, args))
+        try:
+            return {'ok': True, 'result': handler(**args)}
+        except ControlUnavailable as e:
+            return {'ok': False, 'unavailable': True, 'error': str(e)}
+        except Exception as e:
+            logger.warning('Control command {} failed: {}'.format(cmd, e))
+            return {'ok': False, 'error': '{}: {}'.format(type(e).__name__, e)}
+
+
+def call(cmd, path=None, timeout=CLIENT_TIMEOUT_S, **args):
+    """
+    Send a command to the running daemon
+
+    Args:
+        cmd: The command
+        path: The daemon's socket, CONTROL_SOCKET by default
+        timeout: How long to wait for the reply
+        args: The command's arguments
+
+    Returns:
+        The command's result
+
+    Raises:
+        ControlUnavailable: buggd isn't running, or can't carry out the command
+        ControlError: buggd couldn't carry out the command, or the socket isn't buggd's
+    """
+    path = path or CONTROL_SOCKET
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        try:
+            if not is_trusted(path):
+                raise ControlError('{} is owned by another user, so it is not buggd\'s'.format(path))
+            sock.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            raise ControlUnavailable('buggd is not running') from e
+        except PermissionError as e:
+            raise ControlError('No permission to use {}. Try with sudo.'.format(path)) from e
+
+        try:
+            with sock.makefile('rwb') as f:
+                f.write(json.dumps({'cmd': cmd, 'args': args}).encode('utf-8') + b'\n')
+                f.flush()
+                line = f.readline()
+        except OSError as e:
+            raise ControlError('No reply from buggd: {}'.format(e)) from e
+
+    if not line:
+        raise ControlError('buggd closed the connection without replying')
+    reply = json.loads(line)
+    if reply.get('ok'):
+        return reply.get('result')
+    if reply.get('unavailable'):
+        raise ControlUnavailable(reply.get('error'))
+    raise ControlError(reply.get('error'))
+
+
+def is_trusted(path):
+    """ Check if a socket is owned by root or by this process's user, rather than another user """
+    return os.lstat(path).st_uid in (0, os.geteuid())
+
+
+def is_running(path=None):
+    """ Check if a daemon is serving control commands """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(1)
+        try:
+            sock.connect(path or CONTROL_SOCKET)
+            return True
+        except OSError:
+            return False
+
+
+# Served by the daemon
+control = ControlServer()
@@ -5,7 +5,7 @@ import logging
 import subprocess
 import os
 import time
-from smbus2 import SMBus
+from buggd.drivers.i2cbus import get_bus
 from buggd.drivers.modem import Modem
 from buggd.drivers.soundcard import Soundcard
 from buggd.drivers.pcmd3180 import PCMD3180
@@ -387,16 +387,6 @@ def i2c_device_present(addr, bus_num=1, force=True):
     """
 
     try:
-        # Prepare read and write operations without changing the device state
-        with SMBus(bus_num) as bus:
-            # Attempt to read a byte from the device
-            bus.read_byte(addr, force=force)
-        return True
-    except OSError as expt:
-        if expt.errno == 16:
-            # Device is busy but present
-            return True
-        # Any other OSError means the device did not respond as expected
-        return False
+        return get_bus(bus_num).probe(addr, force=force)
     except Exception:
         return False
@@ -0,0 +1,167 @@
+"""
+This module keeps a structured journal of the recording and upload pipeline.
+
+Each event is one line of JSON with its type, a monotonic timestamp (``t``), the wall
+clock time (``utc``), the segment it belongs to, and any figures that go with it, e.g.
+
+    {"event":"encode_end","t":5123.402,"utc":1718000000.512,"segment":"2024-06-10T06_13_20.000Z","bytes":2403112,"duration_s":41.2}
+
+so the time each stage takes can be worked out without grepping the text logs. A segment
+is identified by the name the sensor gives it in capture_data, which is also the name of
+its data file without the extension. The events of a segment also stamp its trace (see
+tracing.py), and carry the trace ID.
+
+Events are buffered in memory and appended in batches to a file in ``journal/`` in the
+upload directory. As with the modem telemetry, the file has a ``.part`` suffix while it is
+being written, and it is closed at the start of each sync so that sync uploads it.
+"""
+
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+import collections
+
+from .utils import discover_serial
+from .checksums import PART_SUFFIX
+from .tracing import tracer
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+JOURNAL_DIR_NAME = 'journal'
+
+# Buffered events are written once there are this many, or the oldest is this old
+FLUSH_EVENTS = 50
+FLUSH_INTERVAL_S = 60
+
+# Events kept while there is nowhere to write them. Beyond this the oldest are dropped.
+MAX_BUFFERED_EVENTS = 10000
+
+# Event types
+CAPTURE_START = 'capture_start'
+CAPTURE_END = 'capture_end'
+TRIM = 'trim'
+ENCODE_START = 'encode_start'
+ENCODE_END = 'encode_end'
+UPLOAD_START = 'upload_start'
+UPLOAD_END = 'upload_end'
+SYNC_START = 'sync_start'
+SYNC_END = 'sync_end'
+MODEM_ON = 'modem_on'
+MODEM_OFF = 'modem_off'
+TRACE = 'trace'
+MAINTENANCE = 'maintenance'
+REBOOT_GAP = 'reboot_gap'
+
+EVENTS = (CAPTURE_START, CAPTURE_END, TRIM, ENCODE_START, ENCODE_END, UPLOAD_START, UPLOAD_END,
+          SYNC_START, SYNC_END, MODEM_ON, MODEM_OFF, TRACE, MAINTENANCE, REBOOT_GAP)
+
+# The trace stamp made by each event. Staging and the end of an upload are stamped where
+# they happen, as the trace has to be saved and finished there.
+TRACE_MARKS = {CAPTURE_END: 'captured', TRIM: 'trimmed', ENCODE_START: 'encode_start', UPLOAD_START: 'upload_start'}
+
+
+def segment_id(path):
+    """ The ID of the segment a data file holds: its name without the directory or extension """
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+class EventJournal:
+    """
+    Collects events from the capture, postprocess and sync threads and writes them out in batches
+    """
+
+    def __init__(self):
+        self.journal_dir = None
+        self.lock = threading.Lock()
+        self.buffer = collections.deque(maxlen=MAX_BUFFERED_EVENTS)
+        self.oldest_t = None
+        self.path = None
+
+    def set_upload_dir(self, upload_dir):
+        """ Write the journal into the upload directory, closing any file left open by a previous run """
+        journal_dir = os.path.join(upload_dir, JOURNAL_DIR_NAME)
+
+        try:
+            os.makedirs(journal_dir, exist_ok=True)
+            for f in os.listdir(journal_dir):
+                if f.endswith(PART_SUFFIX):
+                    os.replace(os.path.join(journal_dir, f), os.path.join(journal_dir, f[:-len(PART_SUFFIX)]))
+        except OSError as e:
+            logger.error('Could not set up the event journal in {}: {}'.format(journal_dir, e))
+            return
+
+        with self.lock:
+            self.journal_dir = journal_dir
+
+    def event(self, event, segment=None, **fields):
+        """
+        Record an event
+
+        Args:
+            event: One of EVENTS
+            segment: The ID of the segment the event is about, if any
+            fields: Anything else to record with the event. Must be JSON serialisable.
+        """
+        if event not in EVENTS:
+            raise ValueError('Unknown journal event {}'.format(event))
+
+        now = time.monotonic()
+        record = {'event': event, 't': round(now, 3), 'utc': round(time.time(), 3)}
+        if segment is not None:
+            record['segment'] = segment
+            if event == CAPTURE_START:
+                record['trace'] = tracer.start(segment)
+            elif event in TRACE_MARKS:
+                trace_id = tracer.mark(segment, TRACE_MARKS[event])
+                if trace_id is not None:
+                    record['trace'] = trace_id
+        record.update(fields)
+        line = json.dumps(record, separators=(',', ':'))
+
+        with self.lock:
+            if not self.buffer:
+                self.oldest_t = now
+            self.buffer.append(line)
+            due = len(self.buffer) >= FLUSH_EVENTS or now - self.oldest_t >= FLUSH_INTERVAL_S
+
+        if due:
+            self.flush()
+
+    def flush(self):
+        """ Append the buffered events to the current file """
+        with self.lock:
+            if self.journal_dir is None or not self.buffer:
+                return
+
+            try:
+                if self.path is None:
+                    self.path = os.path.join(self.journal_dir, 'journal_{}_{}.jsonl'.format(
+                        discover_serial(), time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())))
+                with open(self.path + PART_SUFFIX, 'a', encoding='utf-8') as f:
+                    f.write('\n'.join(self.buffer) + '\n')
+                self.buffer.clear()
+            except OSError as e:
+                # Not critical. The events stay buffered, up to MAX_BUFFERED_EVENTS.
+                logger.error('Could not write the event journal: {}'.format(e))
+
+    def roll(self):
+        """ Write out the buffered events and close the current file, so it can be uploaded """
+        self.flush()
+
+        with self.lock:
+            if self.path is None:
+                return
+            try:
+                os.replace(self.path + PART_SUFFIX, self.path)
+            except OSError as e:
+                logger.error('Could not close event journal {}: {}'.format(self.path, e))
+            self.path = None
+
+
+# Shared by the sensors and the sync loop
+journal = EventJournal()
+atexit.register(journal.flush)
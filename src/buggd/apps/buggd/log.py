@@ -4,35 +4,260 @@ This module is responsible for setting up the logging for thei buggd application
 On startup, setup_logging() is called to configure the logging to both stdout and a file.
 The current time and CPU serial number are used to create a unique log file name.
 
-This means that each boot of the device will create a new log file.
+This means that each boot of the device will create a new log file. The file is rolled
+over when it gets too big or too old. The closed file is gzipped straight into the upload
+directory, and archives that haven't been uploaded are pruned, oldest first, if they take
+up too much space.
+
+Log calls don't write anything themselves. Records go onto a bounded queue, and a
+listener thread writes them to stdout and the file, so the capture and upload threads
+never wait on the journal or the SD card. If the queue fills up records are dropped
+rather than blocking, and counted. Messages logged over and over from the same place,
+such as the per-try lines while waiting for a connection, can be rate-limited by passing
+``extra={'rate_limit': True}``. Everything else is always written.
 """
 
+import atexit
+import copy
+import gzip
 import logging
-from logging.handlers import WatchedFileHandler
+from logging.handlers import WatchedFileHandler, QueueHandler, QueueListener
 import os
+import queue
+import threading
 import time
 import sys
 import shutil
 from .utils import discover_serial
+from .checksums import PART_SUFFIX
 
 
 # The log_dir can't be included in config because we're
-# not loading config until after logging has started.
-LOG_DIR = '/home/buggd/logs/'
+# not loading config until after logging has started. It can be moved with
+# $BUGGD_LOG_DIR, e.g. to run on a development machine.
+LOG_DIR = os.environ.get('BUGGD_LOG_DIR', '/home/buggd/logs/')
 
 # This establishes the lowest level of logging that will be output in each handler.
 # to the console and file. This can be changed to higher levels on a per-module basis.
 STDOUT_DEFAULT_LOG_LEVEL = logging.DEBUG
 FILE_DEFAULT_LOG_LEVEL = logging.DEBUG
 
+# Start a new file when the current one reaches either limit
+LOG_ROTATE_MAX_BYTES = 2 * 1024 * 1024
+LOG_ROTATE_MAX_AGE_S = 3 * 60 * 60
+
+# Archives waiting to be uploaded, in the log and upload directories, are pruned to this
+LOG_ARCHIVE_MAX_BYTES = 64 * 1024 * 1024
+
+# Logs compress well, and fast compression keeps the listener thread from falling behind.
+# Level 3 takes less than half the time of zlib's default 6, for archives about a quarter bigger.
+LOG_GZIP_LEVEL = 3
+ARCHIVE_SUFFIX = '.gz'
+
+# Directory (under the upload directory) that archives are uploaded from
+UPLOAD_LOG_DIR_NAME = 'logs'
+
+# Records waiting to be written. Beyond this, new records are dropped.
+LOG_QUEUE_SIZE = 10000
+
+# Each rate-limited line of code may log RATE_LIMIT_BURST messages every RATE_LIMIT_WINDOW_S
+# seconds. Errors are never limited.
+RATE_LIMIT_ATTR = 'rate_limit'
+RATE_LIMIT_WINDOW_S = 60
+RATE_LIMIT_BURST = 5
+RATE_LIMIT_MAX_LEVEL = logging.WARNING
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Limit how often a call site that repeats itself can log
+
+    Only records logged with ``extra={'rate_limit': True}`` are limited, so distinct
+    messages from one line, such as each file uploaded, are all written. Messages are keyed
+    on the line they are logged from, not their text, so a message that includes a counter
+    or a time is still recognised as a repeat. The first message through after some were
+    dropped says how many.
+
+    Args:
+        window_s: Length of each window in seconds
+        burst: Messages allowed from each call site per window
+        max_level: Records above this level always pass
+    """
+
+    def __init__(self, window_s=RATE_LIMIT_WINDOW_S, burst=RATE_LIMIT_BURST, max_level=RATE_LIMIT_MAX_LEVEL):
+        super().__init__()
+        self.window_s = window_s
+        self.burst = burst
+        self.max_level = max_level
+        self.lock = threading.Lock()
+        self.sites = {}     # (pathname, lineno) -> [window start, count, suppressed]
+        self.suppressed = 0
+
+    def filter(self, record):
+        # When the filter is on more than one handler, decide once per record
+        decided = getattr(record, 'rate_limit_pass', None)
+        if decided is not None:
+            return decided
+        record.rate_limit_pass = self._check(record)
+        return record.rate_limit_pass
+
+    def _check(self, record):
+        if record.levelno > self.max_level or not getattr(record, RATE_LIMIT_ATTR, False):
+            return True
+
+        now = time.monotonic()
+        key = (record.pathname, record.lineno)
+        with self.lock:
+            site = self.sites.get(key)
+            if site is None or now - site[0] >= self.window_s:
+                suppressed = site[2] if site else 0
+                self.sites[key] = [now, 1, 0]
+            elif site[1] < self.burst:
+                site[1] += 1
+                suppressed = 0
+            else:
+                site[2] += 1
+                self.suppressed += 1
+                return False
+
+        if suppressed:
+            record.msg = '{} ({} similar messages suppressed)'.format(record.msg, suppressed)
+        return True
+
+
+# Formats tracebacks before they are queued
+_exc_formatter = logging.Formatter()
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    A QueueHandler that drops records when the queue is full rather than blocking, and
+    counts them. The next record that fits is preceded by a warning saying how many were lost.
+    """
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.lock_dropped = threading.Lock()
+        self.dropped = 0
+        self.unreported = 0
+
+    def prepare(self, record):
+        """
+        Resolve the message in the caller, since its arguments may change once we return,
+        but leave the formatting to the listener
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.unreported:
+                self._report_dropped(record)
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.lock_dropped:
+                self.dropped += 1
+                self.unreported += 1
+
+    def _report_dropped(self, record):
+        with self.lock_dropped:
+            n, self.unreported = self.unreported, 0
+        warning = logging.LogRecord(__name__, logging.WARNING, __file__, 0,
+                                    'Log queue full, dropped {} messages'.format(n), None, None)
+        warning.created = record.created
+        try:
+            self.queue.put_nowait(warning)
+        except queue.Full:
+            with self.lock_dropped:
+                self.unreported += n
+            raise
+
+
+class RollingFileHandler(WatchedFileHandler):
+    """
+    A file handler that starts a new file when the current one reaches max_bytes or
+    is max_age_s old, and passes the closed file to archive
+
+    Args:
+        namer: Returns the path for each new file
+        archive: Called with the path of each closed file
+        max_bytes: Size limit of each file
+        max_age_s: Age limit of each file
+    """
+
+    def __init__(self, namer, archive, max_bytes=LOG_ROTATE_MAX_BYTES, max_age_s=LOG_ROTATE_MAX_AGE_S):
+        self.namer = namer
+        self.archive = archive
+        self.max_bytes = max_bytes
+        self.max_age_s = max_age_s
+        super().__init__(filename=namer())
+        self.opened_t = time.monotonic()
+
+    def should_rollover(self):
+        if self.stream is None:
+            return False
+        return self.stream.tell() >= self.max_bytes or time.monotonic() - self.opened_t >= self.max_age_s
+
+    def rollover(self):
+        """ Close the current file, archive it and start a new one """
+        self.acquire()
+        try:
+            closed = self.baseFilename
+            if self.stream:
+                self.stream.close()
+            self.baseFilename = os.path.abspath(self.namer())
+            self.stream = self._open()
+            self._statstream()
+            self.opened_t = time.monotonic()
+        finally:
+            self.release()
+        self.archive(closed)
+
+    def emit(self, record):
+        if self.should_rollover():
+            self.rollover()
+        super().emit(record)
+
+
+def compress_file(src_path, dst_path):
+    """ gzip a file into dst_path, a chunk at a time, and remove the original """
+    part_path = dst_path + PART_SUFFIX
+    with open(src_path, 'rb') as f_in, open(part_path, 'wb') as f_raw:
+        with gzip.GzipFile(filename=os.path.basename(src_path), mode='wb',
+                           compresslevel=LOG_GZIP_LEVEL, fileobj=f_raw) as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        f_raw.flush()
+        os.fsync(f_raw.fileno())
+    os.rename(part_path, dst_path)
+    os.remove(src_path)
+
+
+class _Listener(QueueListener):
+    """ A QueueListener whose stop() doesn't raise if the queue is full """
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
 class Log:
     """
     Setup logging for the application
 
     Called once at the start of the application to setup logging to both stdout and a file
     """
-    def __init__(self):
-        """ Setup the logger to log to both stdout and a file"""
+    def __init__(self, use_queue=True):
+        """
+        Setup the logger to log to both stdout and a file
+
+        Args:
+            use_queue: Write the logs from a background thread. If False, each log call
+            writes to stdout and the file itself.
+        """
         self.log_dir = LOG_DIR
         self.cpu_serial = discover_serial()
 
@@ -53,12 +278,32 @@ class Log:
         self.stdout_handler = logging.StreamHandler(sys.stdout)
         self.stdout_handler.setLevel(STDOUT_DEFAULT_LOG_LEVEL)
         self.stdout_handler.setFormatter(self.formatter)
-        self.logger.addHandler(self.stdout_handler)
 
-        # Handler for file is created in rotate_log()
-        self.file_handler = None
-        self.rotate_log()
+        # Handler for file, which is archived to the upload directory once it's set
+        self.upload_dir = None
+        self.file_handler = RollingFileHandler(self.generate_new_logfile_name, self.archive)
+        self.file_handler.setLevel(FILE_DEFAULT_LOG_LEVEL)
+        self.file_handler.setFormatter(self.formatter)
+
+        # The stdout and file handlers are called from the listener thread, or directly
+        # from the root logger if we're not queueing
+        self.rate_limit = RateLimitFilter()
+        self.queue_handler = None
+        self.listener = None
+        if use_queue:
+            self.queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+            self.queue_handler.addFilter(self.rate_limit)
+            self.logger.addHandler(self.queue_handler)
+            self.listener = _Listener(self.queue_handler.queue, self.stdout_handler, self.file_handler,
+                                      respect_handler_level=True)
+            self.listener.start()
+            atexit.register(self.stop)
+        else:
+            for handler in (self.stdout_handler, self.file_handler):
+                handler.addFilter(self.rate_limit)
+                self.logger.addHandler(handler)
 
+        self.logger.info('Logging to file %s', self.file_handler.baseFilename)
         self.logger.info('Logging to stdout started')
 
     def get_current_log_filename(self):
@@ -72,45 +317,148 @@ class Log:
 
     def generate_new_logfile_name(self):
         """ Generate a new log file name based on the current time and CPU serial number """
-        # Get the current time - this is the time buggd was started
-        start_time = time.strftime('%Y%m%d_%H%M')
+        # Get the current time - this is the time the file was started
+        start_time = time.strftime('%Y%m%d_%H%M%S')
 
+        # Uploaded archives are deleted, so the time keeps names unique in the bucket.
+        # Files rolled over within the same second are numbered.
         fn = f'rpi_eco_{self.cpu_serial}_{start_time}.log'
+        n = 0
+        while self._name_taken(fn):
+            n += 1
+            fn = f'rpi_eco_{self.cpu_serial}_{start_time}_{n}.log'
         return os.path.join(self.log_dir, fn)
 
+    def _name_taken(self, fn):
+        """ Check if a log file, or its archive, already exists """
+        dirs = [self.log_dir]
+        if self.upload_dir:
+            dirs.append(os.path.join(self.upload_dir, UPLOAD_LOG_DIR_NAME))
+        return any(os.path.exists(os.path.join(d, name)) for d in dirs for name in (fn, fn + ARCHIVE_SUFFIX))
+
     def rotate_log(self):
         """
-        Rotate the log file by closing the current one and creating a new one.
+        Rotate the log file now, rather than waiting for it to reach its size or age limit
         """
-        if self.file_handler:
-            self.logger.removeHandler(self.file_handler)
-            self.file_handler.close()
+        self.file_handler.rollover()
+        self.logger.info('Logging to file %s', self.file_handler.baseFilename)
 
-        fn = self.generate_new_logfile_name()
-        self.file_handler = WatchedFileHandler(filename=fn)
-        self.file_handler.setLevel(FILE_DEFAULT_LOG_LEVEL)
-        self.file_handler.setFormatter(self.formatter)
-        self.logger.addHandler(self.file_handler)
+    def archive(self, path):
+        """
+        Compress a closed log file into the upload directory, or alongside it if there
+        isn't an upload directory yet, and prune the archives
+        """
+        if self.upload_dir:
+            dst_dir = os.path.join(self.upload_dir, UPLOAD_LOG_DIR_NAME)
+        else:
+            dst_dir = os.path.dirname(path)
+
+        try:
+            os.makedirs(dst_dir, exist_ok=True)
+            compress_file(path, os.path.join(dst_dir, os.path.basename(path) + ARCHIVE_SUFFIX))
+        except OSError as e:
+            # Not critical - the uncompressed file is picked up at the next boot
+            self.logger.error('Could not archive log %s. %s', path, e)
+            return
+
+        self._prune_and_report()
+
+    def prune(self, max_bytes=LOG_ARCHIVE_MAX_BYTES):
+        """
+        Delete the oldest archives until those waiting to be uploaded fit in max_bytes.
+        The sync may have listed them already. It skips a file that has gone.
+
+        Returns:
+            The number of archives deleted
+        """
+        dirs = [self.log_dir]
+        if self.upload_dir:
+            dirs.append(os.path.join(self.upload_dir, UPLOAD_LOG_DIR_NAME))
+
+        archives = []
+        for d in dirs:
+            try:
+                names = os.listdir(d)
+            except OSError:
+                continue
+            for name in names:
+                if name.endswith('.log' + ARCHIVE_SUFFIX):
+                    try:
+                        st = os.stat(os.path.join(d, name))
+                    except OSError:
+                        continue
+                    archives.append((st.st_mtime, st.st_size, os.path.join(d, name)))
 
-        self.logger.info('Logging to file %s', fn)
+        total = sum(size for _, size, _ in archives)
+        n_deleted = 0
+        for _, size, path in sorted(archives):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            n_deleted += 1
 
+        return n_deleted
+
+    @property
+    def dropped(self):
+        """ How many records have been dropped because the queue was full """
+        return self.queue_handler.dropped if self.queue_handler else 0
+
+    def flush(self):
+        """ Write out everything queued so far, e.g. before a reboot, and carry on through the queue """
+        if self.listener is not None:
+            # Stopping the listener drains the queue. What is logged meanwhile waits for the restart.
+            self.listener.stop()
+            self.listener.start()
+        for handler in (self.stdout_handler, self.file_handler):
+            handler.flush()
+
+    def stop(self):
+        """ Write out everything still queued, and go back to logging from the caller's thread """
+        if self.listener is None:
+            return
+
+        self.logger.removeHandler(self.queue_handler)
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.addFilter(self.rate_limit)
+            self.logger.addHandler(handler)
+        self.listener = None
 
     def move_archived_to_dir(self, upload_dir):
-        """ Move the archived log files to the upload directory """
+        """
+        Hand the logs from earlier boots to the upload directory, compressing any that
+        weren't archived, and archive into it from now on
+        """
         try:
-            upload_dir_logs = os.path.join(upload_dir, 'logs')
+            upload_dir_logs = os.path.join(upload_dir, UPLOAD_LOG_DIR_NAME)
             os.makedirs(upload_dir_logs, exist_ok=True)
+            self.upload_dir = upload_dir
 
             log_dir = self.log_dir
+            current = os.path.basename(self.get_current_log_filename())
 
-            existing_logs = [f for f in os.listdir(log_dir)
-                             if f.endswith('.log')
-                                and f != os.path.basename(self.get_current_log_filename())]
-
-            for log in existing_logs:
-                shutil.move(os.path.join(log_dir, log),
-                        os.path.join(upload_dir_logs, log))
-                self.logger.info('Moved %s to upload', log)
+            for log in sorted(os.listdir(log_dir)):
+                if log.endswith('.log' + ARCHIVE_SUFFIX):
+                    shutil.move(os.path.join(log_dir, log),
+                            os.path.join(upload_dir_logs, log))
+                    self.logger.info('Moved %s to upload', log)
+                elif log.endswith('.log') and log != current:
+                    compress_file(os.path.join(log_dir, log),
+                                  os.path.join(upload_dir_logs, log + ARCHIVE_SUFFIX))
+                    self.logger.info('Compressed %s to upload', log)
         except OSError as e:
             # not critical - can leave logs in the log_dir
-            self.logger.error('Could not move existing logs to upload. %s', e)
\ No newline at end of file
+            self.logger.error('Could not move existing logs to upload. %s', e)
+
+        self._prune_and_report()
+
+    def _prune_and_report(self):
+        n_pruned = self.prune()
+        if n_pruned:
+            self.logger.warning('Deleted the %d oldest log archives to stay under %d MB',
+                                n_pruned, LOG_ARCHIVE_MAX_BYTES // (1024 * 1024))
@@ -9,27 +9,41 @@ import logging
 import argparse
 import atexit
 import traceback
+import collections
 from importlib import metadata
-from google.cloud import storage
-from pcf8574 import PCF8574
 
 from buggd import sensors
+from buggd import hal
 from buggd.drivers.modem import Modem
 from buggd.drivers.userled import UserLED
 from buggd.drivers.leds import LEDs, Colour
+from buggd.drivers.ledpatterns import LEDPatternEngine, blink, hold, PRIORITY_ERROR, PRIORITY_STATUS
 
 from .utils import call_cmd_line, mount_ext_sd, copy_sd_card_config, discover_serial, clean_dirs, check_sd_not_corrupt, merge_dirs
-from .utils import check_internet_conn, update_time, set_led,  wait_for_internet_conn, check_reboot_due
+from .utils import check_internet_conn, wait_for_internet_conn, check_reboot_due
+from .manifest import manifests
+from .connectivity import connectivity
+from .timesync import timesync
+from .telemetry import telemetry
+from .journal import journal, MODEM_ON, MODEM_OFF, MAINTENANCE, REBOOT_GAP
+from .profiling import profiler, profiling_enabled, RECORD, POSTPROCESS, SYNC
+from .metrics import metrics, heartbeat, sample_system, send_heartbeat
+from .metrics import SEGMENTS_RECORDED, SEGMENT_GAP_S, SEGMENT_GAP_BUCKETS_S, POSTPROCESS_QUEUE_DEPTH
+from .metrics import ENCODE_REALTIME_FACTOR, ENCODE_REALTIME_FACTOR_BUCKETS, REBOOT_GAP_S
+from .backends import make_backend
+from .sync import sync_upload_dir
 from .factorytest import FactoryTest
 from .log import Log
 from .debug import Debug
+from .control import control, call as control_call, ControlError, ControlUnavailable
+from .supervisor import supervisor
 
 # Allow disabling of reboot feature for testing
 # TODO: make this a configurable parameter from the config.json file
 REBOOT_ALLOWED = True
 
-# How many times to try for an internet connection before starting recording
-BOOT_INTERNET_RETRIES = 30
+# How long to wait for an internet connection before starting recording or giving up on a sync
+BOOT_INTERNET_WAIT_S = 60
 
 # What time to reboot the device at daily
 REBOOT_TIME_UTC = dt.time(2, 0, 0)
@@ -37,26 +51,47 @@ REBOOT_TIME_UTC = dt.time(2, 0, 0)
 # How long to wait after an error for a reboot
 ERROR_WAIT_REBOOT_S = 300
 
-# GPIO information for the LED driver and LED colours
-PCF8574_I2C_ADD = 0x23
-PCF8574_I2C_BUS = 1
-REC_LED_CHS = (7, 6, 5)
-DATA_LED_CHS = (4, 3, 2)
-PWR_LED_CHS = (1, 0)
+# Before the daily reboot, how long to wait for the queued segments to be encoded, and for
+# the sync to finish the file it is uploading, checking this often
+MAINTENANCE_DRAIN_TIMEOUT_S = 1800
+MAINTENANCE_SYNC_TIMEOUT_S = 600
+MAINTENANCE_POLL_S = 5
+
+# How long the reboot command has to take effect before recording starts again
+MAINTENANCE_REBOOT_WAIT_S = 300
+
+# When recording stopped for the daily reboot, so the next boot can log the gap. Kept
+# alongside the config file, as the working directory doesn't survive a reboot.
+REBOOT_STATE_FNAME = 'reboot_state.json'
+
+# Worker threads, run by the supervisor
+RECORD_WORKER = 'record'
+POSTPROCESS_WORKER = 'postprocess'
+SYNC_WORKER = 'sync'
+
+# A worker is stalled if it makes no progress for its usual time (e.g. a segment) and this long
+WORKER_LIVENESS_MARGIN_S = 1800
+
+# How often the idle postprocess worker checks in
+POSTPROCESS_POLL_S = 10
+
+# LED colours. The top LED shows recording and the middle LED shows the data connection
 DATA_LED_UPDATE_INT = 10
-REC_LED_REC = (0, 1, 0)
-REC_LED_SLEEP = (0, 0, 0)
-DATA_LED_SETUP = (0, 1, 0)
-DATA_LED_UPLOADING = (0, 1, 1)
-DATA_LED_CONN = (0, 0, 1)
-DATA_LED_NO_CONN = (1, 0, 0)
-DATA_LED_NO_CONN_OFFL = (0, 0, 0)
-LED_ALL_ON = (1, 1, 1)
-LED_ALL_OFF = (0, 0, 0)
-PWR_LED_ON = (0, 0)
+REC_LED_REC = Colour.GREEN
+REC_LED_SLEEP = Colour.OFF
+DATA_LED_SETUP = Colour.GREEN
+DATA_LED_UPLOADING = Colour.CYAN
+DATA_LED_CONN = Colour.BLUE
+DATA_LED_NO_CONN = Colour.RED
+DATA_LED_NO_CONN_OFFL = Colour.OFF
+LED_ALL_ON = Colour.WHITE
+LED_ALL_OFF = Colour.OFF
 
 CONFIG_FNAME = 'config.json'
 
+# Scratch space for recordings in progress
+WORKING_DIR_ROOT = '/tmp'
+
 SD_MNT_LOC = '/mnt/sd/'
 FACTORY_TEST_TRIGGER_FULL = '/mnt/sd/factory-test-full.txt'
 FACTORY_TEST_TRIGGER_BARE_BOARD = '/mnt/sd/factory-test-bare.txt'
@@ -65,8 +100,25 @@ GLOB_no_sd_mode = False
 GLOB_is_connected = False
 #TODO: make offline mode a configurable parameter from the config.json file
 GLOB_offline_mode = False
+# When the last capture finished, to measure the gap before the next one
+GLOB_last_capture_end_t = None
+GLOB_sync_in_progress = False
+GLOB_postprocess_in_progress = False
+# The daily reboot is only tried once per boot
+GLOB_reboot_attempted = False
+
+# Set to start the next sync cycle straight away, e.g. by buggd --sync-now
+sync_requested = threading.Event()
+
+# Set while draining the pipeline for the daily reboot. No new segment or sync cycle starts.
+maintenance = threading.Event()
+
+# Segments waiting for the postprocess worker, as (sensor, name), and the event that wakes it
+postprocess_queue = collections.deque()
+postprocess_ready = threading.Event()
 
 leds = LEDs() # Make the LEDs object global so it can be accessed by the cleanup function
+patterns = LEDPatternEngine(leds) # Animates the LEDs without blocking the caller
 log = Log() # Make the Log object global
 debug = Debug() # Make the Debug object global so we can log tracebacks anywhere
 
@@ -84,6 +136,7 @@ Sensor setup and recording
 * auto_sys_config() # returns automatically detected system configuration options
 * auto_configure_sensor() # sets up the sensor using the config file
 * record_sensor(sensor, wdir, udir, sleep=True) # initiates a single round of sampling
+* postprocess_worker(die) # encodes the segments queued by record_sensor
 
 GCS server sync
 * gcs_server_sync(sync_int, udir, die) # rolling synchronisation, intended to run in thread
@@ -103,7 +156,7 @@ def auto_sys_config(sd_mnt_dir, use_sd_card):
     working_dir_name = 'rpi-ecosystem-monitoring_tmp'
     upload_dir_name = 'audio'
 
-    working_dir = os.path.join('/tmp',working_dir_name)
+    working_dir = os.path.join(WORKING_DIR_ROOT,working_dir_name)
 
     upload_dir_local = upload_dir_name
 
@@ -181,7 +234,7 @@ def auto_configure_sensor():
     return sensor
 
 
-def record_sensor(sensor, working_dir, data_dir, led_driver):
+def record_sensor(sensor, working_dir, data_dir):
 
     """
     Function to run the common sensor record loop. The sleep between
@@ -190,27 +243,81 @@ def record_sensor(sensor, working_dir, data_dir, led_driver):
         sensor: A sensor instance
         working_dir: The working directory to be used by the sensor
         data_dir: The data directory to use for completed files
-        led_driver: The I2C driver for the LEDs
     """
 
-    # Capture data from the sensor
-    logger.info('Capturing data from sensor')
-    set_led(led_driver, REC_LED_CHS, REC_LED_REC)
+    global GLOB_last_capture_end_t
 
-    uncomp_f = sensor.capture_data(working_dir=working_dir, data_dir=data_dir)
+    with profiler.section(RECORD):
+        # Capture data from the sensor
+        logger.info('Capturing data from sensor')
+        leds.top.set(REC_LED_REC)
+
+        capture_start_t = time.monotonic()
+        if GLOB_last_capture_end_t is not None:
+            metrics.observe(SEGMENT_GAP_S, capture_start_t - GLOB_last_capture_end_t, SEGMENT_GAP_BUCKETS_S)
+        else:
+            log_reboot_gap()
 
-    # Check whether the daily reboot is required
-    cmd_on_complete = None
-    if check_reboot_due(REBOOT_TIME_UTC):
-        cmd_on_complete = 'sudo reboot'
+        uncomp_f = sensor.capture_data(working_dir=working_dir, data_dir=data_dir)
+        GLOB_last_capture_end_t = time.monotonic()
+        metrics.inc(SEGMENTS_RECORDED)
 
-    # Postprocess the raw data in a separate thread
-    postprocess_t = threading.Thread(target=sensor.postprocess, args=(uncomp_f,cmd_on_complete,))
-    postprocess_t.start()
+        # Queue the raw data for the postprocess worker
+        metrics.add(POSTPROCESS_QUEUE_DEPTH, 1)
+        postprocess_queue.append((sensor, uncomp_f))
+        postprocess_ready.set()
 
-    # Let the sensor sleep
-    set_led(led_driver, REC_LED_CHS, REC_LED_SLEEP)
-    sensor.sleep()
+        # Let the sensor sleep
+        leds.top.set(REC_LED_SLEEP)
+        sensor.sleep()
+
+def postprocess_segment(sensor, uncomp_f):
+
+    """
+    Run the sensor's postprocess on a segment, measuring how fast it is compared to real time
+    Args:
+        sensor: A sensor instance
+        uncomp_f: The name of the segment returned by capture_data
+    """
+
+    start_t = time.monotonic()
+    try:
+        with profiler.section(POSTPROCESS):
+            sensor.postprocess(uncomp_f)
+    finally:
+        metrics.add(POSTPROCESS_QUEUE_DEPTH, -1)
+
+    metrics.observe(ENCODE_REALTIME_FACTOR, (time.monotonic() - start_t) / sensor.record_length,
+                    ENCODE_REALTIME_FACTOR_BUCKETS)
+
+def postprocess_worker(die):
+
+    """
+    Postprocess the segments queued by record_sensor, one at a time, in the order they were recorded
+
+    Args:
+        die: A threading event to terminate the worker
+    """
+
+    global GLOB_postprocess_in_progress
+
+    while not die.is_set():
+        supervisor.ping(POSTPROCESS_WORKER)
+
+        # Cleared before looking, so a segment queued meanwhile still wakes the wait below
+        postprocess_ready.clear()
+        if not postprocess_queue:
+            postprocess_ready.wait(POSTPROCESS_POLL_S)
+            continue
+
+        # Flagged before it leaves the queue, so the daily reboot can't find the queue empty
+        # and the worker idle while a segment is between the two
+        GLOB_postprocess_in_progress = True
+        try:
+            sensor, uncomp_f = postprocess_queue.popleft()
+            postprocess_segment(sensor, uncomp_f)
+        finally:
+            GLOB_postprocess_in_progress = False
 
 def exit_handler(signal, frame):
 
@@ -236,20 +343,21 @@ class StopMonitoring(Exception):
     pass
 
 
-def gcs_server_sync(sync_interval, upload_dir, die, config_path, led_driver, modem, data_led_update_int):
+def gcs_server_sync(sync_interval, upload_dir, die, config_path, modem, data_led_update_int):
 
     """
-    Function to synchronize the upload data folder with the GCS bucket
+    Function to synchronize the upload data folder with the upload backend (normally the GCS bucket)
 
     Parameters:
         sync_interval: The time interval between synchronisation connections
         upload_dir: The upload directory to synchronise (top level, not the device specific subdirectory)
         die: A threading event to terminate the GCS server sync
-        led_driver: The I2C driver for controlling the LEDs
+        modem: The modem driver
         data_led_update_int: How often to update the status of the data LED in minutes
     """
 
     global GLOB_is_connected
+    global GLOB_sync_in_progress
     global log
 
     # Sleep the thread and keep updating the data LED until the first upload cycle
@@ -257,80 +365,99 @@ def gcs_server_sync(sync_interval, upload_dir, die, config_path, led_driver, mod
     start_offs = sync_interval/2
     logger.info('Sleeping data upload thread for {} secs before first upload'.format(start_offs))
 
-    # Check for internet conn to update LED
-    GLOB_is_connected = check_internet_conn(led_driver, DATA_LED_CHS, col_succ=DATA_LED_CONN, col_fail=DATA_LED_NO_CONN)
+    supervisor.ping(SYNC_WORKER)
+
+    # Update LED from the connection state found at boot (only probes if that is stale)
+    GLOB_is_connected = check_internet_conn(leds.middle, col_succ=DATA_LED_CONN, col_fail=DATA_LED_NO_CONN)
     # Turn off modem to save power
     modem.power_off()
+    journal.event(MODEM_OFF)
+    connectivity.invalidate()
 
     # Wait till half way through first recording to first upload try
     wait_t = start_offs - (time.time() - start_t)
-    time.sleep(max(0, wait_t))
+    sync_requested.wait(max(0, wait_t))
 
     # keep running while the die is not set
     while not die.is_set():
+        if maintenance.is_set():
+            # Draining for the daily reboot, so no new cycle starts
+            supervisor.ping(SYNC_WORKER)
+            time.sleep(MAINTENANCE_POLL_S)
+            continue
+
         # Update sync start time
         start_t = time.time()
+        sync_requested.clear()
+        GLOB_sync_in_progress = True
+        supervisor.ping(SYNC_WORKER)
 
         # Enable the modem and wait for an internet connection
-        modem.power_on()
-        GLOB_is_connected = wait_for_internet_conn(BOOT_INTERNET_RETRIES, led_driver, DATA_LED_CHS, col_succ=DATA_LED_CONN, col_fail=DATA_LED_NO_CONN)
+        modem_on = modem.power_on()
+        journal.event(MODEM_ON, ok=modem_on, duration_s=round(time.time() - start_t, 3))
+        if modem_on:
+            telemetry.start(modem)
+        GLOB_is_connected = wait_for_internet_conn(BOOT_INTERNET_WAIT_S, leds.middle, col_succ=DATA_LED_CONN, col_fail=DATA_LED_NO_CONN)
+        logger.info('Modem state: {}'.format(telemetry.latest()))
 
         # Set data LED to active uploading state (only if the device is connected as otherwise it's confusing - is the device uploading or not?)
         if GLOB_is_connected:
-            # Update time from internet
-            update_time()
+            # Check the clock against network time alongside the upload, rather than holding it up
+            timesync.sync_async()
 
             logger.info('Started GCS sync at {} to upload_dir {}'.format(dt.datetime.utcnow(), upload_dir))
 
             # Set the LED to uploading colour
-            set_led(led_driver, DATA_LED_CHS, DATA_LED_UPLOADING)
-
-            log.rotate_log()
+            leds.middle.set(DATA_LED_UPLOADING)
 
             try:
-                # Get credentials from JSON file
-                client = storage.Client.from_service_account_json(config_path)
-
-                # Find the right GCS bucket
-                bugg_device_conf = json.load(open(config_path))['device']
-                gcs_bucket_name = bugg_device_conf['gcs_bucket_name']
-                bucket = client.bucket(gcs_bucket_name)
-
-                # Loop through local files, uploading them to the server
-                for root, subdirs, files in os.walk(upload_dir):
-                    for local_f in files:
-                        local_path = os.path.join(root, local_f)
-                        remote_path = local_path[len(upload_dir)+1:]
-                        logger.info('Uploading {} to {}'.format(local_path, remote_path))
-                        upload_f = bucket.blob(remote_path)
-                        upload_f.upload_from_filename(filename=local_path)
-
-                        # If the file did not upload successfully an Exception will be thrown
-                        # by upload_from_filename, so if we're here it's safe to delete the local file
-                        logger.info('Upload complete. Deleting local file at {}'.format(local_path))
-                        os.remove(local_path)
+                # Write out the profiles so far, so they go up with this cycle
+                profiler.write()
+
+                with profiler.section(SYNC):
+                    # Connect to the configured upload backend (GCS unless the config says otherwise)
+                    backend = make_backend(config_path)
+
+                    # Send the heartbeat first, so it gets through even if the cycle is cut short
+                    modem_state = telemetry.latest()
+                    sample_system(metrics, upload_dir, rssi_dbm=modem_state['rssi_dbm'] if modem_state else None)
+                    send_heartbeat(backend, metrics)
+
+                    # The daily reboot stops the cycle after the file being uploaded
+                    sync_upload_dir(backend, upload_dir, progress=lambda: supervisor.ping(SYNC_WORKER),
+                                    stop=maintenance)
 
             except Exception as e:
                 logger.info('Exception caught in gcs_server_sync: {}'.format(str(e)))
                 debug.write_traceback_to_log()
 
             # Done uploading so set LED back to connected mode
-            set_led(led_driver, DATA_LED_CHS, DATA_LED_CONN)
+            leds.middle.set(DATA_LED_CONN)
 
         else:
             logger.info('No internet connection available, so not trying GCS sync')
 
+        # Let a time sync started above finish before the connection goes
+        timesync.join()
+        telemetry.stop()
+
         # Disable the modem to save power
         logger.info('Disabling modem until next server sync (to save power)')
         modem.power_off()
+        journal.event(MODEM_OFF, on_s=round(time.time() - start_t, 3))
+        connectivity.invalidate()
+        GLOB_is_connected = False
+        GLOB_sync_in_progress = False
 
-        # Sleep the thread until the next upload cycle
+        # Sleep the thread until the next upload cycle, or until a sync is asked for
         sync_wait = sync_interval - (time.time() - start_t)
         logger.info('Waiting {} secs to next sync'.format(sync_wait))
-        time.sleep(max(0, sync_wait))
+        supervisor.ping(SYNC_WORKER)
+        if sync_requested.wait(max(0, sync_wait)):
+            logger.info('Sync requested, starting it early')
 
 
-def continuous_recording(sensor, working_dir, data_dir, led_driver, die):
+def continuous_recording(sensor, working_dir, data_dir, die):
 
     """
     Runs a loop over the sensor sampling process
@@ -339,54 +466,180 @@ def continuous_recording(sensor, working_dir, data_dir, led_driver, die):
         sensor: A instance of one of the sensor classes
         working_dir: Path to the working directory for recording
         data_dir: Path to the final directory used to store processed data files
-        led_driver: The I2C driver for controlling the LEDs
-        die: A threading event to terminate the server sync
+        die: A threading event to terminate the recording
+
+    Errors are left to the supervisor, which restarts the loop. The daily reboot is taken
+    here, between segments.
+    """
+
+    # Start recording
+    while not die.is_set():
+        supervisor.ping(RECORD_WORKER)
+
+        # Check whether the daily reboot is required
+        if REBOOT_ALLOWED and not GLOB_reboot_attempted and check_reboot_due(REBOOT_TIME_UTC):
+            maintenance_reboot(die)
+            continue
+
+        logger.info('GLOB_no_sd_mode: {}, GLOB_is_connected: {}, GLOB_offline_mode: {}'.format(GLOB_no_sd_mode, GLOB_is_connected, GLOB_offline_mode))
+        record_sensor(sensor, working_dir, data_dir)
+
+
+def wait_for_maintenance(done, timeout_s, die):
+    """
+    Wait for a step of the daily reboot, keeping the record worker alive meanwhile
+
+    Args:
+        done: Returns True once the step is done
+        timeout_s: How long to wait at most
+        die: A threading event to terminate the recording
+
+    Returns:
+        True if the step is done
     """
 
+    end_t = time.monotonic() + timeout_s
+    while not done() and not die.is_set() and time.monotonic() < end_t:
+        supervisor.ping(RECORD_WORKER)
+        time.sleep(MAINTENANCE_POLL_S)
+    return done()
+
+
+def maintenance_reboot(die):
+
+    """
+    Take the daily reboot once the pipeline has drained, rather than in the middle of it
+
+    Runs on the record worker, between segments, so no segment is cut short. No new segment
+    or sync cycle is started. The segments waiting to be encoded are encoded, and the sync
+    finishes the file it is uploading; the rest stay on disk, and an upload that was cut
+    off is checked against the bucket before it is sent again. The journal, profiles and
+    logs are written out, and when recording stopped is saved so that the next boot can
+    log how long the gap was.
+
+    Args:
+        die: A threading event to terminate the recording
+    """
+
+    global GLOB_reboot_attempted
+    GLOB_reboot_attempted = True
+
+    start_t = time.monotonic()
+    logger.info('Daily reboot due. Stopped recording at the end of a segment, draining the pipeline')
+    maintenance.set()
+
+    drained = wait_for_maintenance(lambda: not postprocess_queue and not GLOB_postprocess_in_progress,
+                                   MAINTENANCE_DRAIN_TIMEOUT_S, die)
+    drain_s = time.monotonic() - start_t
+    if not drained:
+        logger.warning('{} segments still waiting to be encoded after {:.0f}s, rebooting anyway'.format(
+            len(postprocess_queue) + GLOB_postprocess_in_progress, drain_s))
+
+    synced = wait_for_maintenance(lambda: not GLOB_sync_in_progress, MAINTENANCE_SYNC_TIMEOUT_S, die)
+    sync_wait_s = time.monotonic() - start_t - drain_s
+    if not synced:
+        logger.warning('Sync still running after {:.0f}s, rebooting anyway'.format(sync_wait_s))
+
+    if die.is_set():
+        maintenance.clear()
+        return
+
+    # Write out everything held in memory, so it goes up after the reboot
+    journal.event(MAINTENANCE, drain_s=round(drain_s, 3), sync_wait_s=round(sync_wait_s, 3),
+                  drained=drained, synced=synced)
+    journal.roll()
+    profiler.write()
+    save_reboot_state(GLOB_last_capture_end_t, drain_s + sync_wait_s)
+
+    logger.info('Pipeline drained in {:.0f}s ({:.0f}s encoding, {:.0f}s finishing the sync), rebooting'.format(
+        drain_s + sync_wait_s, drain_s, sync_wait_s))
+    log.flush()
+    os.sync()
+    call_cmd_line('sudo reboot')
+
+    # The reboot stops the daemon, so carrying on means it didn't happen
+    time.sleep(MAINTENANCE_REBOOT_WAIT_S)
+    logger.error('Still running {}s after the daily reboot, so recording again'.format(MAINTENANCE_REBOOT_WAIT_S))
+    clear_reboot_state()
+    maintenance.clear()
+
+
+def save_reboot_state(last_capture_end_t, drain_s):
+    """
+    Save when recording stopped for a reboot, as wall clock time
+
+    Args:
+        last_capture_end_t: When the last capture ended, as time.monotonic(), or None if there wasn't one
+        drain_s: How long the pipeline took to drain
+    """
+
+    now = time.time()
+    capture_end_utc = now - (time.monotonic() - last_capture_end_t) if last_capture_end_t is not None else now
     try:
-        # Start recording
-        while not die.is_set():
-            logger.info('GLOB_no_sd_mode: {}, GLOB_is_connected: {}, GLOB_offline_mode: {}'.format(GLOB_no_sd_mode, GLOB_is_connected, GLOB_offline_mode))
-            record_sensor(sensor, working_dir, data_dir, led_driver)
-    except Exception as e:
-        logging.error('Caught exception on continuous_recording() function: {}'.format(str(e)))
-        debug.write_traceback_to_log()
-        # Blink error code on LEDs
-        blink_error_leds(led_driver, e, dur=ERROR_WAIT_REBOOT_S)
+        with open(REBOOT_STATE_FNAME, 'w') as f:
+            json.dump({'capture_end_utc': round(capture_end_utc, 3), 'reboot_utc': round(now, 3),
+                       'drain_s': round(drain_s, 3)}, f)
+    except OSError as e:
+        # Not critical, only the gap isn't logged
+        logger.error('Could not save the reboot state: {}'.format(e))
+
+
+def clear_reboot_state():
+    """ Remove the saved reboot state, if there is one """
+    try:
+        os.remove(REBOOT_STATE_FNAME)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.error('Could not remove the reboot state: {}'.format(e))
+
 
+def log_reboot_gap():
+    """
+    At the first capture after a daily reboot, log how long recording stopped for
+    """
 
-def blink_error_leds(led_driver, error_e, dur=None):
+    try:
+        with open(REBOOT_STATE_FNAME) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        logger.error('Could not read the reboot state: {}'.format(e))
+        clear_reboot_state()
+        return
+    clear_reboot_state()
+
+    now = time.time()
+    gap_s = now - state['capture_end_utc']
+    reboot_s = now - state['reboot_utc']
+    logger.info('Recording gap across the daily reboot: {:.0f}s ({:.0f}s draining, {:.0f}s rebooting)'.format(
+        gap_s, state['drain_s'], reboot_s))
+    metrics.set(REBOOT_GAP_S, round(gap_s, 3))
+    metrics.observe(SEGMENT_GAP_S, gap_s, SEGMENT_GAP_BUCKETS_S)
+    journal.event(REBOOT_GAP, gap_s=round(gap_s, 3), drain_s=state['drain_s'], reboot_s=round(reboot_s, 3))
+
+
+def blink_error_leds(error_e, dur=None):
 
     #TODO: implement different flashing patterns for different error codes
     """
-    Communicate that a major error has occurred through LEDs flashing. This is
-    blocking and will stop all future code from running until rebooted
+    Communicate that a major error has occurred through LEDs flashing. The LEDs blink
+    on their own thread; if dur is given this waits that long and then reboots.
 
     Args:
-        led_driver: The I2C driver for controlling the LEDs
         error_e: the exception that caused the error
-        dur: duration in seconds to blink for
+        dur: duration in seconds to wait before rebooting, or None to blink without rebooting
     """
 
     # Blink all status LEDs to indicate a major error has occurred
-    running_t = 0
-    state = 1
+    patterns.post(blink((leds.top, leds.middle), LED_ALL_ON, on_s=1, off_s=1, off=LED_ALL_OFF,
+                        priority=PRIORITY_ERROR, name='error'))
 
-    # Return from function after finite duration if dur provided
-    if dur is not None:
-        while running_t < dur:
-            if state: led_cols = LED_ALL_ON
-            else: led_cols = LED_ALL_OFF
-            state = not state
+    if dur is None:
+        return
 
-            set_led(led_driver, REC_LED_CHS, led_cols)
-            set_led(led_driver, DATA_LED_CHS, led_cols)
-
-            time.sleep(1)
-            running_t += 1
-    else:
-        # Otherwise sleep forever
-        while True: time.sleep(60)
+    time.sleep(dur)
 
     # Reboot unit
     if REBOOT_ALLOWED:
@@ -394,7 +647,84 @@ def blink_error_leds(led_driver, error_e, dur=None):
         call_cmd_line('sudo reboot')
 
 
-def record(led_driver, modem):
+def daemon_status(sensor, upload_dir):
+    """ The state of the running daemon, for buggd --status """
+
+    last_capture_end_t = GLOB_last_capture_end_t
+    return {'version': metadata.version('buggd'),
+            'serial': discover_serial(),
+            'pid': os.getpid(),
+            'sensor': type(sensor).__name__,
+            'upload_dir': os.path.abspath(upload_dir),
+            'offline_mode': GLOB_offline_mode,
+            'no_sd_mode': GLOB_no_sd_mode,
+            'connected': GLOB_is_connected,
+            'sync_in_progress': GLOB_sync_in_progress,
+            'maintenance': maintenance.is_set(),
+            'since_capture_end_s': round(time.monotonic() - last_capture_end_t, 1) if last_capture_end_t is not None else None,
+            'profiling': profiler.enabled,
+            'workers': supervisor.status(),
+            'modem': telemetry.latest()}
+
+
+def sensor_soundcard(sensor):
+    """ The soundcard the sensor holds, if it holds one open """
+    soundcard = getattr(sensor, 'soundcard', None)
+    if soundcard is None:
+        raise ControlUnavailable('{} does not hold the soundcard open'.format(type(sensor).__name__))
+    return soundcard
+
+
+def modem_status(modem):
+    """ Query the modem, unless it is powered off between syncs """
+
+    status = {'powered': modem.rail_is_on(), 'enumerated': modem.is_enumerated(),
+              'responding': False, 'rssi': None, 'rssi_dbm': None, 'ccid': None}
+    if status['enumerated']:
+        status.update(modem.get_status())
+    return status
+
+
+def request_sync():
+    """ Start a sync cycle now, rather than waiting for the next one """
+
+    if GLOB_offline_mode:
+        raise ControlError('Recorder is in offline mode, so it does not sync')
+    if maintenance.is_set():
+        raise ControlError('Draining for the daily reboot, so not starting a sync')
+    if GLOB_sync_in_progress:
+        return {'started': False, 'in_progress': True}
+
+    sync_requested.set()
+    return {'started': True, 'in_progress': False}
+
+
+def serve_control(sensor, modem, upload_dir):
+    """
+    Serve commands from buggd --status, soundcardctl and modemctl on the control socket
+
+    Args:
+        sensor: The configured sensor instance
+        modem: The modem driver
+        upload_dir: The upload directory
+    """
+
+    control.register('status', lambda: daemon_status(sensor, upload_dir))
+    control.register('metrics', lambda: heartbeat(metrics))
+    control.register('gain', lambda gain: sensor_soundcard(sensor).set_gain(int(gain)))
+    control.register('phantom', lambda mode: sensor_soundcard(sensor).set_phantom(mode))
+    control.register('modem_status', lambda: modem_status(modem))
+    control.register('sync_now', request_sync)
+    control.start()
+
+
+def reboot_after_errors(reason):
+    """ Show the error on the LEDs and reboot, when the supervisor can't keep the workers going """
+    logger.critical('Rebooting in {}s: {}'.format(ERROR_WAIT_REBOOT_S, reason))
+    blink_error_leds(reason, dur=ERROR_WAIT_REBOOT_S)
+
+
+def record(modem):
 
     """
     Function to setup, run and log continuous sampling from the sensor.
@@ -413,6 +743,7 @@ def record(led_driver, modem):
     if not GLOB_offline_mode:
         # Enable the modem for a mobile network connection. If no modem set recorder to offline mode
         GLOB_offline_mode = not modem.power_on()
+        journal.event(MODEM_ON, ok=not GLOB_offline_mode)
 
     # Try to mount the external SD card
     try:
@@ -442,15 +773,18 @@ def record(led_driver, modem):
 
     if GLOB_offline_mode:
         # Set LEDs to offline mode
-        set_led(led_driver, DATA_LED_CHS, DATA_LED_NO_CONN_OFFL)
+        leds.middle.set(DATA_LED_NO_CONN_OFFL)
         logger.info('Recorder is in offline mode saving to SD card')
     else:
+        # Follow NetworkManager so waits for a connection end as soon as it comes up
+        connectivity.start_nm_monitor()
+
         # Waiting for internet connection
-        GLOB_is_connected = wait_for_internet_conn(BOOT_INTERNET_RETRIES, led_driver, DATA_LED_CHS, col_succ=DATA_LED_CONN, col_fail=DATA_LED_NO_CONN)
+        GLOB_is_connected = wait_for_internet_conn(BOOT_INTERNET_WAIT_S, leds.middle, col_succ=DATA_LED_CONN, col_fail=DATA_LED_NO_CONN)
 
         if GLOB_is_connected:
-            # Update time from internet
-            update_time()
+            # Update time from internet before the first segment is named
+            timesync.sync()
 
     # Determine the system configuration options automatically
     working_dir, upload_dir, data_dir = auto_sys_config(SD_MNT_LOC, not GLOB_no_sd_mode)
@@ -458,51 +792,62 @@ def record(led_driver, modem):
     # Clean data directories
     clean_dirs(working_dir,upload_dir,data_dir)
 
+    # Track segments relative to the upload directory in the daily manifests
+    manifests.set_upload_dir(upload_dir)
+    timesync.set_upload_dir(upload_dir)
+    telemetry.set_upload_dir(upload_dir)
+    journal.set_upload_dir(upload_dir)
+    profiler.set_upload_dir(upload_dir)
+
+    # Profile if the config asks for it. SIGUSR1 turns profiling on or off while running.
+    if profiling_enabled(CONFIG_FNAME):
+        profiler.start()
+    signal.signal(signal.SIGUSR1, profiler.toggle)
+
     # Move archived logs to the upload directory
     log.move_archived_to_dir(upload_dir)
 
     # Now get the sensor
     sensor = auto_configure_sensor()
 
+    # Let buggd --status, soundcardctl and modemctl talk to the running daemon
+    serve_control(sensor, modem, upload_dir)
+
     # Set up the threads to run and an event handler to allow them to be shutdown cleanly
     die = threading.Event()
     signal.signal(signal.SIGINT, exit_handler)
 
+    # The supervisor runs each loop on its own thread, restarting it if it fails. A loop is
+    # stalled if it makes no progress for a segment (or sync interval) and a margin.
+    supervisor.add(RECORD_WORKER, continuous_recording, (sensor, working_dir, data_dir, die),
+                   liveness_s=sensor.server_sync_interval + WORKER_LIVENESS_MARGIN_S)
+    supervisor.add(POSTPROCESS_WORKER, postprocess_worker, (die,),
+                   liveness_s=sensor.record_length + WORKER_LIVENESS_MARGIN_S)
     if not GLOB_offline_mode:
-        sync_thread = threading.Thread(target=gcs_server_sync, args=(sensor.server_sync_interval,
-                                                                     upload_dir, die, CONFIG_FNAME,
-                                                                     led_driver, modem, DATA_LED_UPDATE_INT))
-
-    record_thread = threading.Thread(target=continuous_recording, args=(sensor, working_dir,
-                                                                    data_dir, led_driver, die))
+        supervisor.add(SYNC_WORKER, gcs_server_sync, (sensor.server_sync_interval, upload_dir, die, CONFIG_FNAME,
+                                                      modem, DATA_LED_UPDATE_INT),
+                       liveness_s=sensor.server_sync_interval + WORKER_LIVENESS_MARGIN_S)
 
     # Initialise background thread to do remote sync of the root upload directory
     # Failure here does not preclude data capture and might be temporary so log
     # errors but don't exit.
     try:
-        # start the recorder
+        # start the recorder, the postprocess and (unless offline) the GCS sync
         logger.info('Starting continuous recording at {}'.format(dt.datetime.utcnow()))
-        record_thread.start()
+        supervisor.start(die, escalate=reboot_after_errors)
 
         if GLOB_offline_mode:
             logger.info('Running in offline mode - no GCS synchronisation')
         else:
-            # start the GCS sync thread
-            sync_thread.start()
             logger.info('Starting GCS server sync every {} seconds at {}'.format(sensor.server_sync_interval, dt.datetime.utcnow()))
 
-        # now run a loop that will continue with a small grain until
-        # an interrupt arrives, this is necessary to keep the program live
-        # and listening for interrupts
-        while True:
-            time.sleep(1)
+        # now supervise the workers until an interrupt arrives, which keeps
+        # the program live and listening for interrupts
+        supervisor.run()
     except StopMonitoring:
         # We've had an interrupt signal, so tell the threads to shutdown,
         # wait for them to finish and then exit the program
-        die.set()
-        record_thread.join()
-        if not GLOB_offline_mode:
-            sync_thread.join()
+        supervisor.stop()
 
         logger.info('Recording and sync shutdown, exiting at {}'.format(dt.datetime.utcnow()))
 
@@ -513,11 +858,46 @@ def handle_args():
                         help='Run factory test, even if trigger file is not present.')
     parser.add_argument('--force-factory-test-bare', action='store_true',
                         help='Run factory test in bare-board mode, even if trigger file is not present.')
+    parser.add_argument('--hal', choices=hal.BACKENDS, default=None,
+                        help='Hardware backend. Defaults to $BUGGD_HAL, or hardware if that is not set.')
     parser.add_argument('--version', action='version', version=metadata.version('buggd'))
+
+    ctl = parser.add_argument_group('control', 'Query or drive the running daemon')
+    ctl = ctl.add_mutually_exclusive_group()
+    ctl.add_argument('--status', action='store_true', help='Print the state of the running daemon.')
+    ctl.add_argument('--metrics', action='store_true', help='Print the running daemon\'s metrics.')
+    ctl.add_argument('--sync-now', action='store_true', help='Start a sync cycle now.')
+
+    sim = parser.add_argument_group('simulation')
+    sim.add_argument('--simulate', action='store_true',
+                     help='Run on simulated hardware and a virtual clock, and report on the recording and syncing.')
+    sim.add_argument('--sim-hours', type=float, default=24, help='How much time to simulate.')
+    sim.add_argument('--sim-config', default=None,
+                     help='Config file to simulate, e.g. one about to be sent out. SimMic records with its sensor options.')
+    sim.add_argument('--sim-dir', default=None,
+                     help='Directory for the simulated device\'s files. It is emptied first. A temporary directory by default.')
+    sim.add_argument('--sim-report', default=None, help='Also write the report to this file, as JSON.')
+    sim.add_argument('--sim-latency', type=float, default=0.6, help='Round trip time of the simulated link, in seconds.')
+    sim.add_argument('--sim-bandwidth-kBps', type=float, default=500, help='Upload bandwidth of the simulated link, in kilobytes (not kilobits) per second.')
+    sim.add_argument('--sim-failure-rate', type=float, default=0, help='Probability of an upload request failing.')
     args = parser.parse_args()
     return args
 
 
+def run_control_command(args):
+    """ Send --status, --metrics or --sync-now to the running daemon and print the reply """
+
+    cmd = 'status' if args.status else 'metrics' if args.metrics else 'sync_now'
+    try:
+        result = control_call(cmd)
+    except ControlError as e:
+        print('{}: {}'.format(cmd, e), file=sys.stderr)
+        return 1
+
+    print(json.dumps(result, indent=2))
+    return 0
+
+
 def main():
     """
     Main function to run the recording daemon
@@ -529,10 +909,23 @@ def main():
     Args:
         --force-factory-test: Run factory test, even if trigger file is not present.
         --force-factory-test-bare: Run factory test in bare-board mode, even if trigger file is not present.
+        --hal: Run on the real hardware, or on simulated peripherals.
+        --simulate: Run a simulation of the recording and syncing, and report on it.
+        --status, --metrics, --sync-now: Ask the running daemon, and exit.
     """
     # Parse command line arguments
     args = handle_args()
 
+    if args.status or args.metrics or args.sync_now:
+        sys.exit(run_control_command(args))
+
+    if args.simulate:
+        from .simulate import run_simulation
+        sys.exit(run_simulation(args))
+
+    # Before anything touches the hardware
+    hal.select(args.hal)
+
     start_time = time.strftime('%Y%m%d_%H%M')
     logger.info('Start of buggd version %s at %s', metadata.version('buggd'), format(start_time))
 
@@ -558,20 +951,17 @@ def main():
 
     # On boot, set the LEDs to show the status of the factory test
     logging.info('Displaying factory test status on LEDs for a few seconds...')
-    leds.top.set(Colour.MAGENTA)
-    leds.bottom.set(Colour.RED)
     if test.passed_at_factory():
-        leds.middle.set(Colour.GREEN)
+        factory_colour = Colour.GREEN
     else:
         logging.warning('Factory test has not run on this unit or it failed.')
-        leds.middle.set(Colour.RED)
-    time.sleep(4)
-    # Turn off test status leds before beginning recording, just so it's a bit clearer what's happening
+        factory_colour = Colour.RED
+    # The status is shown over the LEDs' normal colours, which start off, so it's a bit
+    # clearer what's happening when it ends. Booting carries on meanwhile.
     leds.all_off()
+    patterns.post(hold({leds.top: Colour.MAGENTA, leds.middle: factory_colour}, 4,
+                       priority=PRIORITY_STATUS, name='factory_status'))
     
-    # TODO: replace this old way of handling the LED's with the new LED driver
-    # Initialise LED driver and turn all channels off
-    led_driver = PCF8574(PCF8574_I2C_BUS, PCF8574_I2C_ADD)
     modem = Modem()
 
     # Initialise the LED on the main board
@@ -579,7 +969,7 @@ def main():
     try:
         # run continuous recording function
         led.on()
-        record(led_driver, modem)
+        record(modem)
     except Exception as e:
         type, val, tb = sys.exc_info()
         logging.error('Caught exception on main record() function: %s', e)
@@ -587,7 +977,7 @@ def main():
         led.off()
 
         # Blink error code on LEDs
-        blink_error_leds(led_driver, e, dur=ERROR_WAIT_REBOOT_S)
+        blink_error_leds(e, dur=ERROR_WAIT_REBOOT_S)
 
 
 def cleanup():
@@ -603,6 +993,10 @@ def cleanup():
     led = UserLED()
     led.off()
 
+    patterns.stop()
+    control.stop()
+    connectivity.stop_nm_monitor()
+
     if exc_type is not None:
         logging.warning("Exiting due to exception: %s", exc_type.__name__)
         colour = Colour.YELLOW
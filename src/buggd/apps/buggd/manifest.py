@@ -0,0 +1,218 @@
+"""
+This module keeps a compact per-day manifest of the segments recorded in each data directory.
+
+The data directory is ``proj_<id>/bugg_<serial>/conf_<id>`` under the upload directory.
+For every day there is one CSV file listing each segment's start time, duration,
+channels, size, CRC32C and upload status. An entry is added when the sensor finishes
+writing a segment and marked uploaded when the upload is confirmed. Manifests that
+changed are uploaded at the end of each sync to ``<data dir>/manifests/<date>.csv``.
+The backend can then find missing data by reading one object per device per day,
+instead of listing the bucket.
+
+Manifests live outside the upload directory, so they survive the data files being
+deleted after upload.
+"""
+
+import os
+import csv
+import time
+import logging
+import threading
+
+from .checksums import PART_SUFFIX
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+MANIFEST_DIR = '/home/buggd/manifests/'
+MANIFEST_REMOTE_DIR_NAME = 'manifests'
+
+# Keep local manifests for this many days so late uploads can still be recorded
+MANIFEST_KEEP_DAYS = 14
+
+FIELDS = ['file', 'start', 'duration_s', 'channels', 'bytes', 'crc32c', 'status']
+STATUS_PENDING = 'pending'
+STATUS_UPLOADED = 'uploaded'
+
+
+class ManifestStore:
+    """
+    Holds the manifests for every data directory, keyed by the data directory's path
+    relative to the upload directory and the day of the segment.
+
+    Updates can come from the postprocess and sync threads at the same time, so all
+    access is serialised with a lock. Each update rewrites that day's CSV atomically.
+    A day has at most a few hundred entries, so this is cheap.
+    """
+
+    def __init__(self, manifest_dir=MANIFEST_DIR):
+        self.manifest_dir = manifest_dir
+        self.upload_dir = None
+        self.lock = threading.Lock()
+        self.days = {}      # (prefix, day) -> {file: entry}
+        self.dirty = set()  # (prefix, day) changed since the last upload
+
+    def set_upload_dir(self, upload_dir):
+        """
+        Set the upload directory that data files are located relative to.
+
+        We don't know whether changes made before a restart were uploaded, so every
+        manifest still on disk is uploaded again at the next sync.
+        """
+        self.upload_dir = upload_dir
+
+        with self.lock:
+            for root, _, files in os.walk(self.manifest_dir):
+                for f in files:
+                    if f.endswith('.csv'):
+                        self.dirty.add((os.path.relpath(root, self.manifest_dir), f[:10]))
+
+    def _key(self, path):
+        """ Work out the (prefix, day) a data file belongs to. Returns None for files we don't track """
+        if self.upload_dir is None:
+            return None
+        prefix = os.path.relpath(os.path.dirname(path), self.upload_dir)
+        if prefix.startswith('..'):
+            return None
+        # Segments are named after their start time, e.g. 2024-05-01T10_20_00.000Z.mp3
+        day = os.path.basename(path)[:10]
+        return prefix, day
+
+    def _local_path(self, key):
+        prefix, day = key
+        return os.path.join(self.manifest_dir, prefix, '{}.csv'.format(day))
+
+    def _load(self, key):
+        """ Return the entries for a day, loading them from disk the first time """
+        if key in self.days:
+            return self.days[key]
+
+        entries = {}
+        try:
+            with open(self._local_path(key), 'r', encoding='utf-8', newline='') as f:
+                for row in csv.DictReader(f):
+                    entries[row['file']] = row
+        except FileNotFoundError:
+            pass
+        except (OSError, csv.Error, KeyError) as e:
+            logger.warning('Could not read manifest {}, starting a new one: {}'.format(self._local_path(key), e))
+
+        self.days[key] = entries
+        return entries
+
+    def _save(self, key):
+        path = self._local_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path + PART_SUFFIX, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            for entry in sorted(self.days[key].values(), key=lambda e: e['start']):
+                writer.writerow(entry)
+        os.replace(path + PART_SUFFIX, path)
+
+        self.dirty.add(key)
+
+    def add_segment(self, path, start, duration_s, channels, n_bytes, crc32c):
+        """
+        Record a newly written segment as pending upload
+
+        Args:
+            path: Path of the segment in the data directory
+            start: Start time of the segment, as used in its file name
+            duration_s: Length of the segment in seconds
+            channels: Number of audio channels
+            n_bytes: Size of the file
+            crc32c: Base64 CRC32C of the file
+        """
+
+        key = self._key(path)
+        if key is None:
+            return
+
+        with self.lock:
+            try:
+                entries = self._load(key)
+                entries[os.path.basename(path)] = {
+                    'file': os.path.basename(path),
+                    'start': start,
+                    'duration_s': duration_s,
+                    'channels': channels,
+                    'bytes': n_bytes,
+                    'crc32c': crc32c,
+                    'status': STATUS_PENDING,
+                }
+                self._save(key)
+            except OSError as e:
+                # Not critical - the data itself is unaffected
+                logger.error('Could not update manifest for {}: {}'.format(path, e))
+
+    def mark_uploaded(self, path):
+        """ Mark a segment as uploaded. Files that aren't in a manifest are ignored """
+
+        key = self._key(path)
+        if key is None:
+            return
+
+        with self.lock:
+            try:
+                entries = self._load(key)
+                entry = entries.get(os.path.basename(path))
+                if entry is None or entry['status'] == STATUS_UPLOADED:
+                    return
+                entry['status'] = STATUS_UPLOADED
+                self._save(key)
+            except OSError as e:
+                logger.error('Could not update manifest for {}: {}'.format(path, e))
+
+    def upload_dirty(self, backend):
+        """
+        Upload every manifest that has changed since the last sync, then prune old ones
+
+        Args:
+            backend: The UploadBackend to upload to
+        """
+
+        with self.lock:
+            dirty = sorted(self.dirty)
+
+        for key in dirty:
+            prefix, day = key
+            remote_path = '/'.join([prefix, MANIFEST_REMOTE_DIR_NAME, '{}.csv'.format(day)])
+            logger.info('Uploading manifest {}'.format(remote_path))
+
+            # Snapshot the manifest so the sensor isn't held up while it uploads
+            with self.lock:
+                with open(self._local_path(key), 'rb') as f:
+                    data = f.read()
+                self.dirty.discard(key)
+
+            try:
+                backend.upload_bytes(data, remote_path, content_type='text/csv')
+            except Exception:
+                with self.lock:
+                    self.dirty.add(key)
+                raise
+
+        self.prune()
+
+    def prune(self, keep_days=MANIFEST_KEEP_DAYS):
+        """ Delete local manifests older than keep_days that have already been uploaded """
+
+        cutoff = time.strftime('%Y-%m-%d', time.gmtime(time.time() - keep_days * 86400))
+
+        with self.lock:
+            for key in list(self.days.keys()):
+                if key[1] < cutoff and key not in self.dirty:
+                    del self.days[key]
+
+            for root, _, files in os.walk(self.manifest_dir):
+                for f in files:
+                    if f.endswith('.csv') and f[:10] < cutoff:
+                        prefix = os.path.relpath(root, self.manifest_dir)
+                        if (prefix, f[:10]) not in self.dirty:
+                            os.remove(os.path.join(root, f))
+
+
+# Shared by the sensors, which add segments, and the sync thread, which marks them uploaded
+manifests = ManifestStore()
@@ -0,0 +1,231 @@
+"""
+This module keeps in-process metrics, and sends them to the bucket as a heartbeat.
+
+There are three kinds of metric:
+
+* Counters only go up, e.g. bytes uploaded
+* Gauges hold the latest value, e.g. free disk space
+* Histograms count observations into fixed buckets, e.g. upload throughput
+
+Counters and gauges share one array of doubles, and each histogram keeps its counts in an
+array of integers, so updating a metric is an index into an array. The threads that
+record and upload update them as they go, and the sync loop samples the system gauges
+(backlog, free disk, CPU temperature, signal) at the start of each cycle.
+
+The first thing uploaded each cycle is a heartbeat: a small JSON object with a snapshot
+of every metric and the capture to bucket latency summary, overwritten at
+``heartbeats/<serial>.json``. A slow encoder, a growing
+backlog or a filling SD card therefore shows up in the bucket before any data goes missing.
+"""
+
+import os
+import json
+import time
+import array
+import bisect
+import shutil
+import logging
+import threading
+
+from .utils import discover_serial, get_sys_uptime
+from .tracing import tracer
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+HEARTBEAT_DIR_NAME = 'heartbeats'
+
+CPU_TEMP_PATH = '/sys/class/thermal/thermal_zone0/temp'
+
+# Metric names
+SEGMENTS_RECORDED = 'segments_recorded'
+SEGMENT_GAP_S = 'segment_gap_s'
+ENCODE_REALTIME_FACTOR = 'encode_realtime_factor'
+POSTPROCESS_QUEUE_DEPTH = 'postprocess_queue_depth'
+UPLOAD_MBPS = 'upload_mbps'
+UPLOADED_BYTES = 'uploaded_bytes'
+UPLOAD_FAILURES = 'upload_failures'
+PENDING_BYTES = 'pending_bytes'
+PENDING_FILES = 'pending_files'
+DISK_FREE_BYTES = 'disk_free_bytes'
+CPU_TEMP_C = 'cpu_temp_c'
+RSSI_DBM = 'rssi_dbm'
+CAPTURE_TO_CLOUD_S = 'capture_to_cloud_s'
+REBOOT_GAP_S = 'reboot_gap_s'
+
+# Histogram buckets: the upper bound of each bucket. Anything larger goes in a final overflow bucket.
+SEGMENT_GAP_BUCKETS_S = (0.5, 1, 2, 5, 10, 30, 60, 300, 3600)
+ENCODE_REALTIME_FACTOR_BUCKETS = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2)
+UPLOAD_MBPS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10)
+CAPTURE_TO_CLOUD_BUCKETS_S = (600, 1200, 1800, 2700, 3600, 7200, 21600, 86400)
+
+
+class Histogram:
+    """
+    Counts of observations in fixed buckets, with their sum
+
+    Args:
+        bounds: Increasing upper bounds of the buckets
+    """
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = array.array('Q', [0] * (len(self.bounds) + 1))
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def snapshot(self):
+        return {'bounds': list(self.bounds), 'counts': list(self.counts), 'sum': round(self.sum, 3)}
+
+
+class MetricsRegistry:
+    """
+    Holds every metric by name. Metrics are created when first used.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = array.array('d')
+        self.counters = {}      # name -> index into values
+        self.gauges = {}        # name -> index into values
+        self.histograms = {}    # name -> Histogram
+
+    def _slot(self, kind, name):
+        index = kind.get(name)
+        if index is None:
+            index = kind[name] = len(self.values)
+            self.values.append(float('nan') if kind is self.gauges else 0.0)
+        return index
+
+    def inc(self, name, n=1):
+        """ Add n to a counter """
+        with self.lock:
+            self.values[self._slot(self.counters, name)] += n
+
+    def set(self, name, value):
+        """ Set a gauge. None leaves it unset. """
+        with self.lock:
+            self.values[self._slot(self.gauges, name)] = float('nan') if value is None else value
+
+    def add(self, name, n):
+        """ Move a gauge up or down by n """
+        with self.lock:
+            index = self._slot(self.gauges, name)
+            current = self.values[index]
+            self.values[index] = n if current != current else current + n
+
+    def observe(self, name, value, bounds):
+        """ Add an observation to a histogram, creating it with the given bucket bounds """
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(bounds)
+            histogram.observe(value)
+
+    def get(self, name):
+        """ The value of a counter or gauge, or None if it isn't set """
+        with self.lock:
+            index = self.counters.get(name, self.gauges.get(name))
+            if index is None or self.values[index] != self.values[index]:
+                return None
+            return self.values[index]
+
+    def snapshot(self):
+        """ Every metric, as a dict that can be serialised to JSON """
+
+        def value(index):
+            v = self.values[index]
+            if v != v:
+                return None
+            return int(v) if v.is_integer() else round(v, 3)
+
+        with self.lock:
+            return {'counters': {name: value(i) for name, i in self.counters.items()},
+                    'gauges': {name: value(i) for name, i in self.gauges.items()},
+                    'histograms': {name: h.snapshot() for name, h in self.histograms.items()}}
+
+
+def read_cpu_temp():
+    """ The SoC temperature in degrees C, or None if it can't be read """
+    try:
+        with open(CPU_TEMP_PATH, 'r') as f:
+            return int(f.read().strip()) / 1000
+    except (OSError, ValueError):
+        return None
+
+
+def sample_system(registry, upload_dir, rssi_dbm=None):
+    """
+    Update the gauges that describe the state of the device
+
+    Args:
+        registry: The MetricsRegistry to update
+        upload_dir: The upload directory, whose contents are the backlog
+        rssi_dbm: The latest signal strength, if known
+    """
+
+    pending_bytes = 0
+    pending_files = 0
+    for root, _, files in os.walk(upload_dir):
+        for f in files:
+            try:
+                pending_bytes += os.path.getsize(os.path.join(root, f))
+                pending_files += 1
+            except OSError:
+                # Uploaded or moved while we were looking
+                pass
+    registry.set(PENDING_BYTES, pending_bytes)
+    registry.set(PENDING_FILES, pending_files)
+
+    try:
+        registry.set(DISK_FREE_BYTES, shutil.disk_usage(upload_dir).free)
+    except OSError:
+        registry.set(DISK_FREE_BYTES, None)
+
+    registry.set(CPU_TEMP_C, read_cpu_temp())
+    registry.set(RSSI_DBM, rssi_dbm)
+
+
+def heartbeat(registry):
+    """ The registry, with the device, time and capture to bucket latency, as a dict """
+
+    try:
+        uptime_s = round(get_sys_uptime())
+    except OSError:
+        uptime_s = None
+
+    beat = {'serial': discover_serial(), 'utc': round(time.time()), 'uptime_s': uptime_s}
+    beat.update(registry.snapshot())
+    beat['latency'] = tracer.summary()
+    return beat
+
+
+def make_heartbeat(registry):
+    """ Serialise the heartbeat into compact JSON """
+    return json.dumps(heartbeat(registry), separators=(',', ':')).encode('utf-8')
+
+
+def send_heartbeat(backend, registry):
+    """
+    Upload a heartbeat. Failing to send it doesn't stop the rest of the sync.
+
+    Returns:
+        True if it was uploaded
+    """
+
+    remote_path = '{}/{}.json'.format(HEARTBEAT_DIR_NAME, discover_serial())
+    try:
+        backend.upload_bytes(make_heartbeat(registry), remote_path, content_type='application/json')
+    except Exception as e:
+        logger.warning('Could not send heartbeat: {}'.format(e))
+        return False
+
+    logger.info('Sent heartbeat to {}'.format(remote_path))
+    return True
+
+
+# Shared by the recording and sync threads
+metrics = MetricsRegistry()
@@ -0,0 +1,257 @@
+"""
+This module profiles the daemon in the field, when asked to.
+
+Profiling is off unless ``"profiling": true`` is set in the device section of the config
+file, or the daemon is sent SIGUSR1, which turns it on (and a second SIGUSR1 off again):
+
+    sudo pkill -USR1 -f buggd
+
+While it is on, each call to record_sensor, each postprocess and each sync cycle runs
+under cProfile, and the statistics are added up per section. tracemalloc traces
+allocations too, and a snapshot of where memory is held, and how that has changed since
+the last snapshot, is written every SNAPSHOT_INTERVAL_S.
+
+At the start of each sync (and when profiling is turned off) the statistics so far are
+written to ``profiles/`` in the upload directory, so they go up with that sync:
+
+    profiles/profile_<serial>_<ts>_<section>.prof     pstats, e.g. for snakeviz or pstats.Stats
+    profiles/memory_<serial>_<ts>.txt                 the top allocation sites, and their growth
+
+As elsewhere, files have a ``.part`` suffix until they are complete. The directory is kept
+under PROFILE_MAX_BYTES by deleting the oldest files, so a device that is offline for a
+long time doesn't fill its SD card with profiles.
+"""
+
+import os
+import json
+import time
+import pstats
+import cProfile
+import logging
+import threading
+import contextlib
+import tracemalloc
+
+from .utils import discover_serial
+from .checksums import PART_SUFFIX
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+PROFILE_DIR_NAME = 'profiles'
+
+# Profiles waiting to be uploaded are kept under this, oldest deleted first
+PROFILE_MAX_BYTES = 16 * 1024 * 1024
+
+# How often to write a tracemalloc snapshot while profiling
+SNAPSHOT_INTERVAL_S = 900
+
+# Frames kept for each allocation. More frames cost more memory and time per allocation.
+TRACEMALLOC_FRAMES = 5
+
+# Allocation sites written in each snapshot
+SNAPSHOT_TOP_N = 40
+
+# Sections of the daemon that are profiled
+RECORD = 'record_sensor'
+POSTPROCESS = 'postprocess'
+SYNC = 'sync'
+
+
+def profiling_enabled(config_path):
+    """ Check if the config file turns profiling on """
+    try:
+        with open(config_path) as f:
+            return bool(json.load(f)['device'].get('profiling', False))
+    except (OSError, ValueError, KeyError) as e:
+        logger.debug('No profiling setting in {}: {}'.format(config_path, e))
+        return False
+
+
+class Profiler:
+    """
+    Profiles sections of the daemon while it is enabled, and writes the results into the upload directory
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.profile_dir = None
+        self.lock = threading.Lock()
+        self.stats = {}                 # section -> pstats.Stats, added up since the last write
+        self.calls = {}                 # section -> calls profiled since the last write
+        self.last_snapshot = None
+        self.last_snapshot_t = None
+
+    def set_upload_dir(self, upload_dir):
+        """ Write profiles into the upload directory """
+        self.profile_dir = os.path.join(upload_dir, PROFILE_DIR_NAME)
+
+    def start(self):
+        """ Start profiling """
+        with self.lock:
+            if self.enabled:
+                return
+            self.enabled = True
+            self.last_snapshot = None
+            self.last_snapshot_t = time.time()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        logger.info('Profiling started')
+
+    def stop(self):
+        """ Stop profiling, writing out what has been collected """
+        with self.lock:
+            if not self.enabled:
+                return
+            self.enabled = False
+        self.write_snapshot()
+        self.write()
+        tracemalloc.stop()
+        self.last_snapshot = None
+        logger.info('Profiling stopped')
+
+    def toggle(self, signum=None, frame=None):
+        """ Turn profiling on or off. Can be installed as a signal handler. """
+        if self.enabled:
+            self.stop()
+        else:
+            self.start()
+
+    @contextlib.contextmanager
+    def section(self, name):
+        """
+        Profile the body of a with statement, if profiling is on
+
+        Args:
+            name: The section of the daemon, e.g. RECORD
+        """
+        if not self.enabled:
+            yield
+            return
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            # Another profiler is running in this thread
+            logger.debug('Could not profile {}: {}'.format(name, e))
+            yield
+            return
+
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.add(name, profile)
+            if time.time() - self.last_snapshot_t >= SNAPSHOT_INTERVAL_S:
+                self.write_snapshot()
+
+    def add(self, name, profile):
+        """ Add a section's profile to its statistics so far """
+        with self.lock:
+            if name in self.stats:
+                self.stats[name].add(profile)
+            else:
+                self.stats[name] = pstats.Stats(profile)
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _path(self, prefix, suffix):
+        return os.path.join(self.profile_dir, '{}_{}_{}{}'.format(
+            prefix, discover_serial(), time.strftime('%Y%m%dT%H%M%SZ', time.gmtime()), suffix))
+
+    def _replace(self, path):
+        """ Rename a complete file from its .part name, and keep the directory to size """
+        os.replace(path + PART_SUFFIX, path)
+        self.prune()
+
+    def write(self):
+        """ Write the statistics collected so far, one file per section, and start again """
+        with self.lock:
+            stats, calls = self.stats, self.calls
+            self.stats, self.calls = {}, {}
+
+        if not stats or self.profile_dir is None:
+            return
+
+        for name, section_stats in stats.items():
+            try:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                path = self._path('profile', '_{}.prof'.format(name))
+                section_stats.dump_stats(path + PART_SUFFIX)
+                self._replace(path)
+                logger.info('Wrote profile of {} calls of {} to {}'.format(calls[name], name, path))
+            except OSError as e:
+                logger.error('Could not write profile of {}: {}'.format(name, e))
+
+    def write_snapshot(self):
+        """ Write where memory is allocated, and what has grown since the last snapshot """
+        with self.lock:
+            self.last_snapshot_t = time.time()
+        if not tracemalloc.is_tracing() or self.profile_dir is None:
+            return
+
+        # Leave out what the profiling itself holds, and imports
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, f) for f in (tracemalloc.__file__, cProfile.__file__, pstats.__file__,
+                                                    '<frozen importlib._bootstrap*>', '<unknown>')])
+        current, peak = tracemalloc.get_traced_memory()
+
+        lines = ['Traced memory: {:.1f} MB, peak {:.1f} MB'.format(current / 1e6, peak / 1e6), '',
+                 'Top {} allocation sites:'.format(SNAPSHOT_TOP_N)]
+        lines += [str(stat) for stat in snapshot.statistics('lineno')[:SNAPSHOT_TOP_N]]
+        if self.last_snapshot is not None:
+            lines += ['', 'Top {} changes since the last snapshot:'.format(SNAPSHOT_TOP_N)]
+            lines += [str(stat) for stat in snapshot.compare_to(self.last_snapshot, 'lineno')[:SNAPSHOT_TOP_N]]
+        self.last_snapshot = snapshot
+
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            path = self._path('memory', '.txt')
+            with open(path + PART_SUFFIX, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+            self._replace(path)
+            logger.info('Wrote memory snapshot to {} ({:.1f} MB traced)'.format(path, current / 1e6))
+        except OSError as e:
+            logger.error('Could not write memory snapshot: {}'.format(e))
+
+    def prune(self, max_bytes=PROFILE_MAX_BYTES):
+        """
+        Delete the oldest profiles until those waiting to be uploaded fit in max_bytes.
+        The sync may have listed them already. It skips a file that has gone.
+
+        Returns:
+            The number of files deleted
+        """
+        files = []
+        try:
+            names = os.listdir(self.profile_dir)
+        except OSError:
+            return 0
+        for name in names:
+            if name.endswith(PART_SUFFIX):
+                continue
+            try:
+                st = os.stat(os.path.join(self.profile_dir, name))
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, os.path.join(self.profile_dir, name)))
+
+        total = sum(size for _, size, _ in files)
+        n_deleted = 0
+        for _, size, path in sorted(files):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                n_deleted += 1
+            except OSError as e:
+                logger.error('Could not delete profile {}: {}'.format(path, e))
+
+        if n_deleted:
+            logger.warning('Deleted {} old profiles to stay under {} MB'.format(n_deleted, max_bytes / 1e6))
+        return n_deleted
+
+
+# Shared by the recording, postprocess and sync threads
+profiler = Profiler()
@@ -0,0 +1,702 @@
+"""
+This module runs the daemon against simulated hardware on a virtual clock (buggd --simulate).
+
+record(), its supervisor and workers, and gcs_server_sync() run unchanged. Underneath them:
+
+* The HAL's sim backend stands in for the GPIO, I2C and USB, and a simulated RC7620 answers
+  the AT commands. The modem enumerates a few seconds after being powered on.
+* SimMic stands in for the microphone, taking the recording options from the config.
+* A LocalBackend over a modelled link (latency, bandwidth, failures) stands in for the bucket.
+* The internet is up once the modem has been enumerated for CONNECT_S.
+* Mounting the SD card, nmcli, SNTP and reboots are not run.
+
+Time is virtual. The daemon's modules see a clock whose sleeps only return once every one
+of the daemon's threads is asleep, at which point it jumps to the next wake-up. Work takes
+no virtual time, so a day of recording and syncing runs in minutes. The daily reboot drains
+the pipeline first, as it does on a device. It (and the reboot after an error) then stops
+every thread mid-flight, as a real reboot would, and the daemon starts again BOOT_S later.
+
+At the end it reports the segments recorded and the gaps between them, what was uploaded,
+how the backlog grew and how long the modem was on, so a config (e.g. record_length) or a
+change to the sync can be checked before it goes out to the fleet.
+"""
+
+import os
+import sys
+import json
+import time
+import types
+import shutil
+import logging
+import datetime
+import tempfile
+import threading
+
+from buggd import hal
+from buggd.drivers import i2cbus
+from buggd.drivers import modem as modem_driver
+from buggd.drivers.modem import Modem
+from buggd.drivers.rc7620sim import RC7620Simulator
+from buggd.sensors import simmic
+from . import main as daemon
+from . import utils
+from .backends import LocalBackend, BACKEND_LOCAL
+from .connectivity import connectivity
+from .manifest import manifests
+from .telemetry import telemetry
+from .journal import journal
+from . import metrics as metrics_module
+from .metrics import metrics
+from .tracing import tracer
+from .timesync import timesync
+from . import control as control_module
+from .control import control
+from .supervisor import supervisor
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+SIM_HOURS = 24
+
+# How long after a reboot the daemon is running again
+BOOT_S = 60
+
+# How long the modem takes to register and bring up a connection once enumerated
+CONNECT_S = 15
+
+# Default link model, roughly a poor 3G/4G connection
+LINK_LATENCY_S = 0.6
+LINK_BANDWIDTH_KBYTES_PER_S = 500
+
+BACKLOG_SAMPLE_S = 600
+
+# Gaps between segments up to this long are the trim at the start of each recording
+GAP_TOLERANCE_S = 1.5
+
+# These talk to real processes (the simulated modem, the LED thread), so keep real time
+REAL_TIME_MODULES = ('buggd.drivers.atsession', 'buggd.drivers.rc7620sim', 'buggd.drivers.ledpatterns',
+                     'buggd.apps.buggd.simulate')
+
+# A sleeping thread rechecks the clock this often, in real seconds, in case a thread it
+# was waiting for ended without saying so
+POLL_S = 0.05
+
+# How long to wait, in real seconds, for the daemon's threads to stop at a reboot
+HALT_TIMEOUT_S = 30
+
+HALT_REBOOT = 'reboot'
+HALT_END = 'end'
+
+
+class SimHalt(SystemExit):
+    """
+    Raised in the daemon's threads when the simulated device reboots or the simulation ends.
+    A SystemExit, so it isn't caught by the daemon's exception handlers, and threads end quietly.
+    """
+
+
+class VirtualClock:
+    """
+    A clock shared by the daemon's threads, which only moves when they are all asleep
+
+    Threads take part once they sleep on the clock, or when they are started by a thread
+    that does (unless they are daemon threads).
+
+    Args:
+        start_t: Virtual time to start at, in seconds since the epoch
+        end_t: Virtual time to stop at
+    """
+
+    def __init__(self, start_t, end_t):
+        self.start_t = start_t
+        self.end_t = end_t
+        self.now = start_t
+        self.cond = threading.Condition()
+        self.threads = set()
+        self.exempt = set()     # Threads that carry on through a halt
+        self.sleeping = {}      # thread -> virtual time to wake at
+        self.events = {}        # thread -> ClockEvent it is waiting on
+        self.halted = None
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now - self.start_t
+
+    def register(self, thread, exempt=False):
+        with self.cond:
+            self.threads.add(thread)
+            if exempt:
+                self.exempt.add(thread)
+
+    def unregister(self, thread):
+        with self.cond:
+            self.threads.discard(thread)
+            self._advance()
+
+    def _check_halt(self, thread):
+        if self.halted is not None and thread not in self.exempt:
+            raise SimHalt(self.halted)
+
+    def _advance(self):
+        """ If every thread is asleep, move to the earliest wake-up. Call with the lock held. """
+        self.threads = set(t for t in self.threads if t is threading.current_thread() or t.is_alive())
+        # A thread whose event has been set is awake, even if it hasn't run yet
+        if not self.sleeping or any(t not in self.sleeping or (t in self.events and self.events[t].flag)
+                                    for t in self.threads):
+            return
+
+        wake = min(self.sleeping.values())
+        if wake > self.now:
+            if wake >= self.end_t:
+                self.now = max(self.now, self.end_t)
+                self.halted = self.halted or HALT_END
+            else:
+                self.now = wake
+        self.cond.notify_all()
+
+    def sleep(self, secs):
+        if secs <= 0:
+            with self.cond:
+                self._check_halt(threading.current_thread())
+            return
+        self.wait(None, secs)
+
+    def wait(self, event, timeout):
+        """
+        Sleep until timeout virtual seconds have passed or the event is set
+
+        Returns:
+            True if the event was set
+        """
+        me = threading.current_thread()
+        with self.cond:
+            self._check_halt(me)
+            self.threads.add(me)
+            self.sleeping[me] = float('inf') if timeout is None else self.now + timeout
+            if event is not None:
+                self.events[me] = event
+            try:
+                while True:
+                    if event is not None and event.flag:
+                        return True
+                    if self.now >= self.sleeping[me]:
+                        return False
+                    self._check_halt(me)
+                    self._advance()
+                    if self.now < self.sleeping[me] and not (event is not None and event.flag):
+                        self.cond.wait(POLL_S)
+            finally:
+                del self.sleeping[me]
+                self.events.pop(me, None)
+
+    def halt(self, reason):
+        """ Stop the daemon's threads, at their next sleep """
+        with self.cond:
+            if self.halted is None:
+                self.halted = reason
+            self.cond.notify_all()
+
+    def wait_for_others(self, timeout):
+        """ Wait (in real time) for every other thread but the exempt ones to end """
+        me = threading.current_thread()
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                others = [t for t in self.threads if t is not me and t not in self.exempt and t.is_alive()]
+                if not others:
+                    return True
+                if time.monotonic() > deadline:
+                    logger.warning('Threads still running after halt: {}'.format(', '.join(t.name for t in others)))
+                    return False
+                self.cond.wait(POLL_S)
+
+    def resume(self):
+        with self.cond:
+            self.halted = None
+
+    def close(self):
+        """ Stop every thread, including the exempt ones """
+        with self.cond:
+            self.halted = 'closed'
+            self.exempt.clear()
+            self.cond.notify_all()
+
+
+class ClockEvent:
+    """ A threading.Event whose waits are on the virtual clock """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.flag = False
+
+    def is_set(self):
+        return self.flag
+
+    def set(self):
+        with self.clock.cond:
+            self.flag = True
+            self.clock.cond.notify_all()
+
+    def clear(self):
+        self.flag = False
+
+    def wait(self, timeout=None):
+        return self.clock.wait(self, timeout)
+
+
+def make_time_module(clock):
+    """ A stand-in for the time module, on the virtual clock """
+    shim = types.ModuleType('time')
+    shim.__dict__.update(time.__dict__)
+    shim.time = clock.time
+    shim.time_ns = lambda: int(clock.time() * 1e9)
+    shim.monotonic = clock.monotonic
+    shim.monotonic_ns = lambda: int(clock.monotonic() * 1e9)
+    shim.sleep = clock.sleep
+    shim.gmtime = lambda secs=None: time.gmtime(clock.time() if secs is None else secs)
+    shim.localtime = lambda secs=None: time.localtime(clock.time() if secs is None else secs)
+    shim.strftime = lambda fmt, t=None: time.strftime(fmt, time.localtime(clock.time()) if t is None else t)
+    return shim
+
+
+def make_datetime_class(clock):
+    """ A stand-in for datetime.datetime, on the virtual clock """
+
+    class VirtualDatetime(datetime.datetime):
+        @classmethod
+        def utcnow(cls):
+            return cls.utcfromtimestamp(clock.time())
+
+        @classmethod
+        def now(cls, tz=None):
+            return cls.fromtimestamp(clock.time(), tz)
+
+    return VirtualDatetime
+
+
+class Patches:
+    """ Replaces attributes for the length of the simulation, and puts them back afterwards """
+
+    def __init__(self):
+        self.saved = []
+
+    def set(self, obj, name, value):
+        self.saved.append((obj, name, obj.__dict__.get(name, None), name in obj.__dict__))
+        setattr(obj, name, value)
+
+    def restore(self):
+        for obj, name, value, existed in reversed(self.saved):
+            if existed:
+                setattr(obj, name, value)
+            else:
+                delattr(obj, name)
+        self.saved = []
+
+
+class LogCounter(logging.Handler):
+    """ Counts the warnings and errors logged during the simulation """
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.counts = {}
+
+    def emit(self, record):
+        self.counts[record.levelname] = self.counts.get(record.levelname, 0) + 1
+
+
+def segment_start(name):
+    """ The start time of a segment from its file name, e.g. 2024-06-01T12_00_01.000Z.mp3 """
+    try:
+        return datetime.datetime.strptime(name[:23], '%Y-%m-%dT%H_%M_%S.%f').replace(tzinfo=datetime.timezone.utc).timestamp()
+    except ValueError:
+        return None
+
+
+def find_segments(*dirs):
+    """ Start times of the audio segments under some directories, and their total size """
+    starts = set()
+    n_bytes = 0
+    for top in dirs:
+        for root, _, files in os.walk(top):
+            for f in files:
+                if f.endswith(('.mp3', '.wav')):
+                    start = segment_start(f)
+                    if start is not None:
+                        starts.add(start)
+                        n_bytes += os.path.getsize(os.path.join(root, f))
+    return sorted(starts), n_bytes
+
+
+class Simulation:
+    """
+    One simulated run of the daemon
+
+    Args:
+        hours: How much time to simulate
+        sim_dir: Directory for the simulated device's files, which is emptied first
+        config_path: Config file to run, or None for SimMic's defaults. Its sensor
+                     options are used with SimMic, and its upload backend is replaced.
+        latency_s, bandwidth_kbytes_per_s, failure_rate, seed: The link model
+    """
+
+    def __init__(self, hours=SIM_HOURS, sim_dir=None, config_path=None, latency_s=LINK_LATENCY_S,
+                 bandwidth_kbytes_per_s=LINK_BANDWIDTH_KBYTES_PER_S, failure_rate=0, seed=1):
+        self.hours = hours
+        self.sim_dir = sim_dir
+        self.config_path = config_path
+
+        # Start on the hour, so the daily reboot time is reached in a day
+        start_t = time.time() // 3600 * 3600
+        self.clock = VirtualClock(start_t, start_t + hours * 3600)
+        self.link = LocalBackend(None, latency_s=latency_s, bandwidth_bytes_per_s=bandwidth_kbytes_per_s * 1000,
+                                 failure_rate=failure_rate, seed=seed, sleep=self.clock.sleep)
+        self.patches = Patches()
+        self.log_counter = LogCounter()
+
+        self.backend = None
+        self.at_sim = None
+        self.modem = None
+        self.boot_t = start_t
+        self.reboots = 0
+        self.rail_on_t = None
+        self.modem_on_s = 0
+        self.modem_cycles = 0
+        self.backlog = []
+
+    def _setup_dirs(self):
+        if self.sim_dir is None:
+            self.sim_dir = tempfile.mkdtemp(prefix='buggd-sim-')
+        elif os.path.exists(self.sim_dir):
+            shutil.rmtree(self.sim_dir)
+
+        self.sd_dir = os.path.join(self.sim_dir, 'sd')
+        self.remote_dir = os.path.join(self.sim_dir, 'bucket')
+        self.home_dir = os.path.join(self.sim_dir, 'home')
+        for d in (self.sd_dir, self.remote_dir, self.home_dir, os.path.join(self.sim_dir, 'logs')):
+            os.makedirs(d, exist_ok=True)
+        self.link.root_dir = self.remote_dir
+
+        config = {}
+        if self.config_path is not None:
+            with open(self.config_path, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+        config.setdefault('sensor', {})['sensor_type'] = 'SimMic'
+        device = config.setdefault('device', {})
+        device.setdefault('project_id', 'sim')
+        device.setdefault('config_id', 'sim')
+        device['upload_backend'] = BACKEND_LOCAL
+        device['local_upload_dir'] = self.remote_dir
+        self.config = config
+
+        # The daemon picks the config up from the SD card, as on a device
+        with open(os.path.join(self.sd_dir, daemon.CONFIG_FNAME), 'w', encoding='utf-8') as f:
+            json.dump(config, f, indent=2)
+
+    def _install(self):
+        """ Point the daemon at the simulated device """
+        p = self.patches
+        clock = self.clock
+
+        # Time
+        time_shim = make_time_module(clock)
+        datetime_cls = make_datetime_class(clock)
+        datetime_shim = types.ModuleType('datetime')
+        datetime_shim.__dict__.update(datetime.__dict__)
+        datetime_shim.datetime = datetime_cls
+
+        modules = [m for name, m in list(sys.modules.items())
+                   if m is not None and (name.startswith('buggd.') or name == 'logging') and name not in REAL_TIME_MODULES]
+        for module in modules:
+            for name, value in list(vars(module).items()):
+                if value is time:
+                    p.set(module, name, time_shim)
+                elif value is datetime:
+                    p.set(module, name, datetime_shim)
+                elif value is datetime.datetime:
+                    p.set(module, name, datetime_cls)
+
+        # New (non-daemon) threads take part in the clock from the start
+        real_start = threading.Thread.start
+
+        def start(thread):
+            if thread.daemon:
+                real_start(thread)
+                return
+
+            run = thread.run
+
+            def run_and_unregister():
+                try:
+                    run()
+                finally:
+                    clock.unregister(thread)
+
+            thread.run = run_and_unregister
+            real_start(thread)
+            # The starting thread is busy, so the clock can't move before this
+            clock.register(thread)
+
+        p.set(threading.Thread, 'start', start)
+
+        # Threads stopped by a halt end quietly, as they would with a plain SystemExit
+        real_excepthook = threading.excepthook
+
+        def excepthook(args):
+            if not issubclass(args.exc_type, SimHalt):
+                real_excepthook(args)
+
+        p.set(threading, 'excepthook', excepthook)
+
+        # Hardware
+        self.backend = hal.select(hal.SIM, clock=clock.monotonic)
+        i2cbus.buses.clear()
+        self.backend.gpio.watch(modem_driver.P3V7_EN, self._on_rail)
+
+        self.at_sim = RC7620Simulator(seed=1, on_powerdown=self.backend.modem.power_down)
+        self.at_sim.start()
+        self.at_sim.powered_down = True
+        self.backend.modem.at_sim = self.at_sim
+
+        # The SD card, config and anything run on the command line
+        p.set(daemon, 'SD_MNT_LOC', self.sd_dir)
+        p.set(daemon, 'WORKING_DIR_ROOT', self.sim_dir)
+        p.set(daemon, 'mount_ext_sd', lambda sd_mount_loc: None)
+        p.set(utils, 'add_network_profile', lambda *args: None)
+        for module in (daemon, utils, simmic):
+            p.set(module, 'call_cmd_line', self._call_cmd_line)
+        p.set(utils, 'get_sys_uptime', lambda: clock.time() - self.boot_t)
+        p.set(metrics_module, 'get_sys_uptime', lambda: clock.time() - self.boot_t)
+
+        # Network
+        p.set(daemon, 'make_backend', lambda config_path: self.link)
+        p.set(connectivity, 'probe', self._probe)
+        p.set(connectivity, 'start_nm_monitor', lambda: None)
+        p.set(timesync, 'sync', lambda: None)
+        p.set(timesync, 'sync_async', lambda: None)
+        p.set(timesync, 'join', lambda timeout=None: None)
+
+        # The control socket, so buggd --status can be pointed at the simulated daemon
+        p.set(control_module, 'CONTROL_SOCKET', os.path.join(self.sim_dir, 'buggd.sock'))
+
+        # Logs go to the simulation directory, and only problems to stdout
+        p.set(daemon.log, 'log_dir', os.path.join(self.sim_dir, 'logs'))
+        daemon.log.rotate_log()
+        daemon.log.stdout_handler.setLevel(logging.WARNING)
+        logging.getLogger().setLevel(logging.INFO)
+        logging.getLogger().addHandler(self.log_counter)
+
+    def _uninstall(self):
+        logging.getLogger().removeHandler(self.log_counter)
+        daemon.log.stdout_handler.setLevel(logging.DEBUG)
+        self.patches.restore()
+        self.at_sim.stop()
+
+    def _call_cmd_line(self, args, *_, **__):
+        if 'reboot' in args:
+            logger.info('Simulated reboot at {}'.format(datetime.datetime.utcfromtimestamp(self.clock.time())))
+            self.clock.halt(HALT_REBOOT)
+        else:
+            logger.debug('Not running {}'.format(args))
+        return ''
+
+    def _probe(self, timeout=None):
+        modem = self.backend.modem
+        modem.update()
+        connected = modem.enumerated_at is not None and self.clock.monotonic() - modem.enumerated_at >= CONNECT_S
+        connectivity._update(connected)
+        return connected
+
+    def _on_rail(self, pin, level):
+        if level and self.rail_on_t is None:
+            self.rail_on_t = self.clock.time()
+            self.modem_cycles += 1
+        elif not level and self.rail_on_t is not None:
+            self.modem_on_s += self.clock.time() - self.rail_on_t
+            self.rail_on_t = None
+
+    def _sample_backlog(self):
+        """ Sample what is waiting to be uploaded, on its own thread """
+        self.clock.register(threading.current_thread(), exempt=True)
+        upload_dir = os.path.join(self.sd_dir, 'audio')
+        try:
+            while True:
+                starts, n_bytes = find_segments(upload_dir)
+                self.backlog.append(((self.clock.time() - self.clock.start_t) / 3600, len(starts), n_bytes))
+                self.clock.sleep(BACKLOG_SAMPLE_S)
+        except SimHalt:
+            pass
+
+    def _boot(self):
+        """ Reset the daemon's state as a fresh start of the process would """
+        daemon.GLOB_no_sd_mode = False
+        daemon.GLOB_is_connected = False
+        daemon.GLOB_offline_mode = False
+        daemon.GLOB_last_capture_end_t = None
+        daemon.GLOB_sync_in_progress = False
+        daemon.GLOB_postprocess_in_progress = False
+        daemon.GLOB_reboot_attempted = False
+        daemon.maintenance.clear()
+
+        connectivity.__init__()
+        self.patches.set(connectivity, 'nm_changed', ClockEvent(self.clock))
+        telemetry.__init__()
+        self.patches.set(telemetry, 'stop_event', ClockEvent(self.clock))
+        self.patches.set(daemon, 'sync_requested', ClockEvent(self.clock))
+        self.patches.set(daemon, 'postprocess_ready', ClockEvent(self.clock))
+        # Segments waiting to be encoded are lost, as they are in /tmp
+        daemon.postprocess_queue.clear()
+        supervisor.__init__()
+        manifests.__init__(os.path.join(self.home_dir, 'manifests'))
+        journal.__init__()
+        metrics.__init__()
+        # Traces of segments in flight are lost, but those already finished count for the report
+        tracer.traces.clear()
+
+        self.boot_t = self.clock.time()
+        self.modem = Modem(lock_file_path=os.path.join(self.sim_dir, 'modem.lock'), control_interface=self.at_sim.port)
+
+    def _shutdown(self):
+        """ Everything the daemon had open goes, and the GPIO go back to inputs """
+        control.stop()
+        self.modem.at.close()
+        self.modem.lock.release_lock()
+        self.modem = None
+        self.backend.gpio.cleanup()
+
+    def run(self):
+        """ Run the simulation and return the report """
+        self._setup_dirs()
+        cwd = os.getcwd()
+        os.chdir(self.home_dir)
+        self._install()
+        tracer.__init__()
+        wall_start = time.monotonic()
+
+        self.clock.register(threading.current_thread())
+        threading.Thread(target=self._sample_backlog, name='backlog', daemon=True).start()
+
+        try:
+            while True:
+                self._boot()
+                try:
+                    daemon.record(self.modem)
+                except SimHalt:
+                    pass
+                self.clock.wait_for_others(HALT_TIMEOUT_S)
+                reason = self.clock.halted
+                self._shutdown()
+                self.clock.resume()
+
+                if reason != HALT_REBOOT:
+                    break
+                self.reboots += 1
+                self.clock.sleep(BOOT_S)
+        except SimHalt:
+            # The simulation ended while rebooting
+            pass
+        finally:
+            if self.rail_on_t is not None:
+                self.modem_on_s += self.clock.time() - self.rail_on_t
+                self.rail_on_t = None
+            self.clock.close()
+            self._uninstall()
+            os.chdir(cwd)
+
+        return self.report(time.monotonic() - wall_start)
+
+    def report(self, wall_s):
+        """ Summarise the run """
+        duration_s = self.clock.time() - self.clock.start_t
+        record_length = simmic.SimMic(self.config['sensor']).record_length
+
+        starts, recorded_bytes = find_segments(self.remote_dir, os.path.join(self.sd_dir, 'audio'))
+        gaps = [(b - (a + record_length)) for a, b in zip(starts, starts[1:])]
+        long_gaps = [g for g in gaps if g > GAP_TOLERANCE_S]
+
+        uploaded, uploaded_bytes = find_segments(self.remote_dir)
+        pending = self.backlog[-1] if self.backlog else (0, 0, 0)
+        days = duration_s / 86400
+
+        return {
+            'sim_dir': self.sim_dir,
+            'simulated_hours': duration_s / 3600,
+            'wall_s': wall_s,
+            'speedup': duration_s / wall_s if wall_s else None,
+            'reboots': self.reboots,
+            'warnings': self.log_counter.counts.get('WARNING', 0),
+            'errors': self.log_counter.counts.get('ERROR', 0) + self.log_counter.counts.get('CRITICAL', 0),
+            'segments': len(starts),
+            'recorded_hours': len(starts) * record_length / 3600,
+            'coverage': len(starts) * record_length / duration_s if duration_s else None,
+            'gaps': len(long_gaps),
+            'gap_total_s': sum(long_gaps),
+            'gap_max_s': max(long_gaps, default=0),
+            'segments_uploaded': len(uploaded),
+            'bytes_uploaded': self.link.bytes_uploaded,
+            'upload_requests': self.link.requests,
+            'upload_failures': self.link.failures,
+            'uploaded_mb_per_day': self.link.bytes_uploaded / 1e6 / days if days else None,
+            'uploaded_mb_per_modem_hour': self.link.bytes_uploaded / 1e6 / (self.modem_on_s / 3600) if self.modem_on_s else None,
+            'backlog_segments': pending[1],
+            'backlog_mb': pending[2] / 1e6,
+            'backlog_max_segments': max((b[1] for b in self.backlog), default=0),
+            'backlog_growth_mb_per_day': (pending[2] - self.backlog[0][2]) / 1e6 / days if self.backlog and days else None,
+            'backlog_samples': self.backlog,
+            'modem_cycles': self.modem_cycles,
+            'modem_on_s': self.modem_on_s,
+            'modem_on_fraction': self.modem_on_s / duration_s if duration_s else None,
+            'latency': tracer.summary(),
+        }
+
+
+def format_report(report):
+    """ The report as lines of text """
+
+    def fmt(value, spec):
+        return 'n/a' if value is None else format(value, spec)
+
+    return '\n'.join([
+        'Simulated {:.1f}h in {:.1f}s ({}x), {} reboots, {} warnings, {} errors'.format(
+            report['simulated_hours'], report['wall_s'], fmt(report['speedup'], '.0f'),
+            report['reboots'], report['warnings'], report['errors']),
+        'Recording: {} segments, {:.2f}h of audio ({} coverage), {} gaps totalling {:.0f}s (longest {:.0f}s)'.format(
+            report['segments'], report['recorded_hours'], fmt(report['coverage'], '.1%'),
+            report['gaps'], report['gap_total_s'], report['gap_max_s']),
+        'Upload: {} segments, {:.1f} MB in {} requests ({} failed), {} MB/day, {} MB per modem-hour'.format(
+            report['segments_uploaded'], report['bytes_uploaded'] / 1e6, report['upload_requests'],
+            report['upload_failures'], fmt(report['uploaded_mb_per_day'], '.1f'),
+            fmt(report['uploaded_mb_per_modem_hour'], '.1f')),
+        'Backlog: {} segments ({:.1f} MB) at the end, at most {}, growing {} MB/day'.format(
+            report['backlog_segments'], report['backlog_mb'], report['backlog_max_segments'],
+            fmt(report['backlog_growth_mb_per_day'], '.1f')),
+        'Modem: on {} times for {:.2f}h in total ({} of the time)'.format(
+            report['modem_cycles'], report['modem_on_s'] / 3600, fmt(report['modem_on_fraction'], '.1%')),
+        format_latency(report['latency']),
+        'Files are in {}'.format(report['sim_dir']),
+    ])
+
+
+def format_latency(latency):
+    """ The capture to bucket latency summary as a line of text """
+    if latency is None:
+        return 'Latency: no segments traced'
+    stages = ', '.join('{} {:.0f}s'.format(stage, s) for stage, s in latency['mean_stage_s'].items())
+    return 'Latency: capture to bucket p50 {:.0f}s, p90 {:.0f}s, p99 {:.0f}s over {} segments, mostly {} ({:.0%}). Mean {}'.format(
+        latency['p50_s'], latency['p90_s'], latency['p99_s'], latency['n'], latency['dominant'],
+        latency['dominant_share'] or 0, stages)
+
+
+def run_simulation(args):
+    """ Run a simulation from buggd's command line arguments, and print the report """
+    sim = Simulation(hours=args.sim_hours, sim_dir=args.sim_dir, config_path=args.sim_config,
+                     latency_s=args.sim_latency, bandwidth_kbytes_per_s=args.sim_bandwidth_kBps,
+                     failure_rate=args.sim_failure_rate)
+    report = sim.run()
+    print(format_report(report))
+
+    if args.sim_report:
+        with open(args.sim_report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    return 0
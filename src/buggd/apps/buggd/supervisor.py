@@ -0,0 +1,266 @@
+"""
+This module keeps the daemon's worker threads running.
+
+The recording, postprocess and sync loops each run on a worker thread that the supervisor
+starts. A worker that raises (or returns before the daemon is stopping) is restarted after
+a backoff that grows with the number of times it has failed in the last FAILURE_WINDOW_S,
+so a transient ffmpeg or I/O error costs seconds of recording rather than a reboot. Only
+if a worker fails MAX_FAILURES times in that window is the failure escalated, to the
+reboot that used to follow every error.
+
+Each worker also pings the supervisor as it makes progress. A worker that hasn't pinged
+within its liveness time is stalled: a thread can't be stopped from outside, so that is
+escalated too. When buggd runs as a systemd service with ``Type=notify`` and
+``WatchdogSec=``, the supervisor tells systemd it is ready, and pings the watchdog unless
+a worker has stalled. A stalled worker therefore gets the service restarted by systemd. A
+worker waiting out its backoff doesn't stop the pings, as the supervisor will restart it,
+and restarting the service would lose its count of failures.
+"""
+
+import os
+import time
+import socket
+import logging
+import threading
+import collections
+
+from .debug import Debug
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+debug = Debug()
+
+# How often the workers are checked
+SUPERVISE_INTERVAL_S = 5
+
+# Wait before restarting a worker after its first, second... failure in the window
+RESTART_BACKOFF_S = (5, 30, 120, 300)
+
+# Failures of one worker in this window that lead to a reboot
+FAILURE_WINDOW_S = 3600
+MAX_FAILURES = 5
+
+
+def sd_notify(state):
+    """
+    Send a state change (e.g. 'READY=1') to systemd, if it started the daemon as a notify service
+
+    Returns:
+        True if it was sent
+    """
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return False
+    if address.startswith('@'):
+        # Abstract namespace
+        address = '\0' + address[1:]
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall(state.encode('utf-8'))
+        return True
+    except OSError as e:
+        logger.warning('Could not notify systemd of {}: {}'.format(state, e))
+        return False
+
+
+def watchdog_interval():
+    """ How often to ping the systemd watchdog, or None if it isn't watching the daemon """
+    usec = os.environ.get('WATCHDOG_USEC')
+    pid = os.environ.get('WATCHDOG_PID')
+    if not usec or (pid and int(pid) != os.getpid()):
+        return None
+    # Twice per timeout, as systemd recommends
+    return int(usec) / 1e6 / 2
+
+
+class Worker:
+    """
+    A loop run on its own thread, and how it has fared
+
+    Args:
+        name: Name of the worker, for the logs and pings
+        target: The function to run. It should only return once the daemon is stopping.
+        args: Arguments of target
+        liveness_s: The worker is stalled if it doesn't ping for this long, or None to not check
+    """
+
+    def __init__(self, name, target, args=(), liveness_s=None):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.liveness_s = liveness_s
+        self.thread = None
+        self.last_ping = None
+        self.failures = collections.deque()     # monotonic times of failures within the window
+        self.restart_at = None
+        self.restarts = 0
+        self.last_error = None
+        self.stalled = False
+
+
+class Supervisor:
+    """
+    Starts the workers, restarts them when they fail and feeds the systemd watchdog
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.workers = {}
+        self.die = None
+        self.escalate = None
+        self.escalated = None
+        self.watchdog_s = None
+        self.last_watchdog_t = None
+
+    def add(self, name, target, args=(), liveness_s=None):
+        """ Add a worker, to be started by start() """
+        self.workers[name] = Worker(name, target, args, liveness_s)
+
+    def start(self, die, escalate):
+        """
+        Start every worker
+
+        Args:
+            die: The event that stops the workers
+            escalate: Called with the reason when a worker fails too often or stalls,
+                e.g. to reboot. Called once, on the thread running run().
+        """
+        self.die = die
+        self.escalate = escalate
+        self.watchdog_s = watchdog_interval()
+        for worker in self.workers.values():
+            self._start(worker)
+
+        sd_notify('READY=1')
+        if self.watchdog_s:
+            logger.info('Pinging the systemd watchdog every {:.0f}s'.format(self.watchdog_s))
+
+    def _start(self, worker):
+        worker.restart_at = None
+        worker.last_ping = time.monotonic()
+        worker.stalled = False
+        worker.thread = threading.Thread(target=self._run, args=(worker,), name=worker.name)
+        worker.thread.start()
+
+    def _run(self, worker):
+        """ Run a worker's loop, recording how it ended """
+        try:
+            worker.target(*worker.args)
+            if self.die.is_set():
+                return
+            error = 'returned unexpectedly'
+        except Exception as e:
+            error = '{}: {}'.format(type(e).__name__, e)
+            logger.error('Worker {} failed: {}'.format(worker.name, error))
+            debug.write_traceback_to_log()
+        self._failed(worker, error)
+
+    def _failed(self, worker, error):
+        """ Schedule the restart of a worker, or escalate if it keeps failing """
+        now = time.monotonic()
+        with self.lock:
+            worker.last_error = error
+            worker.failures.append(now)
+            while worker.failures and now - worker.failures[0] > FAILURE_WINDOW_S:
+                worker.failures.popleft()
+            n_failures = len(worker.failures)
+
+            if n_failures >= MAX_FAILURES:
+                self.escalated = self.escalated or 'Worker {} failed {} times in {}s, last with {}'.format(
+                    worker.name, n_failures, FAILURE_WINDOW_S, error)
+                return
+
+            backoff_s = RESTART_BACKOFF_S[min(n_failures, len(RESTART_BACKOFF_S)) - 1]
+            worker.restart_at = now + backoff_s
+
+        logger.warning('Restarting worker {} in {}s ({} failures in the last {}s)'.format(
+            worker.name, backoff_s, n_failures, FAILURE_WINDOW_S))
+        sd_notify('STATUS=Restarting {} after {}'.format(worker.name, error))
+
+    def ping(self, name):
+        """ Let the supervisor know a worker is making progress """
+        worker = self.workers.get(name)
+        if worker is not None:
+            worker.last_ping = time.monotonic()
+
+    def check(self):
+        """
+        Restart workers that are due, look for stalled ones and feed the watchdog
+
+        Returns:
+            True if every worker is running and has pinged in time
+        """
+        now = time.monotonic()
+        healthy = True
+        stalled = False
+
+        for worker in self.workers.values():
+            if worker.thread is not None and worker.thread.is_alive():
+                since_ping_s = now - worker.last_ping
+                if worker.liveness_s is not None and since_ping_s > worker.liveness_s:
+                    healthy = False
+                    stalled = True
+                    if not worker.stalled:
+                        worker.stalled = True
+                        logger.error('Worker {} has stalled: no progress for {:.0f}s'.format(worker.name, since_ping_s))
+                        if not self.watchdog_s:
+                            # Nothing else will get it going again
+                            with self.lock:
+                                self.escalated = self.escalated or 'Worker {} stalled'.format(worker.name)
+                else:
+                    worker.stalled = False
+            else:
+                healthy = False
+                with self.lock:
+                    restart = worker.restart_at is not None and now >= worker.restart_at
+                if restart:
+                    logger.info('Restarting worker {}'.format(worker.name))
+                    worker.restarts += 1
+                    self._start(worker)
+
+        if self.escalated is not None:
+            reason, self.escalated, escalate = self.escalated, None, self.escalate
+            self.escalate = None
+            logger.critical('Escalating: {}'.format(reason))
+            sd_notify('STATUS={}'.format(reason))
+            if escalate is not None:
+                escalate(reason)
+            return False
+
+        # Only a stall holds back the watchdog. A worker in its backoff is restarted here.
+        if not stalled and self.watchdog_s and (self.last_watchdog_t is None or now - self.last_watchdog_t >= self.watchdog_s):
+            sd_notify('WATCHDOG=1')
+            self.last_watchdog_t = now
+
+        return healthy
+
+    def run(self):
+        """ Supervise the workers until the daemon is stopped """
+        while not self.die.is_set():
+            self.check()
+            time.sleep(min(SUPERVISE_INTERVAL_S, self.watchdog_s or SUPERVISE_INTERVAL_S))
+
+    def stop(self):
+        """ Stop the workers, waiting for each to finish what it is doing """
+        sd_notify('STOPPING=1')
+        self.die.set()
+        for worker in self.workers.values():
+            if worker.thread is not None:
+                worker.thread.join()
+
+    def status(self):
+        """ How each worker is doing, for buggd --status """
+        now = time.monotonic()
+        return {worker.name: {'alive': worker.thread is not None and worker.thread.is_alive(),
+                              'since_ping_s': round(now - worker.last_ping, 1) if worker.last_ping is not None else None,
+                              'restarts': worker.restarts,
+                              'recent_failures': sum(1 for t in worker.failures if now - t <= FAILURE_WINDOW_S),
+                              'last_error': worker.last_error}
+                for worker in self.workers.values()}
+
+
+# Shared by the workers, to ping it
+supervisor = Supervisor()
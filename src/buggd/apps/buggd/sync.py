@@ -0,0 +1,220 @@
+"""
+This module uploads the contents of the upload directory to an upload backend.
+
+It holds the part of the sync cycle that doesn't touch hardware - bundling, uploading,
+deleting and updating the manifests - so it can be run against any backend, including
+the local stand-in used by the benchmarks.
+"""
+
+import os
+import time
+import logging
+
+from .bundle import bundle_small_files, remove_bundled_files, get_bundle_dir
+from .checksums import read_sidecar, mark_upload_started, remove_with_sidecar, is_sidecar, is_partial, remove_orphaned_sidecar
+from .manifest import manifests
+from .journal import journal, segment_id, UPLOAD_START, UPLOAD_END, SYNC_START, SYNC_END, TRACE
+from .metrics import metrics, UPLOAD_MBPS, UPLOAD_MBPS_BUCKETS, UPLOADED_BYTES, UPLOAD_FAILURES
+from .metrics import CAPTURE_TO_CLOUD_S, CAPTURE_TO_CLOUD_BUCKETS_S
+from .tracing import tracer
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class SyncStats:
+    """ Counts what a sync cycle did, for logging and benchmarks """
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.skipped = 0
+        self.start_t = time.time()
+        self.end_t = None
+
+    def finish(self):
+        self.end_t = time.time()
+
+    def duration(self):
+        return (self.end_t or time.time()) - self.start_t
+
+    def __str__(self):
+        dur = self.duration()
+        return '{} files, {:.2f} MB in {:.1f}s ({:.2f} MB/s), {} already uploaded'.format(
+            self.files, self.bytes / 1e6, dur, self.bytes / 1e6 / dur if dur else 0, self.skipped)
+
+
+def record_upload(segment, remote_path, n_bytes, duration_s, **fields):
+    """ Record a confirmed upload, with its throughput, in the event journal and metrics """
+    mbps = n_bytes / 1e6 / duration_s if duration_s > 0 else None
+    journal.event(UPLOAD_END, segment, file=remote_path, bytes=n_bytes, duration_s=round(duration_s, 3),
+                  mbps=round(mbps, 3) if mbps is not None else None, **fields)
+
+    metrics.inc(UPLOADED_BYTES, n_bytes)
+    if mbps is not None:
+        metrics.observe(UPLOAD_MBPS, mbps, UPLOAD_MBPS_BUCKETS)
+
+
+def upload_file(backend, local_path, remote_path, stats=None):
+
+    """
+    Upload a single file and delete it locally once the upload is confirmed
+
+    If the file has a hash sidecar (written by the sensor as the file was encoded) the hashes
+    are sent with the upload so the server verifies the data. If a previous attempt to upload
+    the file began but it was never deleted locally - e.g. buggd died in between - the existing
+    remote object is compared against the hashes and the upload is skipped if they match.
+
+    Args:
+        backend: The UploadBackend to upload to
+        local_path: Path of the local file
+        remote_path: Name of the object in the bucket
+        stats: Optional SyncStats to update
+    """
+
+    hashes = read_sidecar(local_path)
+
+    # Only the sensors' data files have hash sidecars, so those are the segments
+    segment = segment_id(local_path) if hashes is not None else None
+
+    if hashes is not None:
+        # Pick the trace up again if the segment was staged before a restart
+        tracer.resume(segment, hashes.get('trace'))
+
+        if hashes.get('upload_started'):
+            existing = backend.get_remote_hashes(remote_path)
+            if existing is not None and existing['crc32c'] == hashes['crc32c'] and existing['md5'] == hashes['md5']:
+                logger.info('{} is already in the bucket with matching hashes. Deleting local file'.format(remote_path))
+                manifests.mark_uploaded(local_path)
+                remove_with_sidecar(local_path)
+                journal.event(UPLOAD_END, segment, file=remote_path, bytes=0, skipped=True)
+                # When it got to the bucket isn't known
+                tracer.discard(segment)
+                if stats: stats.skipped += 1
+                return
+
+        mark_upload_started(local_path, hashes)
+
+    n_bytes = os.path.getsize(local_path)
+    logger.info('Uploading {} to {}'.format(local_path, remote_path))
+    journal.event(UPLOAD_START, segment, file=remote_path, bytes=n_bytes)
+    start_t = time.monotonic()
+    try:
+        backend.upload_file(local_path, remote_path, hashes)
+    except Exception as e:
+        journal.event(UPLOAD_END, segment, file=remote_path, bytes=0, error=str(e))
+        metrics.inc(UPLOAD_FAILURES)
+        raise
+    record_upload(segment, remote_path, n_bytes, time.monotonic() - start_t)
+
+    # If the file did not upload successfully an Exception will be thrown
+    # by the backend, so if we're here it's safe to delete the local file
+    logger.info('Upload complete. Deleting local file at {}'.format(local_path))
+    manifests.mark_uploaded(local_path)
+    remove_with_sidecar(local_path)
+
+    trace = tracer.finish(segment) if segment is not None else None
+    if trace is not None:
+        journal.event(TRACE, segment, **trace)
+        metrics.observe(CAPTURE_TO_CLOUD_S, trace['total_s'], CAPTURE_TO_CLOUD_BUCKETS_S)
+
+    if stats:
+        stats.files += 1
+        stats.bytes += n_bytes
+
+
+def sync_upload_dir(backend, upload_dir, progress=None, stop=None):
+
+    """
+    Upload everything in the upload directory, deleting files as they are confirmed
+
+    Any exception from the backend ends the cycle; whatever wasn't uploaded stays on
+    disk for the next one. A file deleted by another thread after the walk listed it
+    (old logs and profiles are pruned as they are written) is skipped.
+
+    Args:
+        backend: The UploadBackend to upload to
+        upload_dir: The upload directory to synchronise (top level, not the device specific subdirectory)
+        progress: Called after each upload, e.g. to show the sync is still moving
+        stop: An event that, once set, ends the cycle after the file being uploaded. The
+            rest stay on disk for the next cycle.
+
+    Returns:
+        A SyncStats for the cycle
+    """
+
+    stats = SyncStats()
+
+    # Close the journal so far, so it goes up with this cycle
+    journal.roll()
+    journal.event(SYNC_START)
+
+    try:
+        # Pack small files (e.g. rotated logs) into one archive so they cost a single request
+        bundle_path, bundled = bundle_small_files(upload_dir)
+        if bundle_path:
+            remote_path = bundle_path[len(upload_dir)+1:]
+            logger.info('Uploading bundle of {} files to {}'.format(len(bundled), remote_path))
+            n_bytes = os.path.getsize(bundle_path)
+            journal.event(UPLOAD_START, file=remote_path, bytes=n_bytes, files=len(bundled))
+            start_t = time.monotonic()
+            backend.upload_file(bundle_path, remote_path)
+            record_upload(None, remote_path, n_bytes, time.monotonic() - start_t, files=len(bundled))
+
+            # As below, reaching here means the upload succeeded so the originals can go
+            logger.info('Bundle upload complete. Deleting {} bundled files'.format(len(bundled)))
+            remove_bundled_files(bundle_path, bundled)
+            stats.files += 1
+            stats.bytes += n_bytes
+
+        # Loop through local files, uploading them to the server
+        bundle_dir = get_bundle_dir(upload_dir)
+        for root, subdirs, files in os.walk(upload_dir):
+            # Bundles are handled above
+            subdirs[:] = [d for d in subdirs if os.path.join(root, d) != bundle_dir]
+            if stop is not None and stop.is_set():
+                logger.info('Sync stopped early, leaving the rest of {} for the next cycle'.format(upload_dir))
+                break
+            for local_f in files:
+                if stop is not None and stop.is_set():
+                    break
+                local_path = os.path.join(root, local_f)
+
+                # Files still being written are picked up next cycle, and sidecars go with their data file
+                if is_partial(local_path):
+                    continue
+                if is_sidecar(local_path):
+                    # A sidecar whose data file was uploaded earlier in this walk has already gone
+                    remove_orphaned_sidecar(local_path)
+                    continue
+
+                remote_path = local_path[len(upload_dir)+1:]
+                try:
+                    upload_file(backend, local_path, remote_path, stats)
+                except FileNotFoundError:
+                    if os.path.exists(local_path):
+                        raise
+                    # Pruned since the walk listed it, e.g. an old log archive or profile
+                    logger.info('{} was deleted before it could be uploaded'.format(local_path))
+                    continue
+                if progress:
+                    progress()
+
+        # Upload the manifests last, so they include this cycle's uploads
+        manifests.upload_dirty(backend)
+
+    finally:
+        stats.finish()
+        logger.info('Sync cycle uploaded {}'.format(stats))
+        dur = stats.duration()
+        journal.event(SYNC_END, files=stats.files, bytes=stats.bytes, skipped=stats.skipped,
+                      duration_s=round(dur, 3), mbps=round(stats.bytes / 1e6 / dur, 3) if dur else None)
+
+        latency = tracer.summary()
+        if latency is not None:
+            logger.info('Capture to bucket over the last {} segments: p50 {:.0f}s, p90 {:.0f}s, p99 {:.0f}s. '
+                        'Most of it is {} ({:.0%})'.format(latency['n'], latency['p50_s'], latency['p90_s'],
+                                                          latency['p99_s'], latency['dominant'],
+                                                          latency['dominant_share'] or 0))
+
+    return stats
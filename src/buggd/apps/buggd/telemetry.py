@@ -0,0 +1,152 @@
+"""
+This module samples the modem's signal and network state in the background.
+
+While the modem is powered, a thread asks it for the RSSI, registration state, access
+technology, operator and cell every few seconds. The latest sample is cached, so the
+sync loop (and anything else, such as the LEDs) can read it without any serial I/O of its own.
+
+Each sample is also appended to a CSV in ``telemetry/`` in the upload directory, one file
+per modem session. The file is written with a ``.part`` suffix, so the sync skips it until
+the session ends and it is renamed, or until the next boot if the session was cut off.
+Throughput in the upload logs can then be lined up with the signal at the time.
+"""
+
+import os
+import csv
+import time
+import logging
+import threading
+
+from .utils import discover_serial
+from .checksums import PART_SUFFIX
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+SAMPLE_INTERVAL_S = 10
+
+# Samples older than this aren't trusted by readers of the cache
+MAX_AGE_S = 60
+
+TELEMETRY_DIR_NAME = 'telemetry'
+FIELDS = ['utc', 'rssi', 'rssi_dbm', 'registration', 'technology', 'operator', 'lac', 'cell_id']
+
+
+class ModemTelemetry:
+    """
+    Samples the modem on a background thread and caches the latest sample
+
+    Args:
+        interval_s: Time between samples
+    """
+
+    def __init__(self, interval_s=SAMPLE_INTERVAL_S):
+        self.interval_s = interval_s
+        self.telemetry_dir = None
+        self.lock = threading.Lock()
+        self.sample = None
+        self.sample_t = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.path = None
+
+    def set_upload_dir(self, upload_dir):
+        """ Write the time series into the upload directory, closing any file left open by a previous run """
+        telemetry_dir = os.path.join(upload_dir, TELEMETRY_DIR_NAME)
+
+        # A session cut off by a crash or reboot never renamed its file
+        try:
+            os.makedirs(telemetry_dir, exist_ok=True)
+            for f in os.listdir(telemetry_dir):
+                if f.endswith(PART_SUFFIX):
+                    os.replace(os.path.join(telemetry_dir, f), os.path.join(telemetry_dir, f[:-len(PART_SUFFIX)]))
+        except OSError as e:
+            logger.error('Could not set up modem telemetry in {}: {}'.format(telemetry_dir, e))
+
+        self.telemetry_dir = telemetry_dir
+
+    def latest(self, max_age_s=MAX_AGE_S):
+        """
+        The latest sample, without talking to the modem
+
+        Returns:
+            A dict as Modem.get_telemetry(), plus 'age_s', or None if there isn't a recent one
+        """
+        with self.lock:
+            if self.sample is None or time.monotonic() - self.sample_t > max_age_s:
+                return None
+            return dict(self.sample, age_s=time.monotonic() - self.sample_t)
+
+    def start(self, modem):
+        """ Start sampling. Call once the modem is powered on. """
+        if self.thread is not None:
+            return
+
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, args=(modem,), name='telemetry', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Stop sampling and hand the session's time series to the sync. Call before powering the modem off. """
+        if self.thread is None:
+            return
+
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+        with self.lock:
+            self.sample = None
+
+        # Ready to upload
+        if self.path is not None:
+            try:
+                os.replace(self.path + PART_SUFFIX, self.path)
+            except OSError as e:
+                logger.error('Could not close modem telemetry file {}: {}'.format(self.path, e))
+            self.path = None
+
+    def _run(self, modem):
+        # Once per session, until the modem takes it
+        cell_info = False
+        while not self.stop_event.is_set():
+            start_t = time.monotonic()
+            try:
+                if not cell_info:
+                    cell_info = modem.enable_cell_info()
+                sample = modem.get_telemetry()
+            except Exception as e:
+                logger.error('Modem telemetry sample failed: {}'.format(e))
+                sample = None
+
+            if sample is not None:
+                with self.lock:
+                    self.sample = sample
+                    self.sample_t = time.monotonic()
+                self.record(sample)
+
+            self.stop_event.wait(max(0, self.interval_s - (time.monotonic() - start_t)))
+
+    def record(self, sample):
+        """ Append a sample to this session's time series """
+        if self.telemetry_dir is None:
+            return
+
+        try:
+            if self.path is None:
+                os.makedirs(self.telemetry_dir, exist_ok=True)
+                self.path = os.path.join(self.telemetry_dir, 'modem_{}_{}.csv'.format(
+                    discover_serial(), time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())))
+                with open(self.path + PART_SUFFIX, 'w', encoding='utf-8', newline='') as f:
+                    csv.writer(f).writerow(FIELDS)
+
+            row = [time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())] + [sample.get(k) for k in FIELDS[1:]]
+            with open(self.path + PART_SUFFIX, 'a', encoding='utf-8', newline='') as f:
+                csv.writer(f).writerow(row)
+        except OSError as e:
+            # Not critical
+            logger.error('Could not record modem telemetry: {}'.format(e))
+
+
+# Shared by the sync loop and anything else that wants the signal state
+telemetry = ModemTelemetry()
@@ -0,0 +1,217 @@
+"""
+This module keeps the system clock and the real-time clock (RTC) in step with network time.
+
+Time sync used to run ``ntpdate`` with a 3 minute timeout before every upload, which
+held up the upload while the modem was on. Now a single SNTP query measures the offset
+of the system clock, and ``hwclock`` measures the offset of the RTC. The clock is only
+stepped, and the RTC only rewritten, when an offset exceeds its threshold. The sync
+runs on its own thread, alongside the upload.
+
+Every measurement is written to the drift history in the upload directory, as a small CSV
+of its own. The file is written with a ``.part`` suffix and renamed once it is closed, so
+the sync never uploads one still being written, and each upload is a new object rather
+than replacing the day's history. The offsets can then be used to correct segment
+timestamps later.
+"""
+
+import os
+import time
+import socket
+import struct
+import logging
+import threading
+from datetime import datetime
+
+from .utils import call_cmd_line, discover_serial
+from .checksums import PART_SUFFIX
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+NTP_SERVER = 'ntp.ubuntu.com'
+NTP_PORT = 123
+NTP_TIMEOUT_S = 5
+
+# Seconds between the NTP epoch (1900) and the Unix epoch (1970)
+NTP_EPOCH_OFFSET = 2208988800
+
+# Only step the system clock if it is this far out
+STEP_THRESHOLD_S = 0.5
+
+# Only rewrite the RTC if it is this far from the system clock
+RTC_THRESHOLD_S = 1.0
+
+HISTORY_DIR_NAME = 'timesync'
+HISTORY_FIELDS = ['utc', 'ntp_offset_s', 'ntp_delay_s', 'rtc_offset_s', 'stepped', 'rtc_written']
+
+
+def sntp_query(server=NTP_SERVER, timeout=NTP_TIMEOUT_S):
+    """
+    Ask an NTP server for the time with a single SNTP request
+
+    Returns:
+        (offset, delay) in seconds, where offset is how far the system clock is behind the server
+    """
+
+    # LI = 0, version = 4, mode = 3 (client)
+    packet = bytearray(48)
+    packet[0] = (4 << 3) | 3
+
+    addr = socket.getaddrinfo(server, NTP_PORT, socket.AF_INET, socket.SOCK_DGRAM)[0][4]
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        t1 = time.time()
+        sock.sendto(packet, addr)
+        data, _ = sock.recvfrom(512)
+        t4 = time.time()
+
+    if len(data) < 48:
+        raise ValueError('Short NTP response from {}'.format(server))
+
+    def ntp_to_unix(secs, frac):
+        return secs - NTP_EPOCH_OFFSET + frac / 2**32
+
+    # Receive (t2) and transmit (t3) timestamps from the server
+    t2 = ntp_to_unix(*struct.unpack('!II', data[32:40]))
+    t3 = ntp_to_unix(*struct.unpack('!II', data[40:48]))
+
+    offset = ((t2 - t1) + (t3 - t4)) / 2
+    delay = (t4 - t1) - (t3 - t2)
+    return offset, delay
+
+
+def read_rtc_offset():
+    """
+    Measure how far the RTC is from the system clock
+
+    Returns:
+        The RTC time minus the system time in seconds, or None if the RTC couldn't be read
+    """
+
+    res = call_cmd_line('sudo hwclock --get')
+    now = time.time()
+    try:
+        return datetime.fromisoformat(res.strip()).timestamp() - now
+    except ValueError:
+        logger.warning('Could not parse RTC time "{}"'.format(res))
+        return None
+
+
+class TimeSync:
+    """
+    Measures clock drift and corrects the system clock and RTC when needed
+
+    Args:
+        server: NTP server to query
+        step_threshold_s: Step the system clock if it is further than this from network time
+        rtc_threshold_s: Rewrite the RTC if it is further than this from the system clock
+    """
+
+    def __init__(self, server=NTP_SERVER, step_threshold_s=STEP_THRESHOLD_S, rtc_threshold_s=RTC_THRESHOLD_S):
+        self.server = server
+        self.step_threshold_s = step_threshold_s
+        self.rtc_threshold_s = rtc_threshold_s
+        self.history_dir = None
+        self.pending = []
+        self.thread = None
+        self.last_offset = None
+
+    def set_upload_dir(self, upload_dir):
+        """
+        Write the drift history into the upload directory. Measurements taken before
+        this is known, i.e. at boot, are written now.
+        """
+        self.history_dir = os.path.join(upload_dir, HISTORY_DIR_NAME)
+
+        # A write cut off by a crash or reboot never renamed its file
+        if os.path.isdir(self.history_dir):
+            for f in os.listdir(self.history_dir):
+                if f.endswith(PART_SUFFIX):
+                    os.replace(os.path.join(self.history_dir, f), os.path.join(self.history_dir, f[:-len(PART_SUFFIX)]))
+
+        pending, self.pending = self.pending, []
+        if pending:
+            self._write(pending)
+
+    def sync(self):
+        """
+        Measure the clock offsets and correct them if needed. Blocks for a network round trip
+        and an RTC read.
+
+        Returns:
+            True if network time was reached
+        """
+
+        try:
+            offset, delay = sntp_query(self.server)
+        except (OSError, ValueError) as e:
+            logger.info('Could not get network time from {}: {}'.format(self.server, e))
+            return False
+
+        self.last_offset = offset
+        logger.info('System clock offset {:+.3f}s from {} (round trip {:.3f}s)'.format(offset, self.server, delay))
+
+        stepped = False
+        if abs(offset) > self.step_threshold_s:
+            logger.info('Stepping system clock by {:+.3f}s'.format(offset))
+            call_cmd_line('sudo date -u -s @{:.3f}'.format(time.time() + offset))
+            stepped = True
+
+        rtc_offset = read_rtc_offset()
+        rtc_written = False
+        if stepped or rtc_offset is None or abs(rtc_offset) > self.rtc_threshold_s:
+            logger.info('Writing system time to RTC (RTC offset {})'.format(
+                'unknown' if rtc_offset is None else '{:+.3f}s'.format(rtc_offset)))
+            call_cmd_line('sudo hwclock -w')
+            rtc_written = True
+
+        self.record(offset, delay, rtc_offset, stepped, rtc_written)
+        return True
+
+    def sync_async(self):
+        """ Run sync() on a background thread, unless one is already running """
+        if self.thread is not None and self.thread.is_alive():
+            logger.info('Time sync already in progress')
+            return self.thread
+
+        self.thread = threading.Thread(target=self.sync, name='timesync', daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def join(self, timeout=None):
+        """ Wait for a background sync to finish, if one is running """
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def record(self, offset, delay, rtc_offset, stepped, rtc_written):
+        """ Add a measurement to the drift history """
+        row = '{},{:.4f},{:.4f},{},{},{}\n'.format(
+            datetime.utcnow().isoformat()[:-3] + 'Z', offset, delay,
+            '' if rtc_offset is None else '{:.4f}'.format(rtc_offset), int(stepped), int(rtc_written))
+
+        if self.history_dir is None:
+            self.pending.append(row)
+        else:
+            self._write([row])
+
+    def _write(self, rows):
+        """ Write rows of the drift history to a new file """
+        try:
+            os.makedirs(self.history_dir, exist_ok=True)
+            name = 'drift_{}_{}'.format(discover_serial(), datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')[:-3] + 'Z')
+            path = os.path.join(self.history_dir, name + '.csv')
+            n = 1
+            while os.path.exists(path):
+                path = os.path.join(self.history_dir, '{}_{}.csv'.format(name, n))
+                n += 1
+            with open(path + PART_SUFFIX, 'w', encoding='utf-8') as f:
+                f.write(','.join(HISTORY_FIELDS) + '\n')
+                f.writelines(rows)
+            os.replace(path + PART_SUFFIX, path)
+        except OSError as e:
+            # Not critical
+            logger.error('Could not record clock drift: {}'.format(e))
+
+
+# Shared so the boot sequence and sync loop don't run two syncs at once
+timesync = TimeSync()
@@ -0,0 +1,173 @@
+"""
+This module traces each segment from the moment it is named until it is deleted after upload.
+
+A trace is started when the sensor names a segment in capture_data, and is stamped as it
+passes each point in the pipeline. The time between two stamps is one stage:
+
+    capture:    named        -> captured       arecord
+    trim:       captured     -> trimmed        removing the start of the recording
+    queue_wait: trimmed      -> encode_start   waiting for the postprocess thread
+    encode:     encode_start -> staged         ffmpeg, and copying into the data directory
+    wait_sync:  staged       -> upload_start   waiting for a sync cycle to reach it
+    upload:     upload_start -> uploaded       the upload, and deleting the local copy
+
+Stamps are wall clock times, so a segment that waits through a reboot is still traced:
+the trace is saved in the segment's hash sidecar when it is staged, and picked up again
+by the sync. The wall clock is only read once, when the daemon starts, and each stamp adds
+the monotonic time since, so the time sync stepping the clock doesn't move the stamps of
+a boot. A step between two boots lands in the stage the reboot falls in (usually
+wait_sync). A stamp that is missing (e.g. a sensor that doesn't trim), or earlier than
+the one before it, counts as taking no time. The total is the sum of the stages, so the
+two always agree.
+
+The latest TRACE_WINDOW completed traces are kept, for percentiles of the time from
+capture to the bucket and which stage takes most of it.
+"""
+
+import time
+import uuid
+import threading
+import collections
+
+# Stamps in pipeline order, and the stages between them
+MARKS = ('named', 'captured', 'trimmed', 'encode_start', 'staged', 'upload_start', 'uploaded')
+STAGES = ('capture', 'trim', 'queue_wait', 'encode', 'wait_sync', 'upload')
+
+# Completed traces kept for the summary
+TRACE_WINDOW = 500
+
+# Traces of segments that haven't been staged are dropped beyond this, e.g. if postprocess keeps failing
+MAX_OPEN_TRACES = 1000
+
+
+def percentile(values, pct):
+    """ Nearest-rank percentile of a sorted list """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class Tracer:
+    """
+    Holds the traces of segments in the pipeline, keyed by segment ID
+    """
+
+    def __init__(self, window=TRACE_WINDOW):
+        self.lock = threading.Lock()
+        self.traces = collections.OrderedDict()
+        self.completed = collections.deque(maxlen=window)
+        # Wall clock time when the monotonic clock was zero
+        self.epoch = time.time() - time.monotonic()
+
+    def now(self):
+        """ A stamp for the current time """
+        return self.epoch + time.monotonic()
+
+    def start(self, segment):
+        """
+        Start tracing a segment as it is named
+
+        Returns:
+            The trace ID
+        """
+        trace = {'id': uuid.uuid4().hex, 'named': self.now()}
+        with self.lock:
+            self.traces[segment] = trace
+            while len(self.traces) > MAX_OPEN_TRACES:
+                self.traces.popitem(last=False)
+        return trace['id']
+
+    def mark(self, segment, mark):
+        """
+        Stamp a segment as it reaches a point in the pipeline
+
+        Returns:
+            The trace ID, or None if the segment isn't being traced
+        """
+        if mark not in MARKS:
+            raise ValueError('Unknown trace mark {}'.format(mark))
+
+        with self.lock:
+            trace = self.traces.get(segment)
+            if trace is None:
+                return None
+            trace[mark] = self.now()
+            return trace['id']
+
+    def get(self, segment):
+        """ A copy of a segment's trace, to save with it, or None """
+        with self.lock:
+            trace = self.traces.get(segment)
+            return dict(trace) if trace is not None else None
+
+    def resume(self, segment, trace):
+        """ Carry on with a trace saved with a segment, if it isn't already being traced """
+        if not trace:
+            return
+        with self.lock:
+            self.traces.setdefault(segment, dict(trace))
+
+    def discard(self, segment):
+        """ Stop tracing a segment without counting it """
+        with self.lock:
+            self.traces.pop(segment, None)
+
+    def finish(self, segment):
+        """
+        Stamp a segment as uploaded and work out how long each stage took
+
+        Returns:
+            A dict of the trace ID, 'total_s' and the seconds spent in each stage, or None
+            if the segment wasn't being traced
+        """
+        with self.lock:
+            trace = self.traces.pop(segment, None)
+        if trace is None:
+            return None
+        trace['uploaded'] = self.now()
+
+        stages = {}
+        last = trace['named']
+        for stage, mark in zip(STAGES, MARKS[1:]):
+            t = trace.get(mark, last)
+            stages[stage] = max(0.0, t - last)
+            last = max(last, t)
+        total = sum(stages.values())
+
+        with self.lock:
+            self.completed.append((total, stages))
+
+        result = {'trace': trace['id'], 'total_s': round(total, 3)}
+        result.update({'{}_s'.format(stage): round(s, 3) for stage, s in stages.items()})
+        return result
+
+    def summary(self):
+        """
+        Percentiles of capture to bucket latency over the completed traces, and the stage
+        that takes the largest share of it
+
+        Returns:
+            A dict, or None if no trace has completed
+        """
+        with self.lock:
+            completed = list(self.completed)
+        if not completed:
+            return None
+
+        totals = sorted(total for total, _ in completed)
+        stage_totals = {stage: sum(stages[stage] for _, stages in completed) for stage in STAGES}
+        all_stages = sum(stage_totals.values())
+        dominant = max(STAGES, key=lambda stage: stage_totals[stage])
+
+        return {'n': len(completed),
+                'p50_s': round(percentile(totals, 50), 3),
+                'p90_s': round(percentile(totals, 90), 3),
+                'p99_s': round(percentile(totals, 99), 3),
+                'max_s': round(totals[-1], 3),
+                'dominant': dominant,
+                'dominant_share': round(stage_totals[dominant] / all_stages, 3) if all_stages else None,
+                'mean_stage_s': {stage: round(s / len(completed), 3) for stage, s in stage_totals.items()}}
+
+
+# Shared by the sensors, the journal and the sync
+tracer = Tracer()
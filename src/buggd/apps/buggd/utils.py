@@ -7,29 +7,14 @@ import logging
 import shutil
 import filecmp
 import json
-import RPi.GPIO as GPIO
 from datetime import datetime
 import time
-import requests
+from .connectivity import connectivity
 
 # Create a logger for this module and set its level
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-def set_led(led_driver, channels_arr, col_arr):
-    """
-    Sets LED colours using the PCF8574 I2C LED driver
-
-    Args:
-        led_driver: The I2C driver for the PCF8574 chip
-        channels_arr: Array of channels on the PCA9865 that refer to colours in col_arr (tuple)
-        col_arr: The target values for the LED channels (tuple)
-    """
-
-    for ch, col in zip(channels_arr, col_arr):
-        led_driver.port[ch] = not col
-
-
 def set_led_PCA9685(led_driver, channels_arr, col_arr):
     """
     Sets LED colours using the PCA9685 I2C LED driver
@@ -67,81 +52,35 @@ def call_cmd_line(args, use_shell=True, print_output=False, run_in_bg=False):
     return res
 
 
-def update_time():
+def check_internet_conn(led=None, col_succ=None, col_fail=None, timeout=2, max_age_s=None):
     """
-    Update the time from the internet, and write the updated time to the real-time clock module
+    Check if there is a valid internet connection with a cheap probe, or return the cached
+    state if it was probed within max_age_s. Optionally show the result on an LED.
     """
 
-    # (Not needed if RTC properly set-up)
-    # Read time from real-time clock module
-    # logger.info('Reading time from RTC')
-    # call_cmd_line('sudo hwclock -r')
-
-    # Update time from internet
-    logger.info('Updating time from internet before GCS sync')
-    cmd_res = call_cmd_line('sudo timeout 180s ntpdate ntp.ubuntu.com')
-
-    # Check if ntpdate was successful
-    if 'adjust time server' in cmd_res:
-        # Update time on real-time clock module
-        logger.info('Writing updated time to RTC')
-        call_cmd_line('sudo hwclock -w')
+    is_conn = connectivity.check(max_age_s=max_age_s, timeout=timeout)
 
+    if led is not None:
+        led.set(col_succ if is_conn else col_fail)
 
-
-def check_internet_conn(led_driver=[], led_driver_chs=[], col_succ=[], col_fail=[], timeout=2):
-    """
-    Check if there is a valid internet connection by fetching the entire content of Google's homepage and print the number of bytes.
-    """
-    try:
-        # Use the requests library to handle the connection and automatically follow redirects
-        response = requests.get('http://www.google.com', timeout=timeout)
-        
-        # Check if the request was successful (status code 200)
-        if response.status_code == 200:
-            content_length = len(response.content)  # Get the number of bytes in the response content
-            logger.debug("Successfully fetched Google's homepage. Content size: %s bytes.", content_length)
-            if led_driver:
-                set_led(led_driver, led_driver_chs, col_succ)
-            return True
-        else:
-            logger.debug("Failed to fetch Google's homepage. Status code: %s", response.status_code)
-    except Exception as e:
-        logger.debug("An error occurred: %s", e)
-        if led_driver:
-            set_led(led_driver, led_driver_chs, col_fail)
-        return False
+    return is_conn
 
 
-def wait_for_internet_conn(n_tries, led_driver, led_driver_chs, col_succ, col_fail, timeout=2, verbose=False):
+def wait_for_internet_conn(timeout_s, led, col_succ, col_fail, timeout=2, verbose=False):
     """
-    Repeatedly check and wait for a valid internet conntection
+    Wait up to timeout_s for a valid internet connection, probing with exponential backoff
     """
 
-    is_conn = False
-
     logger.info('Waiting for internet connection...')
 
-    for n_try in range(n_tries):
-        # Try to connect to the internet
-        is_conn = check_internet_conn(timeout=timeout)
-
-        # If connected break out
-        if is_conn:
-            break
-
-        # Otherwise sleep for a second and try again
-        else:
-            if verbose:
-                logger.info('No internet connection on try {}/{}'.format(n_try+1, n_tries))
-            time.sleep(1)
+    is_conn = connectivity.wait(timeout_s, probe_timeout=timeout, verbose=verbose)
 
     if is_conn:
         logger.info('Connected to the Internet')
-        set_led(led_driver, led_driver_chs, col_succ)
+        led.set(col_succ)
     else:
-        logger.info('No connection to internet after {} tries'.format(n_tries))
-        set_led(led_driver, led_driver_chs, col_fail)
+        logger.info('No connection to internet after {} secs'.format(timeout_s))
+        led.set(col_fail)
 
     return is_conn
 
@@ -7,7 +7,39 @@ It's mainly intended for use during debugging.
 import logging
 import sys
 import argparse
-from ...drivers.modem import Modem, ModemInUseException
+from ...drivers.modem import Modem, ModemInUseException, CONTROL_INTERFACE
+from ..buggd.control import call, ControlError, ControlUnavailable
+
+
+class DaemonModem:
+    """
+    Answers the queries from the running buggd, which holds the modem, with the same methods as the Modem driver
+    """
+
+    def __init__(self):
+        self.status = call('modem_status')
+
+    def power_on(self):
+        raise ControlError("buggd powers the modem for each sync while it's running. Use buggd --sync-now to sync now.")
+
+    def power_off(self):
+        raise ControlError("buggd powers the modem for each sync while it's running.")
+
+    def is_enumerated(self):
+        return self.status['enumerated']
+
+    def is_responding(self):
+        return self.status['responding']
+
+    def get_sim_ccid(self):
+        return self.status['ccid']
+
+    def get_rssi(self):
+        return self.status['rssi']
+
+    def get_rssi_dbm(self):
+        return self.status['rssi_dbm']
+
 
 def handle_power_command(logger, modem, args):
     """ Turn the modem on / off """
@@ -59,6 +91,8 @@ def main():
     Standalone utility to control the modem's power state and check status
     This allows the user to turn on the modem without running the recording application.
     It's mainly intended for use during debugging.  
+
+    If buggd is running, the modem is queried through it, as it holds the modem.
     """
     # Create a StreamHandler for stdout
     stdout_handler = logging.StreamHandler(sys.stdout)
@@ -72,6 +106,8 @@ def main():
     
     # Define the functions for the command line arguments
     parser = argparse.ArgumentParser(description='Control the modem.')
+    parser.add_argument('--port', default=CONTROL_INTERFACE,
+                        help='Serial port for AT commands, e.g. a simulator\'s pty. Giving one skips asking buggd.')
     subparsers = parser.add_subparsers(dest='command', help='Commands')
 
     # Power command
@@ -104,11 +140,27 @@ def main():
 
     # Execute the function associated with the chosen command
     if hasattr(args, 'func'):
-        modem = Modem()
+        modem = None
+        if args.port == CONTROL_INTERFACE:
+            try:
+                modem = DaemonModem()
+                logger.info("Asking buggd, which is running and holds the modem.")
+                if not modem.status['powered']:
+                    logger.info("buggd has the modem powered off until the next sync.")
+            except ControlUnavailable:
+                pass
+            except ControlError as e:
+                logger.error(f"buggd could not query the modem: {e}")
+                sys.exit(1)
+        if modem is None:
+            modem = Modem(control_interface=args.port)
+
         try:
             args.func(logger, modem, args)
         except ModemInUseException:
             logger.error("Modem is already in use, probably by ModemManager.")
+        except ControlError as e:
+            logger.error(str(e))
     else:
         parser.print_help()
 if __name__ == "__main__":
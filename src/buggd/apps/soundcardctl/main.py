@@ -2,6 +2,13 @@ import argparse
 import logging
 import sys
 from buggd.drivers.soundcard import Soundcard
+from buggd.apps.buggd.control import call, ControlError, ControlUnavailable
+
+# Phantom power modes on the command line
+PHANTOM_MODES = {'none': Soundcard.NONE, 'PIP': Soundcard.PIP, '3V3': Soundcard.P3V3, 'P48': Soundcard.P48}
+
+# Commands buggd can carry out on the soundcard it holds while recording
+DAEMON_COMMANDS = ('gain', 'phantom')
 
 def handle_power_command(logger, soundcard, args):
     """ Set power state of either the internal or external mic interface """
@@ -29,15 +36,17 @@ def handle_gain_command(logger, soundcard, args):
 def handle_phantom_command(logger, soundcard, args):
     """ Set phantom power """
     logger.info(f"Setting phantom power to {args.parameter}")
-    match args.parameter:
-        case 'none':
-            soundcard.set_phantom(soundcard.NONE)
-        case 'PIP':
-            soundcard.set_phantom(soundcard.PIP)
-        case '3V3':
-            soundcard.set_phantom(soundcard.P3V3)
-        case 'P48':
-            soundcard.set_phantom(soundcard.P48)
+    soundcard.set_phantom(PHANTOM_MODES[args.parameter])
+
+
+def handle_daemon_command(logger, args):
+    """ Set the gain or phantom power through buggd, which holds the soundcard while it records """
+    if args.command == 'gain':
+        call('gain', gain=args.parameter)
+        logger.info(f"buggd set the gain to {args.parameter}")
+    else:
+        call('phantom', mode=PHANTOM_MODES[args.parameter])
+        logger.info(f"buggd set the phantom power to {args.parameter}")
 
 
 def handle_variance_command(logger, soundcard, args):
@@ -71,6 +80,8 @@ def main():
     Standalone utility to control the soundcard's power state, gain and phantom power mode.
     This allows the user to control the soundcard without running the recording application.
     It's mainly intended for use during debugging.  
+
+    If buggd is running, the gain and phantom power are set through it, as it holds the soundcard.
     """
 
     # Create a StreamHandler for stdout
@@ -86,8 +97,6 @@ def main():
     parser = argparse.ArgumentParser(description='Test sound commands.')
     subparsers = parser.add_subparsers(dest='command', help='Commands')
 
-    soundcard = Soundcard()
-
     # Power command
     power_parser = subparsers.add_parser('power', help='Control power state')
     power_subparsers = power_parser.add_subparsers(required=True, dest='channel', help='Specify channel to control') 
@@ -108,7 +117,7 @@ def main():
 
     # Phantom command
     set_parser = subparsers.add_parser('phantom', help='Set phantom')
-    set_parser.add_argument('parameter', choices=['none','P48', 'PIP', '3V3'], help='set power mode')
+    set_parser.add_argument('parameter', choices=list(PHANTOM_MODES), help='set power mode')
     set_parser.set_defaults(func=handle_phantom_command)
 
     # Measure variance command
@@ -129,6 +138,22 @@ def main():
     else:
         # Execute the function associated with the chosen command
         if hasattr(args, 'func'):
+            if args.command in DAEMON_COMMANDS:
+                try:
+                    handle_daemon_command(logger, args)
+                    return
+                except ControlUnavailable:
+                    # buggd isn't running, or doesn't hold the soundcard, so use it directly
+                    pass
+                except ControlError as e:
+                    logger.error(f"buggd could not {args.command}: {e}")
+                    sys.exit(1)
+
+            try:
+                soundcard = Soundcard()
+            except RuntimeError:
+                logger.error("The soundcard is in use. If buggd is recording, stop it first.")
+                sys.exit(1)
             args.func(logger, soundcard, args)
         else:
             parser.print_help()
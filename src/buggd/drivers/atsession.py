@@ -0,0 +1,316 @@
+""" A persistent AT command session with the modem's control interface """
+import logging
+import threading
+import time
+from collections import deque
+import serial
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# How long to wait for a command's final result code
+COMMAND_TIMEOUT = 5
+
+# How long a single read blocks for, so the deadline is checked regularly
+READ_TIMEOUT = 0.05
+
+# Lines that end a command's response
+FINAL_OK = ("OK", "CONNECT")
+FINAL_ERROR = ("ERROR", "+CME ERROR", "+CMS ERROR", "NO CARRIER", "BUSY", "NO ANSWER", "NO DIALTONE")
+
+# Unsolicited result codes the modem may send at any time, e.g. on registration changes
+URC_PREFIXES = ("RING", "+CREG:", "+CGREG:", "+CEREG:", "+CMTI:", "+CUSD:", "+CGEV:", "+CIEV:",
+                "+CTZV:", "+CTZE:", "+CRING:", "+CLIP:", "!PCINFO:")
+
+# How many unsolicited result codes to keep
+URC_HISTORY = 100
+
+
+class ATError(Exception):
+    """ Exception raised when the modem doesn't give a final result code in time """
+
+
+class ATResponse:
+    """
+    The response to a command (or a batch of commands)
+
+    Attributes:
+        lines: The information lines of the response, without blank lines or the echo
+        final: The final result code, e.g. 'OK' or '+CME ERROR: 10'
+    """
+
+    def __init__(self, lines, final):
+        self.lines = lines
+        self.final = final
+
+    @property
+    def ok(self):
+        return self.final.startswith(FINAL_OK)
+
+    def get(self, prefix):
+        """
+        Return the values of the information lines starting with prefix, e.g. get('+CSQ')
+        returns ['20,99'] for the line '+CSQ: 20,99'
+        """
+        prefix = prefix.rstrip(':') + ':'
+        return [line[len(prefix):].strip() for line in self.lines if line.startswith(prefix)]
+
+    def __repr__(self):
+        return 'ATResponse({}, {})'.format(self.lines, self.final)
+
+
+def command_prefix(command):
+    """ The prefix of the information lines a command returns, e.g. 'AT+CSQ' -> '+CSQ' """
+    body = command[2:] if command[:2].upper() == 'AT' else command
+    for i, c in enumerate(body):
+        if c in '?=':
+            body = body[:i]
+            break
+    return body.strip()
+
+
+class ATSession:
+    """
+    Keeps the control interface open and exchanges AT commands with the modem
+
+    Each command is answered as soon as its final result code (OK, ERROR, +CME ERROR...)
+    arrives rather than after a fixed delay. Unsolicited result codes that arrive between
+    or during commands are set aside in ``urcs`` and passed to ``on_urc``.
+
+    Args:
+        port: Path of the serial port
+        baud: Baud rate
+        on_urc: Optional function called with each unsolicited result code
+    """
+
+    def __init__(self, port, baud, on_urc=None):
+        self.port = port
+        self.baud = baud
+        self.on_urc = on_urc
+        self.ser = None
+        self.buffer = b""
+        self.urcs = deque(maxlen=URC_HISTORY)
+        self.lock = threading.RLock()
+
+    @property
+    def is_open(self):
+        return self.ser is not None
+
+    def open(self):
+        """ Open the port and turn off command echo """
+        with self.lock:
+            if self.ser is not None:
+                return
+
+            # The exclusive (advisory) lock keeps other instances of our own tools off the port
+            self.ser = serial.Serial(self.port, self.baud, timeout=READ_TIMEOUT, exclusive=True)
+            self.buffer = b""
+            self.ser.reset_input_buffer()
+            logger.debug("Opened AT session on %s", self.port)
+
+            # Echo makes responses ambiguous, so turn it off. The echo of this command is discarded.
+            try:
+                self.command("ATE0")
+            except Exception:
+                self.close()
+                raise
+
+    def close(self):
+        """ Close the port """
+        with self.lock:
+            if self.ser is not None:
+                try:
+                    self.ser.close()
+                except serial.SerialException:
+                    pass
+                self.ser = None
+                logger.debug("Closed AT session on %s", self.port)
+
+    def write(self, command):
+        """ Send a command without waiting for the response, e.g. for AT!POWERDOWN """
+        with self.lock:
+            self.open()
+            self._write(command)
+
+    def command(self, command, timeout=COMMAND_TIMEOUT):
+        """
+        Send a command and wait for its final result code
+
+        Returns:
+            ATResponse
+
+        Raises:
+            ATError if there is no final result code within timeout
+            serial.SerialException if the port fails, e.g. because the modem has gone
+        """
+        with self.lock:
+            self.open()
+            try:
+                # Anything already waiting wasn't asked for, so must be unsolicited
+                self._drain_urcs()
+                self._write(command)
+                return self._read_response(command, timeout)
+            except serial.SerialException:
+                # The port is no use after an error, e.g. because the modem has reset
+                self.close()
+                raise
+
+    def batch(self, commands, timeout=COMMAND_TIMEOUT):
+        """
+        Send several commands on one command line, e.g. ['AT+CSQ', 'AT+CCID?'] is sent as
+        'AT+CSQ;+CCID?', so they cost a single round trip
+
+        The modem stops at the first command that fails, and gives a single final result code.
+        The response lines of the commands before the failure are still returned.
+
+        Returns:
+            ATResponse with the information lines of all of the commands
+        """
+        line = "AT" + ";".join(c[2:] if c[:2].upper() == 'AT' else c for c in commands)
+        return self.command(line, timeout)
+
+    def _write(self, command):
+        self.ser.write((command + "\r").encode())
+
+    def _read_line(self, deadline):
+        """ Return the next non-empty line, or None if the deadline passes first """
+        while True:
+            while b"\n" in self.buffer or b"\r" in self.buffer:
+                # Lines end in \r\n, but be tolerant of either on its own
+                idx = min(i for i in (self.buffer.find(b"\r"), self.buffer.find(b"\n")) if i >= 0)
+                line, self.buffer = self.buffer[:idx], self.buffer[idx + 1:]
+                line = line.decode('utf-8', errors='replace').strip()
+                if line:
+                    return line
+
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+
+            # Blocks for up to READ_TIMEOUT for the first byte
+            self.buffer += self.ser.read(max(1, self.ser.in_waiting))
+
+    def _drain_urcs(self):
+        """ Set aside anything the modem has sent since the last command """
+        if self.ser.in_waiting == 0 and not self.buffer:
+            return
+        self.buffer += self.ser.read(self.ser.in_waiting)
+        while True:
+            line = self._read_line(deadline=0)
+            if line is None:
+                break
+            self._urc(line)
+
+    def _urc(self, line):
+        logger.debug("URC: %s", line)
+        self.urcs.append((time.time(), line))
+        if self.on_urc is not None:
+            try:
+                self.on_urc(line)
+            except Exception as e:
+                logger.error("URC handler failed on %s: %s", line, e)
+
+    def _read_response(self, command, timeout):
+        """ Read lines until the final result code, setting aside unsolicited result codes """
+        deadline = time.monotonic() + timeout
+        expected = tuple(command_prefix(c) + ':' for c in command[2:].split(';'))
+        lines = []
+
+        while True:
+            line = self._read_line(deadline)
+            if line is None:
+                raise ATError("No response to {} within {}s (got {})".format(command, timeout, lines))
+
+            if line.startswith(FINAL_OK) or line.startswith(FINAL_ERROR):
+                response = ATResponse(lines, line)
+                logger.debug("AT command: %s, response: %s", command, response)
+                return response
+
+            # Echo, in case it's back on after a modem reset
+            if line == command:
+                continue
+
+            # A URC unless it's the kind of line this command is expected to return
+            if line.startswith(URC_PREFIXES) and not line.startswith(expected):
+                self._urc(line)
+                continue
+
+            lines.append(line)
+
+
+def parse_rssi(response):
+    """ Get the RSSI (0-31, or 99 if unknown) from the response to AT+CSQ """
+    for value in response.get("+CSQ"):
+        try:
+            rssi = int(value.split(",")[0])
+        except ValueError:
+            return None
+        if rssi == 99:
+            logger.warning("No signal - missing antenna?")
+        return rssi
+    return None
+
+
+def rssi_to_dbm(rssi):
+    """ Convert an RSSI from AT+CSQ to dBm """
+    if rssi is None or rssi == 99:
+        return None
+    return -113 + 2 * rssi
+
+
+def parse_ccid(response):
+    """ Get the ICCID from the response to AT+CCID? """
+    for value in response.get("+CCID"):
+        try:
+            return int(value)
+        except ValueError:
+            return None
+    return None
+
+
+# <stat> of +CREG/+CGREG/+CEREG
+REGISTRATION_STATES = {0: "not registered", 1: "home", 2: "searching", 3: "denied", 4: "unknown", 5: "roaming"}
+
+# <AcT> of +COPS/+CREG/+CEREG
+ACCESS_TECHNOLOGIES = {0: "GSM", 2: "UMTS", 3: "EDGE", 4: "HSDPA", 5: "HSUPA", 6: "HSPA", 7: "LTE", 8: "EC-GSM", 9: "NB-IoT"}
+
+
+def parse_registration(response, prefix):
+    """
+    Get the registration from the response to AT+CREG? or AT+CEREG? (after AT+CREG=2 / AT+CEREG=2)
+
+    Returns:
+        A dict of 'registration', 'lac', 'cell_id' and 'technology', or None if not in the response
+    """
+    for value in response.get(prefix):
+        fields = [f.strip().strip('"') for f in value.split(",")]
+        try:
+            stat = int(fields[1])
+        except (IndexError, ValueError):
+            # An unsolicited "+CEREG: <stat>" that arrived during the command
+            continue
+        result = {'registration': REGISTRATION_STATES.get(stat, str(stat)), 'lac': None, 'cell_id': None, 'technology': None}
+        if len(fields) >= 4:
+            # Area code and cell ID are in hex
+            result['lac'] = fields[2] or None
+            result['cell_id'] = fields[3] or None
+        if len(fields) >= 5 and fields[4].isdigit():
+            result['technology'] = ACCESS_TECHNOLOGIES.get(int(fields[4]), fields[4])
+        return result
+    return None
+
+
+def parse_operator(response):
+    """
+    Get the operator from the response to AT+COPS?
+
+    Returns:
+        (operator name, access technology), either of which may be None
+    """
+    for value in response.get("+COPS"):
+        fields = [f.strip().strip('"') for f in value.split(",")]
+        operator = fields[2] if len(fields) >= 3 and fields[2] else None
+        technology = None
+        if len(fields) >= 4 and fields[3].isdigit():
+            technology = ACCESS_TECHNOLOGIES.get(int(fields[3]), fields[3])
+        return operator, technology
+    return None, None
@@ -0,0 +1,169 @@
+"""
+Shared access to the I2C buses.
+
+Every driver in the process uses the same handle for a bus, which stays open rather than
+being opened for each register. Access is serialised with a lock, so drivers on different
+threads (e.g. the LEDs and the audio bridge) can't interleave their transactions.
+
+Register writes are remembered in a shadow of each device's registers. A write of the
+value a register already holds is skipped, runs of consecutive registers are sent as
+one block write, and writes can be verified by reading them back.
+"""
+import logging
+import threading
+from ..hal import SMBus
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DEFAULT_BUS = 1
+
+# errno returned when a device is bound to a kernel driver
+EBUSY = 16
+
+# SMBus block transfers are limited to 32 bytes
+MAX_BLOCK_LEN = 32
+
+
+class I2CVerifyError(Exception):
+    """ Exception raised when a register doesn't read back the value written to it """
+
+
+class I2CBus:
+    """
+    A process-wide handle on one I2C bus
+
+    Args:
+        bus_num: The bus number, i.e. /dev/i2c-<bus_num>
+    """
+
+    def __init__(self, bus_num=DEFAULT_BUS):
+        self.bus_num = bus_num
+        self.lock = threading.RLock()
+        self.smbus = None
+        self.shadow = {}    # (addr, reg) -> last value written or read
+
+    def _bus(self):
+        if self.smbus is None:
+            self.smbus = SMBus(self.bus_num)
+        return self.smbus
+
+    def close(self):
+        """ Close the handle. It is reopened by the next access. """
+        with self.lock:
+            if self.smbus is not None:
+                self.smbus.close()
+                self.smbus = None
+
+    def invalidate(self, addr):
+        """ Forget the shadow of a device's registers, e.g. because it has been reset """
+        with self.lock:
+            for key in [k for k in self.shadow if k[0] == addr]:
+                del self.shadow[key]
+
+    def probe(self, addr, force=True):
+        """
+        Check if a device responds, by reading a byte from it
+
+        There is no guarantee that this will not change the device's state, or that every
+        device will respond, but it works for the devices we use.
+        """
+        with self.lock:
+            try:
+                self._bus().read_byte(addr, force=force)
+                return True
+            except OSError as e:
+                # Busy means bound to a kernel driver, so present
+                return e.errno == EBUSY
+
+    def read_byte(self, addr):
+        """ Read a byte from a device without a register address, e.g. an IO expander's port """
+        with self.lock:
+            return self._bus().read_byte(addr)
+
+    def write_byte(self, addr, value):
+        """ Write a byte to a device without a register address """
+        with self.lock:
+            self._bus().write_byte(addr, value)
+
+    def read_register(self, addr, reg):
+        """ Read a register, updating the shadow """
+        with self.lock:
+            value = self._bus().read_byte_data(addr, reg)
+            self.shadow[(addr, reg)] = value
+            return value
+
+    def write_register(self, addr, reg, value, verify=False):
+        """
+        Write a register, unless the shadow says it already holds the value
+
+        Returns:
+            True if the register was written, False if the write was skipped
+
+        Raises:
+            I2CVerifyError if verify is set and the register reads back differently
+        """
+        return self.write_registers(addr, {reg: value}, verify) > 0
+
+    def write_registers(self, addr, values, verify=False):
+        """
+        Write several registers in order, skipping those the shadow says are unchanged.
+        Runs of consecutive registers are sent as one block write, which relies on the
+        device incrementing the register address (as most register-based devices do).
+
+        Args:
+            addr: Device address
+            values: dict of register -> value, written in order
+            verify: Read each run back to check it was written
+
+        Returns:
+            The number of registers written
+        """
+        with self.lock:
+            runs = []
+            for reg, value in values.items():
+                if self.shadow.get((addr, reg)) == value:
+                    continue
+                if runs and reg == runs[-1][0] + len(runs[-1][1]) and len(runs[-1][1]) < MAX_BLOCK_LEN:
+                    runs[-1][1].append(value)
+                else:
+                    runs.append((reg, [value]))
+
+            written = 0
+            for start, data in runs:
+                # Until the write succeeds we don't know what the registers hold
+                for i in range(len(data)):
+                    self.shadow.pop((addr, start + i), None)
+
+                if len(data) == 1:
+                    self._bus().write_byte_data(addr, start, data[0])
+                else:
+                    self._bus().write_i2c_block_data(addr, start, data)
+
+                if verify:
+                    if len(data) == 1:
+                        readback = [self._bus().read_byte_data(addr, start)]
+                    else:
+                        readback = self._bus().read_i2c_block_data(addr, start, len(data))
+                    if list(readback) != data:
+                        raise I2CVerifyError('Device 0x{:02x} register 0x{:02x} reads back {} after writing {}'.format(
+                            addr, start, [hex(b) for b in readback], [hex(b) for b in data]))
+
+                for i, value in enumerate(data):
+                    self.shadow[(addr, start + i)] = value
+                written += len(data)
+
+            logger.debug('Wrote %d of %d registers on device 0x%02x in %d transfers', written, len(values), addr, len(runs))
+            return written
+
+
+buses = {}
+buses_lock = threading.Lock()
+
+
+def get_bus(bus_num=DEFAULT_BUS):
+    """ Get the shared handle for an I2C bus """
+    with buses_lock:
+        if bus_num not in buses:
+            buses[bus_num] = I2CBus(bus_num)
+        return buses[bus_num]
@@ -0,0 +1,182 @@
+"""
+Runs LED patterns (blinks, blink codes, sequences) on a timer thread.
+
+Callers post a pattern and return straight away; one thread steps every running pattern,
+sleeping until the next change. Each pattern has a priority. Where patterns want the same
+LED, the highest priority one is shown, and an LED goes back to its base colour (the last
+colour set on it) once no pattern wants it.
+
+The PCF8574 can only turn channels fully on or off, so there is no dimming, e.g. breathing.
+"""
+import logging
+import threading
+import time
+
+from .leds import Colour
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+PRIORITY_STATUS = 10
+PRIORITY_ERROR = 100
+
+
+class Pattern:
+    """
+    A sequence of LED colours
+
+    Args:
+        steps: List of (colours, duration_s), where colours is a dict of LED -> Colour
+        repeat: How many times to play the steps, or None to play until cancelled
+        priority: Higher priority patterns are shown over lower priority ones
+        name: Posting a pattern replaces any running pattern with the same name
+    """
+
+    def __init__(self, steps, repeat=1, priority=0, name=None):
+        self.steps = steps
+        self.repeat = repeat
+        self.priority = priority
+        self.name = name
+        self.period = sum(duration for _, duration in steps)
+        self.leds = set(led for colours, _ in steps for led in colours)
+        self.start_t = None
+        self.done = threading.Event()
+
+    def state_at(self, elapsed):
+        """
+        Returns:
+            (colours, seconds until the next step), or None if the pattern has finished
+        """
+        if self.period <= 0:
+            return None
+
+        n, offset = divmod(elapsed, self.period)
+        if self.repeat is not None and n >= self.repeat:
+            return None
+
+        for colours, duration in self.steps:
+            if offset < duration:
+                return colours, duration - offset
+            offset -= duration
+        return self.steps[-1][0], 0
+
+
+def blink(leds, colour, on_s=0.5, off_s=0.5, repeat=None, off=Colour.OFF, **kwargs):
+    """ Blink one or more LEDs together """
+    return Pattern([({led: colour for led in leds}, on_s), ({led: off for led in leds}, off_s)], repeat, **kwargs)
+
+
+def blink_code(led, colour, count, on_s=0.3, off_s=0.3, pause_s=1.5, repeat=None, off=Colour.OFF, **kwargs):
+    """ Blink an LED count times, then pause, so the count can be read off """
+    steps = []
+    for _ in range(count):
+        steps += [({led: colour}, on_s), ({led: off}, off_s)]
+    steps.append(({led: off}, pause_s))
+    return Pattern(steps, repeat, **kwargs)
+
+
+def hold(colours, duration_s, **kwargs):
+    """ Show colours for a while, e.g. a status at boot """
+    return Pattern([(colours, duration_s)], 1, **kwargs)
+
+
+class LEDPatternEngine:
+    """
+    Runs posted patterns on the LEDs from one background thread
+
+    Args:
+        leds: The LEDs object
+    """
+
+    def __init__(self, leds):
+        self.leds = leds
+        self.cond = threading.Condition()
+        self.patterns = []
+        self.thread = None
+        self.stopping = False
+
+    def post(self, pattern):
+        """ Start a pattern, replacing any running pattern with the same name. Returns the pattern. """
+        with self.cond:
+            if pattern.name is not None:
+                for old in [p for p in self.patterns if p.name == pattern.name]:
+                    self.patterns.remove(old)
+                    old.done.set()
+            pattern.start_t = time.monotonic()
+            self.patterns.append(pattern)
+
+            if self.thread is None:
+                self.stopping = False
+                self.thread = threading.Thread(target=self._run, name='ledpatterns', daemon=True)
+                self.thread.start()
+            self.cond.notify()
+        return pattern
+
+    def cancel(self, name):
+        """ Stop the running pattern with the given name """
+        with self.cond:
+            for old in [p for p in self.patterns if p.name == name]:
+                self.patterns.remove(old)
+                old.done.set()
+            self.cond.notify()
+
+    def stop(self):
+        """ Stop all patterns and the thread, leaving the LEDs at their base colours """
+        with self.cond:
+            for pattern in self.patterns:
+                pattern.done.set()
+            self.patterns = []
+            self.stopping = True
+            self.cond.notify()
+            thread = self.thread
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                wanted = {}
+                wake = None
+
+                # Highest priority first, and the most recent pattern wins a tie
+                for pattern in sorted(self.patterns, key=lambda p: (p.priority, p.start_t), reverse=True):
+                    state = pattern.state_at(now - pattern.start_t)
+                    if state is None:
+                        self.patterns.remove(pattern)
+                        pattern.done.set()
+                        continue
+                    colours, remaining = state
+                    for led, colour in colours.items():
+                        wanted.setdefault(led, colour)
+                    wake = remaining if wake is None else min(wake, remaining)
+
+                try:
+                    self._show(wanted)
+                except Exception as e:
+                    # e.g. an I2C error; try again at the next step rather than dying
+                    logger.error('Failed to update LEDs: {}'.format(e))
+
+                # With nothing left to run, the LEDs are back at their base colours and the
+                # thread can go until the next pattern is posted
+                if self.stopping or not self.patterns:
+                    self.thread = None
+                    return
+
+                self.cond.wait(wake)
+
+    def _show(self, wanted):
+        """ Show the wanted colours, and base colours on the other LEDs, in one write """
+        driver = self.leds.driver
+        with driver.lock:
+            values = {}
+            for led in self.leds.all:
+                if led in wanted:
+                    led.overridden = True
+                    values.update(led.channel_values(wanted[led]))
+                elif led.overridden:
+                    led.overridden = False
+                    if led.base is not None:
+                        values.update(led.channel_values(led.base))
+            if values:
+                driver.update(values)
@@ -1,5 +1,6 @@
+import threading
 from enum import Enum, auto
-from pcf8574 import PCF8574
+from .i2cbus import get_bus
 
 ADDRESS = 0x23
 BUS = 1
@@ -29,25 +30,61 @@ COLOUR_THEORY = {
 }
 
 class Driver():
-    """ This class is responsible for interfacing with the PCF8574 IO expander """
+    """
+    This class is responsible for interfacing with the PCF8574 IO expander
+
+    It keeps a shadow of the port, so an update computes the new byte from the shadow and
+    writes the whole port once. Nothing is written if the byte hasn't changed.
+    """
     def __init__(self, bus, address):
-        self.bus = bus
+        self.bus = get_bus(bus)
         self.address = address
-        self.io_expander = PCF8574(self.bus, self.address)
+        # Re-entrant so the LEDs can hold it across their own updates
+        self.lock = threading.RLock()
+        self.shadow = None
+        self.writes = 0
 
-    def set(self, channel, value):
+    def update(self, values):
         """
-        Turns on one channel of the IO expander (one LED within an RGB LED)
+        Turns channels of the IO expander on or off (LEDs within the RGB LEDs) in one write
         Channels are active low
+
+        Args:
+            values: dict of channel -> on (truthy) or off
         """
-        try:
-            self.io_expander.port[channel] = not value
-        except AssertionError:
-            pass
+        with self.lock:
+            if self.shadow is None:
+                # Start from whatever the port was left at, e.g. by the previous run
+                try:
+                    self.shadow = self.bus.read_byte(self.address)
+                except OSError:
+                    self.shadow = 0xFF
+
+            state = self.shadow
+            for channel, value in values.items():
+                # Channel 0 is the most significant bit
+                bit = 1 << (7 - channel)
+                state = state & ~bit & 0xFF if value else state | bit
+
+            if state == self.shadow:
+                return
+
+            self.bus.write_byte(self.address, state)
+            self.shadow = state
+            self.writes += 1
+
+    def set(self, channel, value):
+        """ Turns on one channel of the IO expander """
+        self.update({channel: value})
 
 
 class LED:
-    """ This class represents an RGB LED """
+    """
+    This class represents an RGB LED
+
+    The colour set is the LED's base colour. While a pattern is running on the LED the
+    pattern is shown instead, and the base colour comes back when the pattern ends.
+    """
     def __init__(self, driver, ch_r, ch_g, ch_b):
         self.driver = driver
         self.channels = {
@@ -56,27 +93,36 @@ class LED:
             'blue': ch_b
         }
         self.stay_on_at_exit = False
+        self.base = None
+        self.overridden = False
 
     def set(self, colour: Colour):
+        """ Sets the colour of the LED """
+        values = self.channel_values(colour)
+        with self.driver.lock:
+            self.base = colour
+            if not self.overridden:
+                self.driver.update(values)
+
+    def channel_values(self, colour: Colour):
         """
-        Sets the colour of the LED
+        The driver channel values that show a colour
         An LED, like the Power LED, can have a colour hard-wired to a specific channel, so 
         check for that and raise an error if we try to set a colour that can't be displayed
         """
         col = COLOUR_THEORY[colour]
-        r, g, b = col
 
-        # Check if any of the channels are stuck in hardware
+        values = {}
         for index, element in enumerate(self.channels.items()):
+            # Check if any of the channels are stuck in hardware
             if isinstance(element[1], bool):
                 if not element[1] == col[index]:
                     inv_map = {v: k for k, v in COLOUR_THEORY.items()}
                     raise ValueError(f"{inv_map.get(col)} cannot be displayed on this LED because \
                                      it's colour {element[0]} is hard-wired to {element[1]}")
-
-        self.driver.set(self.channels['red'], r)
-        self.driver.set(self.channels['green'], g)
-        self.driver.set(self.channels['blue'], b)
+                continue
+            values[element[1]] = col[index]
+        return values
 
 class LEDs():
     """ This class contains the three user-facing LEDs on the product """
@@ -89,12 +135,31 @@ class LEDs():
 
         self.bottom.stay_on_at_exit = True
 
+        self.all = (self.top, self.middle, self.bottom)
+
+
+    def set(self, colours):
+        """
+        Sets the colours of several LEDs in one write
+
+        Args:
+            colours: dict of LED -> Colour
+        """
+        values = {}
+        for led, colour in colours.items():
+            values[led] = led.channel_values(colour)
+
+        with self.driver.lock:
+            update = {}
+            for led, colour in colours.items():
+                led.base = colour
+                if not led.overridden:
+                    update.update(values[led])
+            self.driver.update(update)
 
     def all_off(self):
         """ Turns off all LEDs """
-        self.top.set(Colour.OFF)
-        self.middle.set(Colour.OFF)
-        self.bottom.set(Colour.RED)
+        self.set({self.top: Colour.OFF, self.middle: Colour.OFF, self.bottom: Colour.RED})
 
 
     def at_exit(self):
@@ -2,12 +2,13 @@
 import logging
 import time
 from enum import Enum, auto
-import usb.core
-import usb.util
-import os
+import subprocess
 import serial
-import RPi.GPIO as GPIO
+from ..hal import GPIO, usb_device_present, is_simulated
 from .lock import Lock
+from .atsession import ATSession, ATError, parse_rssi, parse_ccid, rssi_to_dbm, parse_registration, parse_operator
+from .serialport import is_port_open_elsewhere
+from .usbwatch import wait_for_usb_device
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -21,12 +22,17 @@ LOCK_FILE = "/tmp/modem.lock"
 CONTROL_INTERFACE = "/dev/tty_modem_command_interface"
 CONTROL_INTERFACE_BAUD = 115200
 CONTROL_INTERFACE_TIMEOUT = 1
-CONTROL_INTERFACE_READ_SIZE = 100
-TIME_WAIT_RESPONSE = 0.5
 
 VENDOR_ID = 0x1199
 PRODUCT_ID = 0x68c0
 
+# Used for telemetry when ModemManager has the control interface
+MMCLI_TIMEOUT = 10
+
+# How long the modem has to enumerate after POWER_ON_N, and to disappear after AT!POWERDOWN
+ENUMERATE_TIMEOUT = 22
+POWER_OFF_TIMEOUT = 30
+
 class ModemInUseException(Exception):
     """Exception raised when the modem is already in use by another process."""
 
@@ -35,10 +41,18 @@ class Modem:
     Provides power control and status information for the RC7620 GSM modem
     We use the FileLock library to ensure that only one instance of the driver is running at a time.
 
+    AT commands go through a persistent ATSession, which is opened on the first command and
+    closed when the modem is powered off.
     """
 
-    def __init__(self, lock_file_path=LOCK_FILE):
-        """ Attempt to acquire the lock and initialise the GPIO """
+    def __init__(self, lock_file_path=LOCK_FILE, control_interface=CONTROL_INTERFACE):
+        """
+        Attempt to acquire the lock and initialise the GPIO
+
+        Args:
+            lock_file_path: Lock file that keeps other instances of the driver out
+            control_interface: Serial port for AT commands, e.g. a simulator's pty
+        """
         try:
             self.lock = Lock(lock_file_path)
         except RuntimeError as e:
@@ -46,6 +60,8 @@ class Modem:
             self.result = False
             raise
         self.port = None
+        self.control_interface = control_interface
+        self.at = ATSession(control_interface, CONTROL_INTERFACE_BAUD)
 
         GPIO.setmode(GPIO.BCM)
         GPIO.setwarnings(False) # Squash warning if the pin is already in use
@@ -60,6 +76,7 @@ class Modem:
 
     def __del__(self):
         """ Release the lock file when the object is deleted"""
+        self.at.close()
         self.release_gpio()
         self.lock.release_lock()
 
@@ -110,35 +127,24 @@ class Modem:
         GPIO.output(POWER_ON_N, GPIO.LOW)
 
         logger.info("POWER_ON_N asserted, waiting for modem to boot up...")
-        # Wait for the modem to boot up
-        time.sleep(2)
-        max_tries = 10
-        while(max_tries > 0):
-            logger.info("Checking if modem is enumerated...")
-            if self.is_enumerated():
-                logger.info("Modem is enumerated.")
-                return True
-            time.sleep(2)
-            max_tries -= 1
+        start_t = time.monotonic()
+        if wait_for_usb_device(VENDOR_ID, PRODUCT_ID, True, ENUMERATE_TIMEOUT, check=self.is_enumerated, events=not is_simulated()):
+            logger.info("Modem is enumerated after {:.1f}s.".format(time.monotonic() - start_t))
+            return True
         
         logger.error("Timed out waiting for modem to boot up.")
         return False
 
-    def wait_power_off(self):
+    def wait_power_off(self, timeout=POWER_OFF_TIMEOUT):
         """
         Wait for the modem to power down.
         Returns True if the modem has powered down, False otherwise.
         """
-        # Wait for the modem to power down 
-        max_tries = 10
-        while(max_tries > 0):
-            if self.is_enumerated():
-                logger.info("Modem is still powered on. Waiting for it to power down...")
-            else:
-                logger.info("Modem has powered down.")
-                return True
-            time.sleep(3)
-            max_tries -= 1
+        logger.info("Waiting for modem to power down...")
+        start_t = time.monotonic()
+        if wait_for_usb_device(VENDOR_ID, PRODUCT_ID, False, timeout, check=self.is_enumerated, events=not is_simulated()):
+            logger.info("Modem has powered down after {:.1f}s.".format(time.monotonic() - start_t))
+            return True
         return False
 
     def power_off(self):
@@ -151,6 +157,9 @@ class Modem:
         if self.send_at_command_no_response("AT!POWERDOWN"):
             self.release_gpio()
 
+        # The port goes away with the modem
+        self.at.close()
+
         if self.wait_power_off():
             self.turn_off_rail()
             return True
@@ -172,38 +181,15 @@ class Modem:
 
     def is_enumerated(self):
         """ Check if the modem is enumerated on the USB bus """
-        return usb.core.find(idVendor=VENDOR_ID, idProduct=PRODUCT_ID) is not None
+        return usb_device_present(VENDOR_ID, PRODUCT_ID)
 
 
     def is_serial_port_in_use(self, port):
-        # Normalize the target device path (resolve any symlinks)
-        target_device = os.path.realpath(port)
-        
-        # Iterate over all processes in /proc
-        for pid in os.listdir('/proc'):
-            if pid.isdigit():
-                fds_path = f'/proc/{pid}/fd'
-                try:
-                    # List all file descriptors for the current process
-                    fds = os.listdir(fds_path)
-                except PermissionError:
-                    # Skip this process if we don't have permission to view its fds
-                    continue
-                except FileNotFoundError:
-                    # Process might have ended; move on to the next
-                    continue
-                
-                for fd in fds:
-                    fd_path = os.path.join(fds_path, fd)
-                    try:
-                        # Check if this fd is a symlink to our target device
-                        if os.path.realpath(fd_path) == target_device:
-                            logger.info(f"Device {port} is in use by process {pid}")
-                            return True
-                    except FileNotFoundError:
-                        # The fd was closed; move on to the next
-                        continue
-        return False
+        """
+        Check if ModemManager has the port open. Other instances of our own tools are kept
+        out by the advisory lock the AT session takes on the port.
+        """
+        return is_port_open_elsewhere(port)
 
     def send_at_command_no_response(self, command):
         """
@@ -213,51 +199,66 @@ class Modem:
         and we'll be unable to read the response.
         """
         try:
-            # Open the serial port
-            with serial.Serial(CONTROL_INTERFACE, CONTROL_INTERFACE_BAUD, timeout=CONTROL_INTERFACE_TIMEOUT) as ser:
-                ser.write((command + "\r\n").encode())
+            if self.at.is_open:
+                self.at.write(command)
+            else:
+                with serial.Serial(self.control_interface, CONTROL_INTERFACE_BAUD, timeout=CONTROL_INTERFACE_TIMEOUT) as ser:
+                    ser.write((command + "\r\n").encode())
 
         except serial.SerialException as e:
             logger.error("Failed to send AT command: %s", e)
             return None 
 
-    
-    def send_at_command(self, command):
+    def _open_session(self):
+        """ Open the AT session, unless another process has the port """
+        if not self.at.is_open:
+            # Some processes, like ModemManager, open in non-exclusive mode that pyserial can't detect
+            if self.is_serial_port_in_use(self.control_interface):
+                raise ModemInUseException("Serial port already open")
+            self.at.open()
+
+    def at_command(self, command, timeout=None):
         """
-        Sends an AT command to a modem and returns the response.
+        Sends an AT command and returns as soon as the modem gives its final result code.
 
         Returns:
-            list: The response from the modem.
+            ATResponse, or None if the modem could not be reached.
         """
-        response = bytes()
-
-
         try:
-            # Check port isn't already open. Some processes, like ModemManager, open in non-exclusive mode that pyserial can't detect
-            if self.is_serial_port_in_use(CONTROL_INTERFACE):
-                raise ModemInUseException("Serial port already open")
+            self._open_session()
+            if timeout is None:
+                return self.at.command(command)
+            return self.at.command(command, timeout)
+        except (serial.SerialException, ATError) as e:
+            logger.error("Failed to send AT command %s: %s", command, e)
+            return None
 
-            # Open the serial port
-            with serial.Serial(CONTROL_INTERFACE, CONTROL_INTERFACE_BAUD, timeout=CONTROL_INTERFACE_TIMEOUT) as ser:
-                ser.write(("ATE0\r\n").encode())
-                time.sleep(0.1)
-                ser.read_all()
-                time.sleep(0.5)
-                ser.write((command + "\r\n").encode())
-                time.sleep(0.5)
-                response = ser.read_all()
+    def at_batch(self, commands):
+        """
+        Sends several AT commands as one command line, costing a single round trip.
+        The modem stops at the first command that fails.
 
-        except serial.SerialException as e:
-            logger.error("Failed to send AT command: %s", e)
-            return None 
+        Returns:
+            ATResponse holding the lines of all of the commands, or None if the modem could not be reached.
+        """
+        try:
+            self._open_session()
+            return self.at.batch(commands)
+        except (serial.SerialException, ATError) as e:
+            logger.error("Failed to send AT commands %s: %s", commands, e)
+            return None
 
-        logger.debug("AT command: %s, response: %s", command, response)
-        s = response.decode('utf-8')
-        lines = s.splitlines()
-        filtered_lines = [line for line in lines if line.strip()] 
+    def send_at_command(self, command):
+        """
+        Sends an AT command to a modem and returns the response.
 
-        logger.debug(filtered_lines)
-        return filtered_lines
+        Returns:
+            list: The response from the modem, ending with the final result code.
+        """
+        response = self.at_command(command)
+        if response is None:
+            return None
+        return response.lines + [response.final]
    
     def is_responding(self):
         """
@@ -267,9 +268,9 @@ class Modem:
         - True if the modem is responding, False otherwise.
         """
         try:
-            response = self.send_at_command("AT")
-            return "OK" in response
-        except:
+            response = self.at_command("AT")
+            return response is not None and response.ok
+        except ModemInUseException:
             return False
 
     def get_rssi(self):
@@ -280,22 +281,13 @@ class Modem:
         - The signal strength. If 99, there is no signal.
         - None if the modem does not respond to the AT command.
         """
-        response = self.send_at_command("AT+CSQ")
+        response = self.at_command("AT+CSQ")
 
         if response is None:
             return None
 
         logger.debug("Signal strength response: %s", response)
-
-        for item in response:
-            if "+CSQ" in item:
-                try:
-                    rssi = int(item.split(": ")[1].split(",")[0])
-                    if rssi == 99:
-                        logger.warning("No signal - missing antenna?")
-                    return rssi
-                except:
-                    return None
+        return parse_rssi(response)
 
     def get_rssi_dbm(self):
         """
@@ -305,14 +297,7 @@ class Modem:
         - The signal strength in dBm.
         - None if the modem does not respond to the AT command.
         """
-        rssi = self.get_rssi()
-
-        if rssi == 99:
-            return None 
-
-        if rssi is not None:
-            return -113 + 2 * rssi
-        return None
+        return rssi_to_dbm(self.get_rssi())
 
     def get_sim_ccid(self):
         """
@@ -322,23 +307,31 @@ class Modem:
         - The ICCID string.
         - None if the modem does not respond to the AT command or if the SIM card is not present.
         """
-        response = self.send_at_command("AT+CCID?")
-
-        if response is None:
-            return None
+        response = self.at_command("AT+CCID?")
 
-        if "ERROR" in response:
+        if response is None or not response.ok:
             return None
 
         logger.debug("SIM CCID response: %s", response)
+        return parse_ccid(response)
 
-        for item in response:
-            if "+CCID" in item:
-                try:
-                    return int(item.split(": ")[1])
-                except:
-                    return None
+    def get_status(self):
+        """
+        Get the modem's status with a single batch of AT commands.
 
+        Returns:
+        - A dict of 'responding', 'rssi', 'rssi_dbm' and 'ccid'. Values that couldn't be read are None.
+        """
+        # CCID goes last as it fails without a SIM card, which would stop any commands after it
+        response = self.at_batch(["AT+CSQ", "AT+CCID?"])
+
+        rssi = parse_rssi(response) if response is not None else None
+        return {
+            'responding': response is not None,
+            'rssi': rssi,
+            'rssi_dbm': rssi_to_dbm(rssi),
+            'ccid': parse_ccid(response) if response is not None and response.ok else None,
+        }
 
 
     def sim_present(self):
@@ -348,4 +341,86 @@ class Modem:
         Returns:
         - True if a SIM card is present, False otherwise.
         """
-        return self.get_sim_ccid() is not None
\ No newline at end of file
+        return self.get_sim_ccid() is not None
+
+    def enable_cell_info(self):
+        """
+        Have the registration status include the area code and cell ID. The modes last until
+        the modem is powered off, so this is sent once per session rather than with every query.
+
+        Returns:
+        - True if the modes were set, or ModemManager has the control interface (and mmcli is asked instead).
+        """
+        try:
+            response = self.at_batch(["AT+CREG=2", "AT+CEREG=2"])
+        except ModemInUseException:
+            return True
+        return response is not None and response.ok
+
+    def get_telemetry(self):
+        """
+        Get the signal and network state with a single batch of AT commands. If ModemManager
+        has the control interface, it is asked through mmcli instead. The area code and cell ID
+        are only reported after enable_cell_info().
+
+        Returns:
+        - A dict of 'rssi', 'rssi_dbm', 'registration', 'technology', 'operator', 'lac' and 'cell_id'.
+          Values that couldn't be read are None.
+        - None if the modem could not be reached.
+        """
+        try:
+            response = self.at_batch(["AT+CSQ", "AT+CREG?", "AT+CEREG?", "AT+COPS?"])
+        except ModemInUseException:
+            return self.get_telemetry_mmcli()
+
+        if response is None:
+            return None
+
+        rssi = parse_rssi(response)
+        operator, technology = parse_operator(response)
+        telemetry = {'rssi': rssi, 'rssi_dbm': rssi_to_dbm(rssi), 'registration': None,
+                     'technology': technology, 'operator': operator, 'lac': None, 'cell_id': None}
+
+        # Prefer the LTE registration, unless only registered on 2G/3G
+        reg = parse_registration(response, "+CEREG")
+        if reg is None or reg['registration'] not in ("home", "roaming"):
+            reg = parse_registration(response, "+CREG") or reg
+        if reg is not None:
+            telemetry.update({k: v for k, v in reg.items() if v is not None})
+        return telemetry
+
+    def get_telemetry_mmcli(self):
+        """
+        Get the signal and network state from ModemManager
+
+        Returns:
+        - A dict as get_telemetry(), or None if mmcli failed.
+        """
+        try:
+            res = subprocess.run(["mmcli", "-m", "any", "--output-keyvalue"], capture_output=True,
+                                 encoding="utf-8", timeout=MMCLI_TIMEOUT, check=True)
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.error("Failed to get modem state from ModemManager: %s", e)
+            return None
+
+        values = {}
+        for line in res.stdout.splitlines():
+            key, _, value = line.partition(":")
+            value = value.strip()
+            values[key.strip()] = None if value in ("", "--") else value
+
+        # ModemManager gives signal quality as a percentage of the CSQ range
+        rssi = None
+        quality = values.get("modem.generic.signal-quality.value")
+        if quality is not None and quality.isdigit():
+            rssi = round(int(quality) * 31 / 100)
+
+        return {
+            'rssi': rssi,
+            'rssi_dbm': rssi_to_dbm(rssi),
+            'registration': values.get("modem.3gpp.registration-state"),
+            'technology': values.get("modem.generic.access-technologies.value[1]"),
+            'operator': values.get("modem.3gpp.operator-name"),
+            'lac': None,
+            'cell_id': None,
+        }
@@ -2,8 +2,8 @@
 
 import logging
 import time
-from smbus2 import SMBus
-import RPi.GPIO as GPIO
+from ..hal import GPIO
+from .i2cbus import get_bus, I2CVerifyError
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +20,7 @@ class PCMD3180:
 
     def __init__(self):
         self.address = I2C_ADDRESS
+        self.bus = get_bus()
         GPIO.setmode(GPIO.BCM)
         GPIO.setwarnings(False)
 
@@ -33,6 +34,8 @@ class PCMD3180:
         GPIO.setup(SHDNZ, GPIO.OUT)
         GPIO.output(SHDNZ, GPIO.HIGH)
         time.sleep(0.5)
+        # Registers are back to their defaults
+        self.bus.invalidate(self.address)
 
     def power_off(self):
         """ Turn off the PCMD3180"""
@@ -40,6 +43,7 @@ class PCMD3180:
         GPIO.setup(SHDNZ, GPIO.OUT)
         GPIO.output(SHDNZ, GPIO.LOW)
         time.sleep(0.1)
+        self.bus.invalidate(self.address)
 
     def reset(self):
         """ Reset the PCMD3180 """
@@ -48,22 +52,18 @@ class PCMD3180:
 
     def write_register(self, reg, data):
         """ Write data to a register over I2C """
-        i2c = SMBus(1)
         try:
-            i2c.write_byte_data(self.address, reg, data)
+            self.bus.write_register(self.address, reg, data)
         except Exception as e:
             logger.error("Failed to write to register %s: %s", reg, e)
-        i2c.close()
 
     def read_register(self, reg):
         """ Read data from a register over I2C """
-        i2c = SMBus(1)
         try:
-            data = i2c.read_byte_data(self.address, reg)
+            data = self.bus.read_register(self.address, reg)
         except Exception as e:
             logger.error("Failed to read from register %s: %s", reg, e)
             data = None
-        i2c.close()
         return data
 
     def send_configuration(self):
@@ -91,6 +91,13 @@ class PCMD3180:
             0x3e: 0xff, # Max volume (27dB)
             0x07: 0x80, # LJ format, 16 bit
         }
-        for reg, data in config_data.items():
-            self.write_register(reg, data)
-        logger.info("Configuration sent.")
+        # Consecutive registers go in one block write, and registers already set are skipped
+        try:
+            written = self.bus.write_registers(self.address, config_data, verify=True)
+        except I2CVerifyError as e:
+            logger.error("PCMD3180 configuration did not read back correctly: %s", e)
+            return
+        except OSError as e:
+            logger.error("Failed to send configuration to PCMD3180: %s", e)
+            return
+        logger.info("Configuration sent (%d of %d registers needed writing).", written, len(config_data))
@@ -0,0 +1,242 @@
+"""
+Simulates the RC7620 modem's AT command interface on a pseudo-terminal.
+
+The pty's path can be given to the Modem driver (or modemctl's --port) in place of
+CONTROL_INTERFACE, so the AT command handling can be tested and benchmarked on any
+Linux machine. The simulator answers the commands buggd uses, with configurable
+response latency, line noise and unsolicited result codes.
+
+Run it on its own with:
+    python -m buggd.drivers.rc7620sim --latency 0.05 --urc-interval 5
+"""
+import logging
+import os
+import pty
+import random
+import select
+import threading
+import time
+import tty
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DEFAULT_CCID = 8944500102198304826
+DEFAULT_RSSI = 20
+DEFAULT_OPERATOR = "EE"
+DEFAULT_LAC = "00C3"
+DEFAULT_CELL_ID = "0A1B2C3D"
+
+# Sent every urc_interval_s, and at random in the middle of responses if noise is on
+URCS = ("+CEREG: 1", "+CREG: 1", "!PCINFO: State:Online")
+
+
+class RC7620Simulator:
+    """
+    A fake RC7620 control interface on a pty
+
+    Args:
+        latency_s: Delay before each response
+        rssi: RSSI returned by AT+CSQ (99 for no signal)
+        ccid: ICCID returned by AT+CCID?, or None for no SIM card
+        urc_interval_s: Send an unsolicited result code this often, or None for never
+        noise: Probability (0-1) of stray blank lines, split writes and URCs within a response
+        seed: Seed for the noise, so runs are repeatable
+        on_powerdown: Called after AT!POWERDOWN, e.g. to take the simulated modem off the USB bus
+    """
+
+    def __init__(self, latency_s=0, rssi=DEFAULT_RSSI, ccid=DEFAULT_CCID, urc_interval_s=None, noise=0, seed=None,
+                 on_powerdown=None):
+        self.latency_s = latency_s
+        self.rssi = rssi
+        self.ccid = ccid
+        self.urc_interval_s = urc_interval_s
+        self.noise = noise
+        self.random = random.Random(seed)
+        self.on_powerdown = on_powerdown
+
+        self.operator = DEFAULT_OPERATOR
+        self.lac = DEFAULT_LAC
+        self.cell_id = DEFAULT_CELL_ID
+        self.registered = True
+
+        self.echo = True
+        self.reg_modes = {"+CREG": 0, "+CEREG": 0}
+        self.powered_down = False
+        self.commands = []
+
+        self.master = None
+        self.slave = None
+        self.port = None
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def start(self):
+        """ Open the pty and start answering commands. Returns the path of the port. """
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name='rc7620sim', daemon=True)
+        self.thread.start()
+        logger.info("Simulated RC7620 control interface on %s", self.port)
+        return self.port
+
+    def stop(self):
+        """ Stop answering and close the pty """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        self.master = self.slave = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _send(self, text):
+        data = text.encode()
+        if self.noise and len(data) > 1 and self.random.random() < self.noise:
+            # Arrive in two parts, as it can over USB
+            split = self.random.randrange(1, len(data))
+            os.write(self.master, data[:split])
+            time.sleep(0.001)
+            data = data[split:]
+        os.write(self.master, data)
+
+    def _line(self, text):
+        if self.noise and self.random.random() < self.noise:
+            text = "\r\n" + text
+        return "\r\n" + text + "\r\n"
+
+    def _run(self):
+        buffer = b""
+        next_urc = time.monotonic() + self.urc_interval_s if self.urc_interval_s else None
+
+        while not self.stop_event.is_set():
+            timeout = 0.05
+            if next_urc is not None:
+                timeout = max(0, min(timeout, next_urc - time.monotonic()))
+
+            readable, _, _ = select.select([self.master], [], [], timeout)
+            if next_urc is not None and time.monotonic() >= next_urc:
+                if not self.powered_down:
+                    self._send(self._line(self.random.choice(URCS)))
+                next_urc += self.urc_interval_s
+
+            if not readable:
+                continue
+            try:
+                buffer += os.read(self.master, 1024)
+            except OSError:
+                break
+
+            while b"\r" in buffer:
+                line, buffer = buffer.split(b"\r", 1)
+                line = line.decode('utf-8', errors='replace').strip()
+                if line and not self.powered_down:
+                    self._handle(line)
+
+    def _handle(self, line):
+        self.commands.append(line)
+        if self.echo:
+            self._send(line + "\r")
+
+        if self.latency_s:
+            time.sleep(self.latency_s)
+
+        if not line.upper().startswith("AT"):
+            self._send(self._line("ERROR"))
+            return
+
+        # Commands can be concatenated with ';'. The first failure ends the line.
+        out = ""
+        final = "OK"
+        for cmd in line[2:].split(';'):
+            result = self._command(cmd.strip().upper())
+            if result is None:
+                final = "ERROR"
+                break
+            if isinstance(result, tuple):
+                final = result[1]
+                break
+            for info in result:
+                out += self._line(info)
+                if self.noise and self.random.random() < self.noise:
+                    out += self._line(self.random.choice(URCS))
+
+        self._send(out + self._line(final))
+
+    def _command(self, cmd):
+        """
+        Answer a single command
+
+        Returns:
+            A list of information lines, (lines, error) for an error result, or None if unknown
+        """
+        if cmd == "":
+            return []
+        if cmd in ("E0", "E1"):
+            self.echo = cmd == "E1"
+            return []
+        if cmd == "+CSQ":
+            return ["+CSQ: {},99".format(self.rssi)]
+        if cmd == "+CCID?":
+            if self.ccid is None:
+                # SIM not inserted
+                return ([], "+CME ERROR: 10")
+            return ["+CCID: {}".format(self.ccid)]
+        if cmd in ("+CREG=0", "+CREG=1", "+CREG=2", "+CEREG=0", "+CEREG=1", "+CEREG=2"):
+            prefix, mode = cmd.split("=")
+            self.reg_modes[prefix] = int(mode)
+            return []
+        if cmd in ("+CREG?", "+CEREG?"):
+            mode = self.reg_modes[cmd[:-1]]
+            # Only registered on LTE
+            stat = 1 if self.registered and cmd == "+CEREG?" else 0
+            if mode == 2 and stat:
+                return ['{}: {},{},"{}","{}",7'.format(cmd[:-1], mode, stat, self.lac, self.cell_id)]
+            return ["{}: {},{}".format(cmd[:-1], mode, stat)]
+        if cmd == "+COPS?":
+            if not self.registered:
+                return ["+COPS: 0"]
+            return ['+COPS: 0,0,"{}",7'.format(self.operator)]
+        if cmd == "!POWERDOWN":
+            self.powered_down = True
+            if self.on_powerdown is not None:
+                self.on_powerdown()
+            return []
+        return None
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Simulate the RC7620 AT command interface on a pty')
+    parser.add_argument('--latency', type=float, default=0, help='Delay before each response, in seconds')
+    parser.add_argument('--rssi', type=int, default=DEFAULT_RSSI)
+    parser.add_argument('--no-sim', action='store_true', help='Behave as if there is no SIM card')
+    parser.add_argument('--urc-interval', type=float, default=None, help='Send an unsolicited result code this often')
+    parser.add_argument('--noise', type=float, default=0, help='Probability of noise within a response')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    sim = RC7620Simulator(latency_s=args.latency, rssi=args.rssi, ccid=None if args.no_sim else DEFAULT_CCID,
+                          urc_interval_s=args.urc_interval, noise=args.noise)
+    with sim:
+        print(sim.port, flush=True)
+        try:
+            while not sim.powered_down:
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
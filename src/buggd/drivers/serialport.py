@@ -0,0 +1,101 @@
+"""
+Checks whether a serial port is open in another process.
+
+ModemManager opens the modem's ports in non-exclusive mode, which pyserial can't detect,
+so we look at ModemManager's open file descriptors directly. Its PIDs are read from its
+systemd cgroup, so only a handful of descriptors are checked rather than every descriptor
+of every process. Our own tools take an advisory lock on the port instead (pyserial's
+``exclusive=True``), so they never need this check.
+"""
+import logging
+import os
+import stat
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+MM_CGROUP_PROCS = "/sys/fs/cgroup/system.slice/ModemManager.service/cgroup.procs"
+MM_PROCESS_NAME = "ModemManager"
+
+
+def find_pids_by_name(name):
+    """ Find processes by name. Only reads /proc/<pid>/comm, so much cheaper than scanning fds """
+    pids = []
+    for pid in os.listdir('/proc'):
+        if pid.isdigit():
+            try:
+                with open('/proc/{}/comm'.format(pid), 'r', encoding='utf-8') as f:
+                    if f.read().strip() == name:
+                        pids.append(pid)
+            except OSError:
+                # Process might have ended
+                continue
+    return pids
+
+
+def find_modemmanager_pids(cgroup_procs=MM_CGROUP_PROCS):
+    """
+    Return the PIDs of ModemManager
+
+    Read from the service's cgroup when running under systemd. Otherwise fall back to
+    looking for the process by name.
+    """
+    try:
+        with open(cgroup_procs, 'r', encoding='utf-8') as f:
+            return f.read().split()
+    except FileNotFoundError:
+        # ModemManager isn't running as a service, or this isn't a systemd cgroup v2 system
+        pass
+    except OSError as e:
+        logger.debug("Could not read %s: %s", cgroup_procs, e)
+
+    return find_pids_by_name(MM_PROCESS_NAME)
+
+
+def pid_has_device_open(pid, rdev):
+    """ Check if a process has the character device with the given device number open """
+    fds_path = '/proc/{}/fd'.format(pid)
+    try:
+        fds = os.listdir(fds_path)
+    except (PermissionError, FileNotFoundError):
+        # Can't see this process's fds, or it has ended
+        return False
+
+    for fd in fds:
+        try:
+            # stat follows the fd symlink to the device node; comparing device numbers
+            # means symlinks such as /dev/tty_modem_command_interface don't need resolving
+            st = os.stat(os.path.join(fds_path, fd))
+        except OSError:
+            # The fd was closed
+            continue
+        if stat.S_ISCHR(st.st_mode) and st.st_rdev == rdev:
+            return True
+    return False
+
+
+def is_port_open_elsewhere(port, pids=None):
+    """
+    Check if a serial port is open in ModemManager (or the given processes)
+
+    Args:
+        port: Path of the port, may be a symlink
+        pids: PIDs to check, ModemManager's by default
+
+    Returns:
+        True if one of the processes has the port open
+    """
+    try:
+        rdev = os.stat(port).st_rdev
+    except FileNotFoundError:
+        # Nobody can have a port open that doesn't exist
+        return False
+
+    if pids is None:
+        pids = find_modemmanager_pids()
+
+    for pid in pids:
+        if pid_has_device_open(pid, rdev):
+            logger.info("Device %s is in use by process %s", port, pid)
+            return True
+    return False
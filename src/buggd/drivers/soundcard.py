@@ -1,7 +1,5 @@
 """ Provides power, phantom power, and gain controls for the soundcard """
 
-import RPi.GPIO as GPIO
-import spidev
 import logging
 import os
 import json
@@ -9,6 +7,7 @@ import subprocess
 import numpy as np
 from scipy.io import wavfile
 from scipy.signal import find_peaks
+from ..hal import GPIO, SpiDev
 from .lock import Lock
 from .pcmd3180 import PCMD3180
 
@@ -56,7 +55,7 @@ class Soundcard:
         self.pcmd3180 = PCMD3180()
         GPIO.setmode(GPIO.BCM)
         GPIO.setwarnings(False) # Squash warning if the pin is already in use
-        self.spi = spidev.SpiDev()
+        self.spi = SpiDev()
         self.spi.open(0, 0)
         self.spi.max_speed_hz = 5_000_000
 
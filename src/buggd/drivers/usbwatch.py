@@ -0,0 +1,127 @@
+"""
+Detects a USB device appearing and disappearing.
+
+Presence is read from sysfs (/sys/bus/usb/devices), which is much cheaper than a libusb
+bus scan. Waits are woken by the kernel's uevents over netlink, so they end as soon as the
+device is added or removed. If the netlink socket can't be opened, sysfs is polled instead.
+"""
+import logging
+import os
+import select
+import socket
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+SYSFS_USB_DEVICES = "/sys/bus/usb/devices"
+
+# Kernel uevent multicast group
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_GROUP_KERNEL = 1
+
+# Used when netlink isn't available, and as a safety net for missed events
+POLL_INTERVAL = 0.25
+EVENT_RECHECK_INTERVAL = 2
+
+
+def _read_attr(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def usb_device_present(vendor_id, product_id, sysfs_dir=SYSFS_USB_DEVICES):
+    """
+    Check sysfs for a USB device
+
+    Returns:
+        True or False, or None if sysfs isn't available
+    """
+    try:
+        entries = os.listdir(sysfs_dir)
+    except OSError:
+        return None
+
+    vendor = '{:04x}'.format(vendor_id)
+    product = '{:04x}'.format(product_id)
+    for entry in entries:
+        # Interfaces (e.g. 1-1:1.0) don't have IDs of their own
+        if ':' in entry:
+            continue
+        base = os.path.join(sysfs_dir, entry)
+        if _read_attr(os.path.join(base, 'idVendor')) == vendor and _read_attr(os.path.join(base, 'idProduct')) == product:
+            return True
+    return False
+
+
+def open_uevent_socket():
+    """ Subscribe to kernel uevents. Returns None if it isn't possible (e.g. not Linux, or no permission) """
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        sock.bind((0, UEVENT_GROUP_KERNEL))
+        sock.setblocking(False)
+        return sock
+    except (AttributeError, OSError) as e:
+        logger.debug("Netlink uevents unavailable, polling sysfs instead: %s", e)
+        return None
+
+
+def _is_usb_add_remove(msg):
+    """ Check if a kernel uevent is a USB device being added or removed """
+    # Kernel messages are "action@devpath" followed by NUL separated KEY=value pairs
+    fields = msg.split(b'\0')
+    return fields[0].split(b'@')[0] in (b'add', b'remove') and b'SUBSYSTEM=usb' in fields
+
+
+def wait_for_usb_device(vendor_id, product_id, present, timeout, check=None, events=True):
+    """
+    Wait for a USB device to appear (present=True) or disappear (present=False)
+
+    Args:
+        vendor_id, product_id: The device to wait for
+        present: The state to wait for
+        timeout: How long to wait in seconds
+        check: Function returning whether the device is present, usb_device_present by default
+        events: Wake on kernel uevents. Without them, check is polled, e.g. for a simulated device.
+
+    Returns:
+        True if the device reached the state within the timeout
+    """
+    if check is None:
+        check = lambda: usb_device_present(vendor_id, product_id)
+
+    deadline = time.monotonic() + timeout
+
+    # Subscribe before the first check, so an event between the two isn't missed
+    sock = open_uevent_socket() if events else None
+    try:
+        while True:
+            if check() == present:
+                return True
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            if sock is None:
+                time.sleep(min(POLL_INTERVAL, remaining))
+                continue
+
+            # Wait for a USB add/remove, rechecking now and then in case an event was missed
+            wait_until = time.monotonic() + min(EVENT_RECHECK_INTERVAL, remaining)
+            while True:
+                readable, _, _ = select.select([sock], [], [], max(0, wait_until - time.monotonic()))
+                if not readable:
+                    break
+                try:
+                    msg = sock.recv(8192)
+                except BlockingIOError:
+                    continue
+                if _is_usb_add_remove(msg):
+                    break
+    finally:
+        if sock is not None:
+            sock.close()
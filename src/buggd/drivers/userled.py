@@ -1,5 +1,5 @@
 """ Tiny driver for the user LED on the main PCB """
-import RPi.GPIO as GPIO
+from ..hal import GPIO
 
 USER_LED_PIN = 13
 
@@ -0,0 +1,97 @@
+"""
+Hardware abstraction layer.
+
+The drivers get their GPIO, SPI, I2C and USB access from here rather than importing
+RPi.GPIO, spidev, smbus2 and pyusb themselves. The backend is chosen once at startup:
+
+    hardware: The real libraries, imported when first used (the default)
+    sim:      Simulated peripherals that record every pin and register transaction with
+              a timestamp, so the drivers and daemon can run on any Linux machine
+
+Choose with select(), or the BUGGD_HAL environment variable. Select before any driver
+touches the hardware, since drivers hold on to the handles they open.
+
+    from buggd.hal import GPIO, SpiDev, SMBus
+"""
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+HARDWARE = 'hardware'
+SIM = 'sim'
+BACKENDS = (HARDWARE, SIM)
+
+ENV_VAR = 'BUGGD_HAL'
+
+_backend = None
+_lock = threading.Lock()
+
+
+def select(name=None, **kwargs):
+    """
+    Choose the backend
+
+    Args:
+        name: 'hardware' or 'sim', or None to use $BUGGD_HAL (hardware if it isn't set)
+        kwargs: Options for the backend, e.g. the clock for the sim backend
+
+    Returns:
+        The backend
+    """
+    global _backend
+
+    if name is None:
+        name = os.environ.get(ENV_VAR, HARDWARE)
+    if name not in BACKENDS:
+        raise ValueError('Unknown HAL backend {}, expected one of {}'.format(name, ', '.join(BACKENDS)))
+
+    with _lock:
+        if name == SIM:
+            from .sim import SimBackend
+            _backend = SimBackend(**kwargs)
+        else:
+            from .hardware import HardwareBackend
+            _backend = HardwareBackend(**kwargs)
+
+    logger.info('Using the {} HAL backend'.format(name))
+    return _backend
+
+
+def backend():
+    """ The selected backend, selecting the default if there isn't one yet """
+    if _backend is None:
+        select()
+    return _backend
+
+
+def is_simulated():
+    """ Check if the simulated backend is selected """
+    return backend().name == SIM
+
+
+class _GPIOProxy:
+    """ Looks like the RPi.GPIO module, and forwards to the selected backend's GPIO """
+
+    def __getattr__(self, name):
+        return getattr(backend().gpio, name)
+
+
+GPIO = _GPIOProxy()
+
+
+def SpiDev():
+    """ A new SPI device handle, like spidev.SpiDev() """
+    return backend().spi_dev()
+
+
+def SMBus(bus_num):
+    """ An open handle on an I2C bus, like smbus2.SMBus(bus_num) """
+    return backend().smbus(bus_num)
+
+
+def usb_device_present(vendor_id, product_id):
+    """ Check if a USB device is enumerated """
+    return backend().usb_device_present(vendor_id, product_id)
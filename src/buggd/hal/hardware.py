@@ -0,0 +1,39 @@
+"""
+The production HAL backend, on the Raspberry Pi's peripherals.
+
+The libraries are imported when first used, so that nothing but the hardware itself
+needs them installed.
+"""
+from ..drivers.usbwatch import usb_device_present as sysfs_usb_device_present
+
+
+class HardwareBackend:
+    """ GPIO, SPI, I2C and USB through RPi.GPIO, spidev, smbus2 and pyusb """
+
+    name = 'hardware'
+
+    def __init__(self):
+        self._gpio = None
+
+    @property
+    def gpio(self):
+        if self._gpio is None:
+            import RPi.GPIO
+            self._gpio = RPi.GPIO
+        return self._gpio
+
+    def spi_dev(self):
+        import spidev
+        return spidev.SpiDev()
+
+    def smbus(self, bus_num):
+        from smbus2 import SMBus
+        return SMBus(bus_num)
+
+    def usb_device_present(self, vendor_id, product_id):
+        present = sysfs_usb_device_present(vendor_id, product_id)
+        if present is None:
+            # No sysfs, so fall back to scanning the bus
+            import usb.core
+            return usb.core.find(idVendor=vendor_id, idProduct=product_id) is not None
+        return present
@@ -0,0 +1,381 @@
+"""
+The simulated HAL backend.
+
+Each peripheral behaves closely enough to the real one for the drivers to run unchanged,
+including RPi.GPIO's errors when a pin is used before it is set up. Every pin, SPI, I2C
+and USB transaction goes into a TransactionLog with a timestamp, so tests can check the
+order and timing of the drivers' hardware sequencing.
+
+The board is partly modelled: the modem enumerates on USB a few seconds after being
+strobed on (and disappears when its rail is cut, it is reset or it is powered down), and
+the PCMD3180's registers go back to their defaults when it is shut down.
+"""
+import collections
+import errno
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Devices that answer on each I2C bus: the LED controller, I2S bridge and RTC
+SIM_I2C_DEVICES = {1: (0x23, 0x4c, 0x68)}
+
+# How long the simulated modem takes to enumerate after POWER_ON_N
+SIM_MODEM_BOOT_S = 5
+
+
+Transaction = collections.namedtuple('Transaction', ['t', 'bus', 'address', 'op', 'data'])
+Transaction.__doc__ = """ One hardware access: when, on which bus and device, what, and the data written or read """
+
+
+class TransactionLog:
+    """
+    A timestamped record of every hardware access
+
+    Args:
+        clock: Returns the time in seconds for each record
+        maxlen: Keep only the most recent maxlen records, or None to keep all of them
+    """
+
+    def __init__(self, clock=time.monotonic, maxlen=None):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = collections.deque(maxlen=maxlen)
+
+    def record(self, bus, address, op, data=None):
+        with self.lock:
+            self.entries.append(Transaction(self.clock(), bus, address, op, data))
+
+    def find(self, bus=None, address=None, op=None):
+        """ Records matching all of the given fields, oldest first """
+        with self.lock:
+            return [e for e in self.entries
+                    if (bus is None or e.bus == bus)
+                    and (address is None or e.address == address)
+                    and (op is None or e.op == op)]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def dump(self, path):
+        """ Write the records to a file, one JSON object per line """
+        with self.lock:
+            entries = list(self.entries)
+        with open(path, 'w', encoding='utf-8') as f:
+            for e in entries:
+                f.write(json.dumps(e._asdict()) + '\n')
+
+
+class SimGPIO:
+    """ Stands in for the RPi.GPIO module """
+
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+
+    def __init__(self, log):
+        self.log = log
+        self.lock = threading.RLock()
+        self.mode = None
+        self.directions = {}    # pin -> IN or OUT, for pins that have been set up
+        self.levels = {}        # pin -> level driven by us or, for inputs, from outside
+        self.watchers = collections.defaultdict(list)
+
+    def watch(self, pin, callback):
+        """ Call callback(pin, level) whenever the level we drive on a pin changes """
+        self.watchers[pin].append(callback)
+
+    def _check_mode(self):
+        if self.mode is None:
+            raise RuntimeError('Please set pin numbering mode using GPIO.setmode(GPIO.BOARD) or GPIO.setmode(GPIO.BCM)')
+
+    def _drive(self, pin, level):
+        """ Change the level of an output, calling the watchers if it changed """
+        with self.lock:
+            changed = self.levels.get(pin, self.LOW) != level
+            self.levels[pin] = level
+        if changed:
+            for callback in self.watchers[pin]:
+                callback(pin, level)
+
+    def setmode(self, mode):
+        with self.lock:
+            if self.mode is not None and self.mode != mode:
+                raise ValueError('A different mode has already been set!')
+            self.mode = mode
+        self.log.record('gpio', None, 'setmode', mode)
+
+    def getmode(self):
+        return self.mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=PUD_OFF, initial=-1):
+        self._check_mode()
+        with self.lock:
+            self.directions[pin] = direction
+            if direction == self.IN:
+                self.levels.setdefault(pin, self.HIGH if pull_up_down == self.PUD_UP else self.LOW)
+        self.log.record('gpio', pin, 'setup', [direction, initial])
+        if direction == self.OUT and initial != -1:
+            self._drive(pin, initial)
+
+    def output(self, pin, value):
+        self._check_mode()
+        if self.directions.get(pin) != self.OUT:
+            raise RuntimeError('The GPIO channel has not been set up as an OUTPUT')
+        level = self.HIGH if value else self.LOW
+        self.log.record('gpio', pin, 'output', level)
+        self._drive(pin, level)
+
+    def input(self, pin):
+        self._check_mode()
+        if pin not in self.directions:
+            raise RuntimeError('You must setup() the GPIO channel first')
+        level = self.levels.get(pin, self.LOW)
+        self.log.record('gpio', pin, 'input', level)
+        return level
+
+    def gpio_function(self, pin):
+        self._check_mode()
+        return self.directions.get(pin, self.IN)
+
+    def set_input(self, pin, level):
+        """ Drive an input from outside, e.g. a button """
+        with self.lock:
+            self.levels[pin] = level
+
+    def cleanup(self, pin=None):
+        """ As RPi.GPIO, return the pins we set up to inputs and forget the numbering mode """
+        with self.lock:
+            pins = list(self.directions) if pin is None else [pin]
+            for p in pins:
+                self.directions.pop(p, None)
+            if pin is None:
+                self.mode = None
+        self.log.record('gpio', pin, 'cleanup')
+        # Outputs are released, so whatever they drove goes away
+        for p in pins:
+            self._drive(p, self.LOW)
+
+
+class SimSpiDev:
+    """ Stands in for spidev.SpiDev. Reads back zeros. """
+
+    def __init__(self, log):
+        self.log = log
+        self.bus = None
+        self.max_speed_hz = 0
+        self.mode = 0
+
+    def open(self, bus, device):
+        self.bus = 'spi{}.{}'.format(bus, device)
+        self.log.record(self.bus, None, 'open')
+
+    def close(self):
+        if self.bus is not None:
+            self.log.record(self.bus, None, 'close')
+            self.bus = None
+
+    def xfer(self, data):
+        if self.bus is None:
+            raise OSError(errno.EBADF, 'SPI device is not open')
+        self.log.record(self.bus, None, 'xfer', list(data))
+        return [0] * len(data)
+
+    xfer2 = xfer
+
+    def writebytes(self, data):
+        self.xfer(data)
+
+
+class SimI2CDevice:
+    """ A register-based I2C device. read_byte and write_byte act on a port, as an IO expander's. """
+
+    def __init__(self, address):
+        self.address = address
+        self.port = 0xFF
+        self.registers = bytearray(256)
+
+    def reset(self):
+        self.port = 0xFF
+        self.registers = bytearray(256)
+
+
+class SimSMBus:
+    """ Stands in for smbus2.SMBus, on the backend's simulated devices """
+
+    def __init__(self, backend, bus_num):
+        self.backend = backend
+        self.bus = 'i2c-{}'.format(bus_num)
+        self.devices = backend.i2c_devices.setdefault(bus_num, {})
+        self.backend.log.record(self.bus, None, 'open')
+
+    def _device(self, addr):
+        device = self.devices.get(addr)
+        if device is None:
+            # What smbus2 gets from the kernel when nothing ACKs
+            raise OSError(errno.EREMOTEIO, 'Remote I/O error')
+        return device
+
+    def _record(self, addr, op, data):
+        self.backend.log.record(self.bus, addr, op, data)
+
+    def close(self):
+        self.backend.log.record(self.bus, None, 'close')
+
+    def read_byte(self, addr, force=None):
+        value = self._device(addr).port
+        self._record(addr, 'read_byte', value)
+        return value
+
+    def write_byte(self, addr, value, force=None):
+        self._device(addr).port = value & 0xFF
+        self._record(addr, 'write_byte', value)
+
+    def read_byte_data(self, addr, reg, force=None):
+        value = self._device(addr).registers[reg]
+        self._record(addr, 'read_byte_data', [reg, value])
+        return value
+
+    def write_byte_data(self, addr, reg, value, force=None):
+        self._device(addr).registers[reg] = value & 0xFF
+        self._record(addr, 'write_byte_data', [reg, value])
+
+    def read_i2c_block_data(self, addr, reg, length, force=None):
+        device = self._device(addr)
+        data = [device.registers[(reg + i) & 0xFF] for i in range(length)]
+        self._record(addr, 'read_i2c_block_data', [reg] + data)
+        return data
+
+    def write_i2c_block_data(self, addr, reg, data, force=None):
+        device = self._device(addr)
+        for i, value in enumerate(data):
+            device.registers[(reg + i) & 0xFF] = value & 0xFF
+        self._record(addr, 'write_i2c_block_data', [reg] + list(data))
+
+
+class SimModem:
+    """
+    Models the modem's power sequencing: it enumerates boot_s after POWER_ON_N is strobed
+    with the 3.7V rail on, and disappears when the rail is cut, it is reset, or it is told
+    to power down.
+
+    Time is taken from the backend's clock, and the modem is only brought up when the bus
+    is next looked at, so it follows a simulated clock as well as the real one.
+    """
+
+    def __init__(self, backend, boot_s=SIM_MODEM_BOOT_S):
+        from ..drivers import modem
+
+        self.backend = backend
+        self.boot_s = boot_s
+        self.id = (modem.VENDOR_ID, modem.PRODUCT_ID)
+        self.rail_pin = modem.P3V7_EN
+        self.lock = threading.Lock()
+        self.boot_at = None         # When it will enumerate, while booting
+        self.enumerated_at = None   # When it enumerated, while it is up
+
+        # The simulated AT interface, if any, which goes quiet while the modem is down
+        self.at_sim = None
+
+        backend.gpio.watch(modem.P3V7_EN, self._on_rail)
+        backend.gpio.watch(modem.POWER_ON_N, self._on_power_on)
+        backend.gpio.watch(modem.RESET_IN_N, self._on_reset)
+
+    def _on_rail(self, pin, level):
+        if not level:
+            self.power_down()
+
+    def _on_power_on(self, pin, level):
+        with self.lock:
+            if level and self.backend.gpio.levels.get(self.rail_pin) and self.boot_at is None and self.enumerated_at is None:
+                self.boot_at = self.backend.log.clock() + self.boot_s
+
+    def _on_reset(self, pin, level):
+        if level:
+            self.power_down()
+
+    def update(self):
+        """ Enumerate if the modem has finished booting """
+        with self.lock:
+            if self.boot_at is None or self.backend.log.clock() < self.boot_at:
+                return
+            self.boot_at = None
+            self.enumerated_at = self.backend.log.clock()
+            if self.at_sim is not None:
+                self.at_sim.powered_down = False
+        self.backend.usb_add(*self.id)
+
+    def power_down(self):
+        """ The modem shuts down, e.g. after AT!POWERDOWN """
+        with self.lock:
+            self.boot_at = None
+            self.enumerated_at = None
+            if self.at_sim is not None:
+                self.at_sim.powered_down = True
+        self.backend.usb_remove(*self.id)
+
+
+class SimBackend:
+    """
+    Simulated GPIO, SPI, I2C and USB, sharing one TransactionLog
+
+    Args:
+        clock: Timestamps for the log
+    """
+
+    name = 'sim'
+
+    def __init__(self, clock=time.monotonic):
+        self.log = TransactionLog(clock)
+        self.gpio = SimGPIO(self.log)
+        self.i2c_devices = {bus: {addr: SimI2CDevice(addr) for addr in addrs}
+                            for bus, addrs in SIM_I2C_DEVICES.items()}
+        self.usb_devices = set()
+        self.usb_lock = threading.Lock()
+
+        self.modem = SimModem(self)
+
+        # The PCMD3180 resets its registers when shut down
+        from ..drivers import pcmd3180
+        bridge = self.i2c_devices[1][pcmd3180.I2C_ADDRESS]
+        self.gpio.watch(pcmd3180.SHDNZ, lambda pin, level: level or bridge.reset())
+
+    def spi_dev(self):
+        return SimSpiDev(self.log)
+
+    def smbus(self, bus_num):
+        return SimSMBus(self, bus_num)
+
+    def usb_device_present(self, vendor_id, product_id):
+        self.modem.update()
+        with self.usb_lock:
+            return (vendor_id, product_id) in self.usb_devices
+
+    def usb_add(self, vendor_id, product_id):
+        """ Enumerate a device """
+        with self.usb_lock:
+            if (vendor_id, product_id) in self.usb_devices:
+                return
+            self.usb_devices.add((vendor_id, product_id))
+        self.log.record('usb', '{:04x}:{:04x}'.format(vendor_id, product_id), 'add')
+
+    def usb_remove(self, vendor_id, product_id):
+        """ Disconnect a device """
+        with self.usb_lock:
+            if (vendor_id, product_id) not in self.usb_devices:
+                return
+            self.usb_devices.discard((vendor_id, product_id))
+        self.log.record('usb', '{:04x}:{:04x}'.format(vendor_id, product_id), 'remove')
@@ -2,4 +2,5 @@
 # This does need to be edited as classes are added
 from .sensorbase import SensorBase
 from .i2smic import I2SMic
-from .externalmic import ExternalMic
\ No newline at end of file
+from .externalmic import ExternalMic
+from .simmic import SimMic
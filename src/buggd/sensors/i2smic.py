@@ -1,8 +1,12 @@
 import os
+import time
 import shutil
 import logging
 import datetime
 from buggd.apps.buggd.utils import call_cmd_line
+from buggd.apps.buggd.checksums import stage_with_checksums
+from buggd.apps.buggd.manifest import manifests
+from buggd.apps.buggd.journal import journal, CAPTURE_START, CAPTURE_END, TRIM, ENCODE_START, ENCODE_END
 from buggd.drivers.soundcard import Soundcard
 from .option import set_option
 from .sensorbase import SensorBase
@@ -106,14 +110,20 @@ class I2SMic(SensorBase):
         wfile = os.path.join(self.working_dir, self.working_file)
         wfile_trimmed = os.path.join(self.working_dir, 'trimmed_{}'.format(self.working_file))
 
+        journal.event(CAPTURE_START, uncomp_f_name, record_length=self.record_length)
+
         # Record audio at given freq and duration using the arecord command
         rec_cmd = 'sudo arecord --device plughw:{},0 -c1 --rate {} --format S32_LE --duration {} {}'
         call_cmd_line(rec_cmd.format(self.capture_card, self.record_freq, self.record_length + self.rec_start_trim_secs, wfile))
 
+        journal.event(CAPTURE_END, uncomp_f_name)
+
         # Trim the first N seconds of audio to remove the 'popping' sound
+        trim_start_t = time.monotonic()
         trim_cmd = 'ffmpeg -y -loglevel panic -i {} -ss {} {} >/dev/null 2>&1'
         call_cmd_line(trim_cmd.format(wfile, self.rec_start_trim_secs, wfile_trimmed))
         os.remove(wfile)
+        journal.event(TRIM, uncomp_f_name, duration_s=round(time.monotonic() - trim_start_t, 3))
 
         # Move the recorded (and trimmed) file to a location where it will get compressed
         shutil.move(wfile_trimmed, os.path.join(self.working_dir, uncomp_f_name))
@@ -131,22 +141,45 @@ class I2SMic(SensorBase):
         # current working file
         uncomp_path = os.path.join(self.working_dir, uncomp_f_name)
 
+        encode_start_t = time.monotonic()
+        journal.event(ENCODE_START, uncomp_f_name, compress=self.compress_data)
+
         if self.compress_data == True:
             # Compress the raw audio file to mp3 format
-            comp_path = os.path.join(self.data_dir, uncomp_f_name) + '.mp3'
+            out_path = os.path.join(self.data_dir, uncomp_f_name) + '.mp3'
+            enc_path = os.path.join(self.working_dir, uncomp_f_name) + '.mp3'
             logger.info('{} - Starting compression'.format(uncomp_f_name))
             cmd = ('ffmpeg -loglevel panic -i {} -codec:a libmp3lame -filter:a "volume={}" -qscale:a 0 -ac 1 {} >/dev/null 2>&1') # VBR compression
             #cmd = ('ffmpeg -loglevel panic -i {} -codec:a libmp3lame -filter:a "volume=5" -b:a 192k -ac 1 {} >/dev/null 2>&1') # CBR compression
-            call_cmd_line(cmd.format(uncomp_path, self.amplification, comp_path))
-            logger.info('{} - Finished audio compression'.format(uncomp_f_name))
+            call_cmd_line(cmd.format(uncomp_path, self.amplification, enc_path))
 
         else:
             # Don't compress but still amplify the audio and store as WAV
             logger.info('{} - No compression of audio data, just amplification'.format(uncomp_f_name))
             out_path = os.path.join(self.data_dir, uncomp_f_name) + '.wav'
+            enc_path = os.path.join(self.working_dir, uncomp_f_name) + '.wav'
             cmd = ('ffmpeg -loglevel panic -i {} -filter:a "volume={}" {} >/dev/null 2>&1')
-            call_cmd_line(cmd.format(uncomp_path, self.amplification, out_path))
-            logger.info('{} - Finished audio amplification'.format(uncomp_f_name))
+            call_cmd_line(cmd.format(uncomp_path, self.amplification, enc_path))
+
+        # ffmpeg's errors go to /dev/null, so a failure only shows as a missing or empty file
+        if not os.path.exists(enc_path) or os.path.getsize(enc_path) == 0:
+            logger.error('{} - Encoding failed, discarding the segment'.format(uncomp_f_name))
+            journal.event(ENCODE_END, uncomp_f_name, bytes=0, error='encode failed',
+                          duration_s=round(time.monotonic() - encode_start_t, 3))
+            for path in (uncomp_path, enc_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            if cmd_on_complete:
+                call_cmd_line(cmd_on_complete)
+            return
+
+        # Copy into the data directory, hashing on the way so the SD card is never read back
+        hashes = stage_with_checksums(enc_path, out_path)
+        manifests.add_segment(out_path, uncomp_f_name, self.record_length, 1, hashes['bytes'], hashes['crc32c'])
+        logger.info('{} - Finished audio {}'.format(uncomp_f_name, 'compression' if self.compress_data else 'amplification'))
+
+        journal.event(ENCODE_END, uncomp_f_name, bytes=hashes['bytes'],
+                      duration_s=round(time.monotonic() - encode_start_t, 3))
 
         # Remove the old working file
         if os.path.exists(uncomp_path):
@@ -0,0 +1,150 @@
+"""
+A synthetic audio source, used by buggd --simulate.
+
+It takes as long to record as a real microphone, and stages files of a realistic size
+through the same checksum and manifest path as I2SMic, but doesn't touch the soundcard
+or run arecord and ffmpeg.
+"""
+import os
+import time
+import logging
+import datetime
+from buggd.apps.buggd.utils import call_cmd_line
+from buggd.apps.buggd.checksums import stage_with_checksums
+from buggd.apps.buggd.manifest import manifests
+from buggd.apps.buggd.journal import journal, CAPTURE_START, CAPTURE_END, ENCODE_START, ENCODE_END
+from .option import set_option
+from .sensorbase import SensorBase
+
+logger = logging.getLogger(__name__)
+
+# Synthetic data is a random block, repeated
+BLOCK_BYTES = 1024 * 1024
+
+# Bytes per sample of the 32 bit WAVs recorded by I2SMic
+WAV_SAMPLE_BYTES = 4
+WAV_HEADER_BYTES = 44
+
+
+class SimMic(SensorBase):
+
+    def __init__(self, config=None):
+        """
+        A synthetic microphone that takes the same options as I2SMic
+
+        Args:
+            config: A dictionary loaded from a config JSON file used to replace
+            the default settings of the sensor.
+        """
+
+        opts = self.options()
+        opts = {var['name']: var for var in opts}
+
+        self.record_length = set_option('record_length', config, opts)
+        self.record_freq = set_option('record_freq', config, opts)
+        self.compress_data = set_option('compress_data', config, opts)
+        self.capture_delay = set_option('capture_delay', config, opts)
+        self.sim_mp3_kbps = set_option('sim_mp3_kbps', config, opts)
+
+        self.rec_start_trim_secs = 1
+        self.working_dir = None
+        self.data_dir = None
+        self.server_sync_interval = self.record_length + self.capture_delay
+        self.block = os.urandom(BLOCK_BYTES)
+
+    @staticmethod
+    def options():
+        """
+        Static method defining the config options and defaults for the sensor class
+        """
+        return [{'name': 'record_length',
+                 'type': int,
+                 'default': 1200,
+                 'prompt': 'What is the time in seconds of the audio segments?'},
+                {'name': 'record_freq',
+                 'type': int,
+                 'default': 44100,
+                 'prompt': 'At what frequency should we sample?'},
+                {'name': 'compress_data',
+                 'type': bool,
+                 'default': True,
+                 'prompt': 'Should the audio data be compressed from WAV to VBR mp3?'},
+                {'name': 'capture_delay',
+                 'type': int,
+                 'default': 0,
+                 'prompt': 'How long should the system wait between audio samples?'},
+                {'name': 'sim_mp3_kbps',
+                 'type': int,
+                 'default': 128,
+                 'prompt': 'What is the average bitrate of the compressed audio?'}
+                ]
+
+    def setup(self):
+        return True
+
+    def capture_data(self, working_dir, data_dir):
+        """
+        Wait for as long as a recording takes, and name it as I2SMic would
+
+        Args:
+            working_dir: A working directory to use for the recorded uncompressed file
+            data_dir: The directory to write the final data file to
+        """
+
+        self.working_dir = working_dir
+        self.data_dir = data_dir
+
+        start_time_dt = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.rec_start_trim_secs)
+        # As I2SMic, keeping the milliseconds even when they are zero, as they always are on a virtual clock
+        start_time = start_time_dt.isoformat(timespec='milliseconds')+'Z'
+        start_time = start_time.replace(':','_')
+        uncomp_f_name = '{}'.format(start_time)
+
+        logger.info('Started synthetic recording at {} for {}s'.format(start_time, self.record_length))
+        journal.event(CAPTURE_START, uncomp_f_name, record_length=self.record_length)
+        time.sleep(self.record_length + self.rec_start_trim_secs)
+        journal.event(CAPTURE_END, uncomp_f_name)
+
+        # Only a placeholder, as the size of the raw audio doesn't matter
+        with open(os.path.join(self.working_dir, uncomp_f_name), 'wb') as f:
+            f.write(self.block[:WAV_HEADER_BYTES])
+
+        logger.info('{} - Finished recording'.format(uncomp_f_name))
+        return uncomp_f_name
+
+    def postprocess(self, uncomp_f_name, cmd_on_complete=None):
+        """
+        Write a file of the size the encoder would have produced and stage it to upload
+        """
+
+        uncomp_path = os.path.join(self.working_dir, uncomp_f_name)
+
+        encode_start_t = time.monotonic()
+        journal.event(ENCODE_START, uncomp_f_name, compress=self.compress_data)
+
+        if self.compress_data:
+            ext = '.mp3'
+            n_bytes = self.record_length * self.sim_mp3_kbps * 1000 // 8
+        else:
+            ext = '.wav'
+            n_bytes = WAV_HEADER_BYTES + self.record_length * self.record_freq * WAV_SAMPLE_BYTES
+
+        enc_path = os.path.join(self.working_dir, uncomp_f_name) + ext
+        out_path = os.path.join(self.data_dir, uncomp_f_name) + ext
+        with open(enc_path, 'wb') as f:
+            remaining = n_bytes
+            while remaining > 0:
+                f.write(self.block[:remaining])
+                remaining -= BLOCK_BYTES
+
+        hashes = stage_with_checksums(enc_path, out_path)
+        manifests.add_segment(out_path, uncomp_f_name, self.record_length, 1, hashes['bytes'], hashes['crc32c'])
+        logger.info('{} - Finished synthetic encoding'.format(uncomp_f_name))
+        journal.event(ENCODE_END, uncomp_f_name, bytes=hashes['bytes'],
+                      duration_s=round(time.monotonic() - encode_start_t, 3))
+
+        if os.path.exists(uncomp_path):
+            os.remove(uncomp_path)
+
+        if cmd_on_complete:
+            call_cmd_line(cmd_on_complete)
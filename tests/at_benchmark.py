@@ -0,0 +1,69 @@
+"""
+Benchmark of AT command round trips against the simulated RC7620.
+
+Compares the original way of sending a command (open the port, send ATE0, then wait a
+fixed 1.1 s) with the persistent ATSession, one command at a time and batched.
+
+Usage:
+    python tests/at_benchmark.py --latency 0.02 --iterations 20
+"""
+
+import time
+import argparse
+import serial
+
+from buggd.drivers.atsession import ATSession
+from buggd.drivers.rc7620sim import RC7620Simulator
+
+STATUS_COMMANDS = ["AT", "AT+CSQ", "AT+CCID?"]
+
+
+def legacy_command(port, command):
+    """ The original send_at_command, less the port ownership check """
+    with serial.Serial(port, 115200, timeout=1) as ser:
+        ser.write(("ATE0\r\n").encode())
+        time.sleep(0.1)
+        ser.read_all()
+        time.sleep(0.5)
+        ser.write((command + "\r\n").encode())
+        time.sleep(0.5)
+        response = ser.read_all()
+    return [line for line in response.decode('utf-8').splitlines() if line.strip()]
+
+
+def time_per_query(fn, iterations):
+    """ Mean time per full status query in milliseconds """
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark AT command round trips')
+    parser.add_argument('--latency', type=float, default=0.02, help='Simulated modem response time, in seconds')
+    parser.add_argument('--noise', type=float, default=0.1, help='Probability of noise within a response')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--legacy-iterations', type=int, default=2, help='The original method takes seconds per query')
+    args = parser.parse_args()
+
+    with RC7620Simulator(latency_s=args.latency, noise=args.noise, seed=1) as sim:
+        legacy = time_per_query(lambda: [legacy_command(sim.port, c) for c in STATUS_COMMANDS], args.legacy_iterations)
+
+        session = ATSession(sim.port, 115200)
+        try:
+            session.open()
+            single = time_per_query(lambda: [session.command(c) for c in STATUS_COMMANDS], args.iterations)
+            batched = time_per_query(lambda: session.batch(STATUS_COMMANDS), args.iterations)
+        finally:
+            session.close()
+
+    print('Status query of {} ({:.0f} ms simulated latency):'.format(', '.join(STATUS_COMMANDS), args.latency * 1e3))
+    print('Open port per command:   {:8.1f} ms'.format(legacy))
+    print('Persistent session:      {:8.1f} ms'.format(single))
+    print('Persistent, batched:     {:8.1f} ms'.format(batched))
+    print('URCs set aside:          {}'.format(len(session.urcs)))
+
+
+if __name__ == "__main__":
+    main()
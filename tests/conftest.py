@@ -0,0 +1,7 @@
+""" Shared setup for the tests """
+
+import os
+import tempfile
+
+# The daemon's modules start logging when they are imported, so keep the files out of /home/buggd
+os.environ.setdefault('BUGGD_LOG_DIR', tempfile.mkdtemp(prefix='buggd-test-logs-'))
@@ -0,0 +1,100 @@
+"""
+Benchmark of the time a log call takes in the calling thread, with the stdout and file
+handlers called synchronously (as buggd used to log) and through the queue.
+
+The rate limit is lifted, so every message is written. stdout goes to /dev/null, and the
+log file to a temporary directory, or to --log-dir, which should be on the SD card to see
+the worst case on a device. Without an SD card, --flush-delay-ms makes each write to the
+log file take longer, as a busy card does.
+
+Usage:
+    python tests/log_benchmark.py --messages 20000 --log-dir /mnt/sd/bench
+    python tests/log_benchmark.py --messages 2000 --flush-delay-ms 1
+"""
+
+import os
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+
+from buggd.apps.buggd import log as buggd_log
+
+logger = logging.getLogger('buggd.bench')
+
+
+def percentile(values, pct):
+    """ The value pct percent of the way through the sorted values """
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def slow_flush(handler, delay_s):
+    """ Make a handler's flushes take delay_s longer """
+    flush = handler.flush
+
+    def slow():
+        time.sleep(delay_s)
+        flush()
+
+    handler.flush = slow
+
+
+def run(use_queue, n_messages, log_dir, flush_delay_s=0):
+    """ Time n_messages log calls, returning the latency of each in seconds and the number dropped """
+
+    buggd_log.LOG_DIR = log_dir
+    log = buggd_log.Log(use_queue=use_queue)
+    devnull = open(os.devnull, 'w', encoding='utf-8')
+    log.stdout_handler.setStream(devnull)
+    if flush_delay_s:
+        slow_flush(log.file_handler, flush_delay_s)
+
+    # Different call sites, as the capture and upload threads log from many places
+    calls = [lambda i: logger.info('Recorded segment {} in {:.1f}s'.format(i, 1.5)),
+             lambda i: logger.info('Uploaded {} bytes to {}'.format(i * 1000, 'bucket/object')),
+             lambda i: logger.debug('Manifest entry {} written'.format(i))]
+
+    latencies = []
+    for i in range(n_messages):
+        t0 = time.perf_counter()
+        calls[i % len(calls)](i)
+        latencies.append(time.perf_counter() - t0)
+
+    dropped = log.dropped
+    t0 = time.perf_counter()
+    log.stop()
+    drain_s = time.perf_counter() - t0
+
+    for handler in list(log.logger.handlers):
+        log.logger.removeHandler(handler)
+        handler.close()
+    devnull.close()
+
+    return sorted(latencies), dropped, drain_s
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the latency of log calls')
+    parser.add_argument('--messages', type=int, default=20000, help='Number of messages to log')
+    parser.add_argument('--log-dir', default=None, help='Where to write the log file (default: a temporary directory)')
+    parser.add_argument('--flush-delay-ms', type=float, default=0, help='Extra time taken by each write to the log file')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='buggd_log_bench_', dir=args.log_dir)
+    try:
+        results = {}
+        for name, use_queue in (('synchronous', False), ('queued', True)):
+            results[name] = run(use_queue, args.messages, os.path.join(tmp, name), args.flush_delay_ms / 1000)
+
+        print('{:12} {:>10} {:>10} {:>10} {:>10} {:>8} {:>9}'.format('', 'mean us', 'p50 us', 'p99 us', 'max us', 'dropped', 'drain s'))
+        for name, (latencies, dropped, drain_s) in results.items():
+            print('{:12} {:10.1f} {:10.1f} {:10.1f} {:10.1f} {:8} {:9.3f}'.format(
+                name, sum(latencies) / len(latencies) * 1e6, percentile(latencies, 50) * 1e6,
+                percentile(latencies, 99) * 1e6, latencies[-1] * 1e6, dropped, drain_s))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
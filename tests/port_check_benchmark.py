@@ -0,0 +1,80 @@
+"""
+Microbenchmark of the check for another process holding the modem's serial port.
+
+Compares the original check, which resolved every file descriptor of every process in
+/proc, with the targeted check of ModemManager's descriptors. A pseudo-terminal stands
+in for the modem's port and is held open by this process, which also opens some extra
+descriptors to stand in for ModemManager's.
+
+Usage:
+    python tests/port_check_benchmark.py --iterations 200
+"""
+
+import os
+import pty
+import time
+import argparse
+
+from buggd.drivers.serialport import is_port_open_elsewhere, find_modemmanager_pids
+
+
+def full_proc_scan(port):
+    """ The original check: resolve every fd of every process and compare paths """
+    target_device = os.path.realpath(port)
+    for pid in os.listdir('/proc'):
+        if pid.isdigit():
+            fds_path = f'/proc/{pid}/fd'
+            try:
+                fds = os.listdir(fds_path)
+            except (PermissionError, FileNotFoundError):
+                continue
+            for fd in fds:
+                try:
+                    if os.path.realpath(os.path.join(fds_path, fd)) == target_device:
+                        return True
+                except OSError:
+                    continue
+    return False
+
+
+def time_call(fn, iterations):
+    """ Mean time per call in microseconds """
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the serial port ownership check')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--extra-fds', type=int, default=30, help='Extra descriptors to hold open, as ModemManager would')
+    args = parser.parse_args()
+
+    master, slave = pty.openpty()
+    port = os.ttyname(slave)
+    extra = [os.open('/dev/null', os.O_RDONLY) for _ in range(args.extra_fds)]
+    own_pid = [str(os.getpid())]
+
+    try:
+        # Both checks must see this process holding the port. The third timing, with the
+        # ModemManager PID lookup, can't be checked this way: it won't find this process.
+        assert full_proc_scan(port)
+        assert is_port_open_elsewhere(port, pids=own_pid)
+
+        n_procs = sum(1 for p in os.listdir('/proc') if p.isdigit())
+        print('Processes:                        {}'.format(n_procs))
+        print('Full /proc scan:                  {:10.1f} us'.format(time_call(lambda: full_proc_scan(port), args.iterations)))
+        print('ModemManager PID lookup:          {:10.1f} us'.format(time_call(find_modemmanager_pids, args.iterations)))
+        print('Targeted check of known PIDs:     {:10.1f} us'.format(
+            time_call(lambda: is_port_open_elsewhere(port, pids=own_pid), args.iterations)))
+        print('Targeted check incl. PID lookup:  {:10.1f} us'.format(
+            time_call(lambda: is_port_open_elsewhere(port), args.iterations)))
+
+    finally:
+        for fd in extra + [master, slave]:
+            os.close(fd)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Benchmark of a full sync of a synthetic backlog against the local upload stand-in.
+
+The link is modelled by the LocalBackend: every request costs a round trip, data is
+limited to the given bandwidth, and requests fail at random. The time spent waiting on
+the link is accumulated rather than slept, so the benchmark runs quickly while still
+reporting realistic figures. Sync cycles are repeated until the backlog is empty, as
+happens on the device when a cycle is cut short by a failure.
+
+Usage:
+    python tests/sync_benchmark.py --segments 72 --segment-kb 2400 --latency 0.6 --bandwidth-kBps 500
+"""
+
+import os
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+
+from buggd.apps.buggd.backends import LocalBackend
+from buggd.apps.buggd.checksums import stage_with_checksums
+from buggd.apps.buggd.manifest import manifests
+from buggd.apps.buggd.sync import sync_upload_dir
+
+# Time for the modem to power up, register and bring up the connection, and to power down
+MODEM_CONNECT_S = 30
+MODEM_POWERDOWN_S = 5
+
+
+class LinkTime:
+    """ Accumulates the time the backend would have spent waiting on the link """
+
+    def __init__(self):
+        self.total = 0
+
+    def sleep(self, secs):
+        self.total += secs
+
+
+def make_backlog(upload_dir, working_dir, n_segments, segment_bytes, n_logs, log_bytes):
+    """ Fill the upload directory with hashed segments and small aged log files """
+
+    data_dir = os.path.join(upload_dir, 'proj_bench', 'bugg_bench', 'conf_bench')
+    log_dir = os.path.join(upload_dir, 'logs')
+    os.makedirs(data_dir)
+    os.makedirs(log_dir)
+
+    start = time.time() - n_segments * 300
+    for i in range(n_segments):
+        name = time.strftime('%Y-%m-%dT%H_%M_%S.000Z', time.gmtime(start + i * 300))
+        enc_path = os.path.join(working_dir, name + '.mp3')
+        with open(enc_path, 'wb') as f:
+            f.write(os.urandom(segment_bytes))
+        hashes = stage_with_checksums(enc_path, os.path.join(data_dir, name + '.mp3'))
+        manifests.add_segment(os.path.join(data_dir, name + '.mp3'), name, 300, 1, hashes['bytes'], hashes['crc32c'])
+
+    old = time.time() - 3600
+    for i in range(n_logs):
+        path = os.path.join(log_dir, 'rpi_eco_bench_{}.log'.format(i))
+        with open(path, 'wb') as f:
+            f.write(b'x' * log_bytes)
+        os.utime(path, (old, old))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the sync loop against a simulated link')
+    parser.add_argument('--segments', type=int, default=72, help='Number of audio segments in the backlog')
+    parser.add_argument('--segment-kb', type=int, default=2400, help='Size of each segment')
+    parser.add_argument('--logs', type=int, default=24, help='Number of small log files in the backlog')
+    parser.add_argument('--log-kb', type=int, default=20, help='Size of each log file')
+    parser.add_argument('--latency', type=float, default=0.6, help='Round trip time per request, in seconds')
+    parser.add_argument('--bandwidth-kBps', type=float, default=500, help='Upload bandwidth in kilobytes (not kilobits) per second')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Probability of a request failing')
+    parser.add_argument('--max-cycles', type=int, default=20, help='Give up after this many sync cycles')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    # The buggd modules log each upload at INFO, which would drown out the results
+    logging.basicConfig()
+    logging.getLogger().handlers[0].setLevel(logging.WARNING)
+
+    tmp = tempfile.mkdtemp(prefix='buggd_sync_bench_')
+    upload_dir = os.path.join(tmp, 'upload')
+    working_dir = os.path.join(tmp, 'working')
+    bucket_dir = os.path.join(tmp, 'bucket')
+    os.makedirs(working_dir)
+
+    try:
+        manifests.manifest_dir = os.path.join(tmp, 'manifests')
+        manifests.set_upload_dir(upload_dir)
+        make_backlog(upload_dir, working_dir, args.segments, args.segment_kb * 1000, args.logs, args.log_kb * 1000)
+
+        link = LinkTime()
+        backend = LocalBackend(bucket_dir, latency_s=args.latency, bandwidth_bytes_per_s=args.bandwidth_kBps * 1000,
+                               failure_rate=args.failure_rate, seed=args.seed, sleep=link.sleep)
+
+        cycles = 0
+        while cycles < args.max_cycles:
+            cycles += 1
+            try:
+                sync_upload_dir(backend, upload_dir)
+            except Exception as e:
+                print('Cycle {} ended early: {}'.format(cycles, e))
+
+            if sum(len(f) for _, _, f in os.walk(upload_dir)) == 0:
+                break
+
+        # Count what arrived in the bucket, including from cycles that ended early
+        files = sum(1 for _, _, fs in os.walk(bucket_dir) for f in fs if not f.endswith(LocalBackend.META_SUFFIX))
+        n_bytes = backend.bytes_uploaded
+        sync_s = link.total
+        modem_on_s = sync_s + cycles * (MODEM_CONNECT_S + MODEM_POWERDOWN_S)
+
+        print('Sync cycles:        {}'.format(cycles))
+        print('Requests:           {} ({} failed)'.format(backend.requests, backend.failures))
+        print('Files uploaded:     {}'.format(files))
+        print('Data uploaded:      {:.2f} MB'.format(n_bytes / 1e6))
+        print('Time on link:       {:.1f} s'.format(sync_s))
+        print('Files/s:            {:.2f}'.format(files / sync_s if sync_s else 0))
+        print('MB/s:               {:.3f}'.format(n_bytes / 1e6 / sync_s if sync_s else 0))
+        print('Modem on time:      {:.1f} s'.format(modem_on_s))
+        print('Backlog remaining:  {} files'.format(sum(len(f) for _, _, f in os.walk(upload_dir))))
+
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
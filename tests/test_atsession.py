@@ -0,0 +1,110 @@
+""" Regression tests of AT response parsing, against the simulated RC7620 """
+
+import pytest
+
+from buggd.drivers.atsession import ATSession, ATError, parse_rssi, parse_ccid, rssi_to_dbm, parse_registration, parse_operator
+from buggd.drivers.rc7620sim import RC7620Simulator
+
+
+@pytest.fixture
+def sim():
+    sim = RC7620Simulator(seed=1)
+    sim.start()
+    yield sim
+    sim.stop()
+
+
+def query(sim, command):
+    session = ATSession(sim.port, 115200)
+    try:
+        return session.command(command)
+    finally:
+        session.close()
+
+
+def test_rssi(sim):
+    response = query(sim, "AT+CSQ")
+    assert response.ok
+    assert parse_rssi(response) == 20
+    assert rssi_to_dbm(parse_rssi(response)) == -73
+
+
+def test_no_signal(sim):
+    sim.rssi = 99
+    assert parse_rssi(query(sim, "AT+CSQ")) == 99
+    assert rssi_to_dbm(99) is None
+
+
+def test_ccid(sim):
+    response = query(sim, "AT+CCID?")
+    assert response.ok
+    assert parse_ccid(response) == sim.ccid
+
+
+def test_no_sim(sim):
+    sim.ccid = None
+    response = query(sim, "AT+CCID?")
+    assert not response.ok
+    assert response.final == "+CME ERROR: 10"
+    assert parse_ccid(response) is None
+
+
+def test_batch_keeps_lines_before_error(sim):
+    sim.ccid = None
+    session = ATSession(sim.port, 115200)
+    try:
+        response = session.batch(["AT+CSQ", "AT+CCID?"])
+    finally:
+        session.close()
+    assert not response.ok
+    assert parse_rssi(response) == 20
+
+
+def test_urcs_set_aside_under_noise():
+    seen = []
+    with RC7620Simulator(noise=0.5, seed=3) as sim:
+        session = ATSession(sim.port, 115200, on_urc=seen.append)
+        try:
+            for _ in range(20):
+                response = session.batch(["AT+CSQ", "AT+CCID?"])
+                assert response.ok
+                assert response.lines == ["+CSQ: 20,99", "+CCID: {}".format(sim.ccid)]
+        finally:
+            session.close()
+    assert seen
+    assert [line for _, line in session.urcs] == seen
+
+
+def test_echo_is_turned_off(sim):
+    session = ATSession(sim.port, 115200)
+    try:
+        session.open()
+        assert not sim.echo
+        assert session.command("AT").lines == []
+    finally:
+        session.close()
+
+
+def test_timeout_after_powerdown(sim):
+    session = ATSession(sim.port, 115200)
+    try:
+        assert session.command("AT!POWERDOWN").ok
+        with pytest.raises(ATError):
+            session.command("AT", timeout=0.2)
+    finally:
+        session.close()
+
+
+def test_registration(sim):
+    response = query(sim, "AT+CEREG=2;+CREG?;+CEREG?;+COPS?")
+    assert response.ok
+    assert parse_registration(response, "+CEREG") == {'registration': 'home', 'lac': '00C3', 'cell_id': '0A1B2C3D', 'technology': 'LTE'}
+    assert parse_registration(response, "+CREG")['registration'] == 'not registered'
+    assert parse_operator(response) == ('EE', 'LTE')
+
+
+def test_not_registered(sim):
+    sim.registered = False
+    response = query(sim, "AT+CEREG=2;+CEREG?;+COPS?")
+    assert parse_registration(response, "+CEREG") == {'registration': 'not registered', 'lac': None, 'cell_id': None, 'technology': None}
+    assert parse_operator(response) == (None, None)
@@ -0,0 +1,128 @@
+""" Tests of packing small files into bundles, and deleting them once uploaded """
+
+import os
+import json
+import time
+import tarfile
+
+import pytest
+
+from buggd.apps.buggd.backends import LocalBackend, UploadError
+from buggd.apps.buggd import bundle as bundle_module
+from buggd.apps.buggd.bundle import find_small_files, bundle_small_files, remove_bundled_files, get_bundle_dir
+from buggd.apps.buggd.bundle import MANIFEST_NAME
+from buggd.apps.buggd.checksums import get_sidecar_path
+from buggd.apps.buggd.sync import sync_upload_dir
+
+MAX_BYTES = 1024
+MIN_AGE_S = 60
+
+
+@pytest.fixture
+def upload_dir(tmp_path):
+    path = tmp_path / 'audio'
+    path.mkdir()
+    return str(path)
+
+
+def make_file(upload_dir, name, n_bytes=100, age_s=3600):
+    path = os.path.join(upload_dir, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'x' * n_bytes)
+    t = time.time() - age_s
+    os.utime(path, (t, t))
+    return path
+
+
+def found(upload_dir, **kwargs):
+    return sorted(remote for _, remote, _ in find_small_files(upload_dir, max_bytes=MAX_BYTES, min_age_s=MIN_AGE_S,
+                                                              **kwargs))
+
+
+def test_thresholds(upload_dir):
+    make_file(upload_dir, 'logs/small.log.gz')
+    make_file(upload_dir, 'logs/limit.log.gz', n_bytes=MAX_BYTES)
+    make_file(upload_dir, 'logs/big.log.gz', n_bytes=MAX_BYTES + 1)
+    # May still be being written
+    make_file(upload_dir, 'logs/new.log.gz', age_s=MIN_AGE_S - 10)
+
+    assert found(upload_dir) == ['logs/limit.log.gz', 'logs/small.log.gz']
+
+
+def test_exclusions(upload_dir):
+    make_file(upload_dir, 'logs/small.log.gz')
+    # Hashed data files are uploaded alone, so the server can verify them
+    data = make_file(upload_dir, 'proj/seg.mp3')
+    make_file(upload_dir, os.path.relpath(get_sidecar_path(data), upload_dir))
+    make_file(upload_dir, 'journal/journal.jsonl.part')
+    make_file(upload_dir, 'bundles/bundle_old.tar.gz')
+
+    assert found(upload_dir) == ['logs/small.log.gz']
+
+
+def test_max_files(upload_dir):
+    for i in range(5):
+        make_file(upload_dir, 'logs/{}.log.gz'.format(i))
+    assert len(found(upload_dir, max_files=3)) == 3
+
+
+def test_bundle(upload_dir):
+    paths = [make_file(upload_dir, 'logs/{}.log.gz'.format(i), n_bytes=10 + i) for i in range(3)]
+
+    bundle_path, files = bundle_small_files(upload_dir, max_bytes=MAX_BYTES, min_age_s=MIN_AGE_S)
+
+    assert os.path.dirname(bundle_path) == get_bundle_dir(upload_dir)
+    assert os.listdir(get_bundle_dir(upload_dir)) == [os.path.basename(bundle_path)]
+    with tarfile.open(bundle_path) as tar:
+        names = tar.getnames()
+        manifest = json.load(tar.extractfile(MANIFEST_NAME))
+    assert names[0] == MANIFEST_NAME
+    assert sorted(names[1:]) == ['logs/0.log.gz', 'logs/1.log.gz', 'logs/2.log.gz']
+    assert sorted((f['path'], f['bytes']) for f in manifest['files']) == [
+        ('logs/0.log.gz', 10), ('logs/1.log.gz', 11), ('logs/2.log.gz', 12)]
+
+    # Nothing is deleted until the upload is confirmed
+    assert all(os.path.exists(path) for path in paths)
+    remove_bundled_files(bundle_path, files)
+    assert not any(os.path.exists(path) for path in paths + [bundle_path])
+
+
+def test_single_file_not_bundled(upload_dir):
+    make_file(upload_dir, 'logs/only.log.gz')
+    assert bundle_small_files(upload_dir, max_bytes=MAX_BYTES, min_age_s=MIN_AGE_S) == (None, [])
+
+
+def test_failed_upload_keeps_originals(upload_dir, tmp_path):
+    paths = [make_file(upload_dir, 'logs/{}.log.gz'.format(i)) for i in range(3)]
+
+    with pytest.raises(UploadError):
+        sync_upload_dir(LocalBackend(str(tmp_path / 'bucket'), failure_rate=1), upload_dir)
+    assert all(os.path.exists(path) for path in paths)
+
+    # The next cycle replaces the stale bundle, and deletes the originals once it is up
+    backend = LocalBackend(str(tmp_path / 'bucket'))
+    sync_upload_dir(backend, upload_dir)
+    assert not any(os.path.exists(path) for path in paths)
+    assert os.listdir(get_bundle_dir(upload_dir)) == []
+    uploaded = os.listdir(os.path.join(backend.root_dir, 'bundles'))
+    assert len([name for name in uploaded if name.endswith('.tar.gz')]) == 1
+
+
+def test_file_deleted_while_bundling(upload_dir, monkeypatch):
+    paths = [make_file(upload_dir, 'logs/{}.log.gz'.format(i)) for i in range(3)]
+
+    # Pruned after it was found, before it was packed
+    def find_then_prune(*args, **kwargs):
+        files = find_small_files(*args, **kwargs)
+        if os.path.exists(paths[0]):
+            os.remove(paths[0])
+        return files
+
+    monkeypatch.setattr(bundle_module, 'find_small_files', find_then_prune)
+    bundle_path, files = bundle_small_files(upload_dir, max_bytes=MAX_BYTES, min_age_s=MIN_AGE_S)
+
+    assert sorted(local for local, _, _ in files) == paths[1:]
+    with tarfile.open(bundle_path) as tar:
+        assert sorted(tar.getnames()) == sorted(['logs/1.log.gz', 'logs/2.log.gz', MANIFEST_NAME])
+    assert os.listdir(get_bundle_dir(upload_dir)) == [os.path.basename(bundle_path)]
@@ -0,0 +1,62 @@
+""" Tests of following NetworkManager's state with nmcli monitor """
+
+import sys
+import types
+import subprocess
+
+import pytest
+
+from buggd.apps.buggd import connectivity as connectivity_module
+from buggd.apps.buggd.connectivity import ConnectivityMonitor
+
+
+@pytest.fixture
+def nmcli(monkeypatch):
+    """ Stands a Python script (code) in for nmcli monitor, keeping the processes started """
+    nmcli = types.SimpleNamespace(code='', procs=[])
+    popen = subprocess.Popen
+
+    def fake_popen(args, **kwargs):
+        proc = popen([sys.executable, '-c', nmcli.code], **kwargs)
+        nmcli.procs.append(proc)
+        return proc
+
+    monkeypatch.setattr(connectivity_module.subprocess, 'Popen', fake_popen)
+    return nmcli
+
+
+def test_monitor_reaps_nmcli(nmcli):
+    nmcli.code = "print(\"Connectivity is now 'full'\")"
+    monitor = ConnectivityMonitor()
+    monitor.start_nm_monitor()
+    thread = monitor.nm_thread
+    thread.join(10)
+
+    assert monitor.is_connected
+    assert monitor.nm_changed.is_set()
+    # Waited on, so not left a zombie, and can be started again
+    proc, = nmcli.procs
+    assert proc.returncode == 0
+    assert monitor.nm_thread is None and monitor.nm_proc is None
+
+    monitor.start_nm_monitor()
+    thread = monitor.nm_thread
+    thread.join(10)
+    assert len(nmcli.procs) == 2 and nmcli.procs[1].returncode == 0
+
+
+def test_stop_monitor(nmcli):
+    nmcli.code = "import time; print(\"Connectivity is now 'none'\", flush=True); time.sleep(60)"
+    monitor = ConnectivityMonitor()
+    monitor.start_nm_monitor()
+    assert monitor.nm_changed.wait(10)
+    thread = monitor.nm_thread
+
+    monitor.stop_nm_monitor()
+
+    proc, = nmcli.procs
+    assert proc.returncode is not None
+    assert not thread.is_alive()
+    assert monitor.nm_proc is None
+    # Stopping again does nothing
+    monitor.stop_nm_monitor()
@@ -0,0 +1,126 @@
+""" Tests of the daemon's control socket """
+
+import os
+import json
+import socket
+
+import pytest
+
+from buggd.apps.buggd.control import ControlServer, ControlError, ControlUnavailable, call, is_running
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'buggd.sock')
+
+
+def no_soundcard():
+    raise ControlUnavailable('no soundcard')
+
+
+@pytest.fixture
+def server(path):
+    server = ControlServer()
+    server.register('add', lambda a, b: a + b)
+    server.register('fail', lambda: 1 / 0)
+    server.register('elsewhere', no_soundcard)
+    assert server.start(path)
+    yield server
+    server.stop()
+
+
+def test_call(server, path):
+    assert call('add', path=path, a=2, b=3) == 5
+
+
+def test_errors(server, path):
+    with pytest.raises(ControlError, match='ZeroDivisionError'):
+        call('fail', path=path)
+    with pytest.raises(ControlError, match='Unknown command'):
+        call('nope', path=path)
+    with pytest.raises(ControlError, match='TypeError'):
+        call('add', path=path, a=1)
+
+
+def test_unavailable(server, path):
+    with pytest.raises(ControlUnavailable, match='no soundcard'):
+        call('elsewhere', path=path)
+
+
+def test_not_running(path):
+    with pytest.raises(ControlUnavailable):
+        call('add', path=path, a=1, b=2)
+    assert not is_running(path)
+
+
+def test_stale_socket(path):
+    # Left behind by a daemon that died
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+    with pytest.raises(ControlUnavailable):
+        call('add', path=path, a=1, b=2)
+
+    server = ControlServer()
+    server.register('add', lambda a, b: a + b)
+    assert server.start(path)
+    try:
+        assert call('add', path=path, a=1, b=2) == 3
+        # A second daemon doesn't take over the socket
+        assert not ControlServer().start(path)
+        assert call('add', path=path, a=1, b=2) == 3
+    finally:
+        server.stop()
+    assert not os.path.exists(path)
+
+
+def send_line(path, line):
+    """ Send a raw request line and return the reply """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(5)
+        sock.connect(path)
+        with sock.makefile('rwb') as f:
+            f.write(line + b'\n')
+            f.flush()
+            return json.loads(f.readline())
+
+
+def test_malformed_requests(server, path):
+    for line in (b'not json', b'[]', b'{"args": {}}', b'{"cmd": [1]}', b'{"cmd": {}}',
+                 b'{"cmd": "add", "args": [1, 2]}'):
+        assert send_line(path, line) == {'ok': False, 'error': 'Malformed request'}
+    # The connection thread is still serving
+    assert call('add', path=path, a=1, b=2) == 3
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason='Needs root to give the socket to another user')
+def test_socket_owned_by_another_user(path):
+    # Bound and answering, but by another user
+    other = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    other.bind(path)
+    other.listen(1)
+    os.chown(path, 12345, 12345)
+    try:
+        with pytest.raises(ControlError, match='another user'):
+            call('add', path=path, a=1, b=2)
+
+        server = ControlServer()
+        server.register('add', lambda a, b: a + b)
+        assert server.start(path)
+        try:
+            assert call('add', path=path, a=1, b=2) == 3
+        finally:
+            server.stop()
+    finally:
+        other.close()
+
+
+def test_creates_socket_dir(tmp_path):
+    path = str(tmp_path / 'run' / 'buggd' / 'buggd.sock')
+    server = ControlServer()
+    server.register('add', lambda a, b: a + b)
+    assert server.start(path)
+    try:
+        assert call('add', path=path, a=1, b=2) == 3
+    finally:
+        server.stop()
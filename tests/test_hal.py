@@ -0,0 +1,72 @@
+""" Regression tests of the drivers' hardware sequencing, on the simulated HAL """
+
+import pytest
+
+from buggd import hal
+from buggd.drivers import i2cbus
+from buggd.drivers.leds import LEDs, Colour
+from buggd.drivers.pcmd3180 import PCMD3180, I2C_ADDRESS, SHDNZ
+from buggd.drivers.modem import Modem, P3V7_EN, POWER_ON_N
+
+
+@pytest.fixture
+def sim():
+    backend = hal.select(hal.SIM)
+    # Don't reuse handles opened on another backend
+    i2cbus.buses.clear()
+    yield backend
+    i2cbus.buses.clear()
+
+
+def test_led_update_is_one_write(sim):
+    leds = LEDs()
+    leds.set({leds.top: Colour.GREEN, leds.middle: Colour.BLUE})
+
+    writes = sim.log.find(bus='i2c-1', address=0x23, op='write_byte')
+    assert len(writes) == 1
+
+    # Setting the same colours again doesn't touch the bus
+    leds.set({leds.top: Colour.GREEN, leds.middle: Colour.BLUE})
+    assert len(sim.log.find(bus='i2c-1', address=0x23, op='write_byte')) == 1
+
+
+def test_pcmd3180_configuration(sim):
+    bridge = PCMD3180()
+    bridge.reset()
+    bridge.send_configuration()
+
+    registers = sim.i2c_devices[1][I2C_ADDRESS].registers
+    assert registers[0x07] == 0x80
+    assert registers[0x3e] == 0xff
+
+    # Already configured, so nothing is written
+    sim.log.clear()
+    bridge.send_configuration()
+    assert not sim.log.find(address=I2C_ADDRESS, op='write_byte_data')
+    assert not sim.log.find(address=I2C_ADDRESS, op='write_i2c_block_data')
+
+    # Shutting it down resets the registers, so they're all written again
+    bridge.reset()
+    bridge.send_configuration()
+    assert registers[0x07] == 0x80
+    shutdown = sim.log.find(bus='gpio', address=SHDNZ, op='output')
+    assert [e.data for e in shutdown] == [0, 1]
+
+
+def test_modem_power_on_sequence(sim, tmp_path):
+    sim.modem.boot_s = 0.1
+    modem = Modem(lock_file_path=str(tmp_path / 'modem.lock'))
+    assert not modem.is_enumerated()
+
+    assert modem.power_on()
+    assert modem.is_enumerated()
+    assert modem.rail_is_on()
+
+    # The rail comes up before the modem is strobed on, and it enumerates after that
+    rail_t = sim.log.find(address=P3V7_EN, op='output')[0].t
+    strobe = sim.log.find(address=POWER_ON_N, op='output')
+    assert [e.data for e in strobe] == [1, 0]
+    assert rail_t < strobe[0].t < sim.log.find(bus='usb', op='add')[0].t
+
+    modem.turn_off_rail()
+    assert not modem.is_enumerated()
@@ -0,0 +1,167 @@
+""" Tests of the daemon's logging """
+
+import os
+import gzip
+import types
+import logging
+
+import pytest
+
+from buggd.apps.buggd import log as log_module
+from buggd.apps.buggd.log import RateLimitFilter, RollingFileHandler, compress_file, ARCHIVE_SUFFIX
+from buggd.apps.buggd.checksums import PART_SUFFIX
+
+
+def make_record(msg, lineno=10, level=logging.INFO, rate_limit=None):
+    record = logging.LogRecord('buggd.test', level, '/buggd/test.py', lineno, msg, None, None)
+    if rate_limit is not None:
+        record.rate_limit = rate_limit
+    return record
+
+
+def test_rate_limit_is_opt_in():
+    # Distinct messages from one call site, e.g. each file uploaded, all get through
+    limit = RateLimitFilter(window_s=60, burst=5)
+    assert all(limit.filter(make_record('Uploading seg_{}.mp3'.format(i))) for i in range(10))
+    assert limit.suppressed == 0
+
+
+def test_rate_limit(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(log_module, 'time', types.SimpleNamespace(monotonic=lambda: now[0]))
+    limit = RateLimitFilter(window_s=60, burst=5)
+
+    passed = [limit.filter(make_record('No connection on try {}'.format(i), rate_limit=True)) for i in range(8)]
+    assert passed == [True] * 5 + [False] * 3
+
+    # Other call sites, and errors, aren't held back
+    assert limit.filter(make_record('Elsewhere', lineno=20, rate_limit=True))
+    assert limit.filter(make_record('Failed', level=logging.ERROR, rate_limit=True))
+
+    # The next window says how many were dropped
+    now[0] += 60
+    record = make_record('No connection on try 9', rate_limit=True)
+    assert limit.filter(record)
+    assert record.msg == 'No connection on try 9 (3 similar messages suppressed)'
+
+
+def test_flush_keeps_queueing(tmp_path, monkeypatch):
+    monkeypatch.setattr(log_module, 'LOG_DIR', str(tmp_path))
+    log = log_module.Log()
+    try:
+        logger = logging.getLogger('buggd.test')
+        logger.info('Before the flush')
+        log.flush()
+        with open(log.get_current_log_filename()) as f:
+            assert 'Before the flush' in f.read()
+
+        # Still logging from the listener thread, not the caller's
+        assert log.listener is not None and log.queue_handler in logging.getLogger().handlers
+        logger.info('After the flush')
+        log.flush()
+        with open(log.get_current_log_filename()) as f:
+            assert 'After the flush' in f.read()
+    finally:
+        log.stop()
+        for handler in (log.stdout_handler, log.file_handler):
+            logging.getLogger().removeHandler(handler)
+        log.file_handler.close()
+
+
+@pytest.fixture
+def log(tmp_path, monkeypatch):
+    """ A Log writing to a temporary directory, from the caller's thread """
+    monkeypatch.setattr(log_module, 'LOG_DIR', str(tmp_path / 'logs'))
+    log = log_module.Log(use_queue=False)
+    yield log
+    for handler in (log.stdout_handler, log.file_handler):
+        logging.getLogger().removeHandler(handler)
+        handler.close()
+
+
+def read_gz(path):
+    with gzip.open(path, 'rt') as f:
+        return f.read()
+
+
+def test_compress_file(tmp_path):
+    src = tmp_path / 'a.log'
+    src.write_text('line\n' * 1000)
+    dst = str(tmp_path / 'a.log.gz')
+
+    compress_file(str(src), dst)
+
+    assert read_gz(dst) == 'line\n' * 1000
+    assert not src.exists()
+    assert not os.path.exists(dst + PART_SUFFIX)
+
+
+def test_rollover(tmp_path):
+    names = iter(str(tmp_path / '{}.log'.format(i)) for i in range(100))
+    archived = []
+    handler = RollingFileHandler(lambda: next(names), archived.append, max_bytes=200, max_age_s=3600)
+    try:
+        for i in range(20):
+            handler.handle(make_record('Message number {} {}'.format(i, 'x' * 50)))
+        # By size
+        assert len(archived) >= 5
+        assert all(os.path.getsize(path) >= 200 for path in archived)
+
+        # By age
+        n_archived = len(archived)
+        handler.max_bytes = 1e9
+        handler.handle(make_record('Fresh file'))
+        handler.opened_t -= 3600
+        handler.handle(make_record('Too old'))
+        assert len(archived) == n_archived + 1
+    finally:
+        handler.close()
+
+
+def test_rollover_archives_to_upload_dir(log, tmp_path):
+    upload_dir = str(tmp_path / 'audio')
+    log.move_archived_to_dir(upload_dir)
+    log.file_handler.max_bytes = 2000
+
+    logger = logging.getLogger('buggd.test')
+    for i in range(100):
+        logger.debug('Message number {}'.format(i))
+
+    archives = os.listdir(os.path.join(upload_dir, log_module.UPLOAD_LOG_DIR_NAME))
+    assert len(archives) >= 2
+    assert all(name.endswith('.log' + ARCHIVE_SUFFIX) for name in archives)
+    # Each archive has its own name, and all of them are readable
+    text = ''.join(read_gz(os.path.join(upload_dir, log_module.UPLOAD_LOG_DIR_NAME, name)) for name in archives)
+    assert 'Message number 0' in text
+
+
+def test_prune(log, tmp_path):
+    upload_logs = tmp_path / 'audio' / log_module.UPLOAD_LOG_DIR_NAME
+    upload_logs.mkdir(parents=True)
+    log.upload_dir = str(tmp_path / 'audio')
+    for i, d in enumerate([log.log_dir, str(upload_logs), log.log_dir]):
+        path = os.path.join(d, 'old_{}.log{}'.format(i, ARCHIVE_SUFFIX))
+        with open(path, 'wb') as f:
+            f.write(b'x' * 1000)
+        os.utime(path, (1000 + i, 1000 + i))
+
+    assert log.prune(max_bytes=2000) == 1
+    assert not os.path.exists(os.path.join(log.log_dir, 'old_0.log' + ARCHIVE_SUFFIX))
+    assert os.path.exists(os.path.join(str(upload_logs), 'old_1.log' + ARCHIVE_SUFFIX))
+
+
+def test_move_archived_after_crash(log, tmp_path):
+    # A log the last boot archived, and one it was still writing when it crashed
+    with gzip.open(os.path.join(log.log_dir, 'rpi_eco_x_1.log' + ARCHIVE_SUFFIX), 'wt') as f:
+        f.write('archived\n')
+    with open(os.path.join(log.log_dir, 'rpi_eco_x_2.log'), 'w') as f:
+        f.write('crashed\n')
+
+    upload_dir = str(tmp_path / 'audio')
+    log.move_archived_to_dir(upload_dir)
+
+    upload_logs = os.path.join(upload_dir, log_module.UPLOAD_LOG_DIR_NAME)
+    assert read_gz(os.path.join(upload_logs, 'rpi_eco_x_1.log' + ARCHIVE_SUFFIX)) == 'archived\n'
+    assert read_gz(os.path.join(upload_logs, 'rpi_eco_x_2.log' + ARCHIVE_SUFFIX)) == 'crashed\n'
+    # The current log carries on where it is
+    assert os.listdir(log.log_dir) == [os.path.basename(log.get_current_log_filename())]
@@ -0,0 +1,151 @@
+""" Tests of draining the pipeline before the daily reboot, and measuring the gap """
+
+import os
+import json
+import types
+import threading
+import collections
+
+import pytest
+
+from buggd.apps.buggd import main as daemon
+from buggd.apps.buggd.metrics import metrics, REBOOT_GAP_S
+
+
+class Rebooted(Exception):
+    pass
+
+
+class FakeTime:
+    """ A clock that moves on when slept on, calling on_sleep each time """
+
+    def __init__(self):
+        self.t = 1000.0
+        self.on_sleep = None
+
+    def monotonic(self):
+        return self.t
+
+    def time(self):
+        return 1.7e9 + self.t
+
+    def sleep(self, s):
+        self.t += s
+        if self.on_sleep is not None:
+            self.on_sleep()
+
+
+@pytest.fixture
+def clock(tmp_path, monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(daemon, 'time', clock)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(daemon, 'maintenance', threading.Event())
+    monkeypatch.setattr(daemon, 'postprocess_queue', collections.deque())
+    monkeypatch.setattr(daemon, 'GLOB_postprocess_in_progress', False)
+    monkeypatch.setattr(daemon, 'GLOB_sync_in_progress', False)
+    monkeypatch.setattr(daemon, 'GLOB_reboot_attempted', False)
+    monkeypatch.setattr(daemon, 'GLOB_last_capture_end_t', clock.t)
+    monkeypatch.setattr(daemon.os, 'sync', lambda: None)
+    return clock
+
+
+@pytest.fixture
+def commands(clock, monkeypatch):
+    """ The commands run. A reboot ends maintenance_reboot, as it would on a device. """
+    commands = []
+
+    def call_cmd_line(cmd):
+        commands.append((clock.t, cmd))
+        if 'reboot' in cmd:
+            raise Rebooted()
+
+    monkeypatch.setattr(daemon, 'call_cmd_line', call_cmd_line)
+    return commands
+
+
+def test_drains_then_reboots(clock, commands):
+    die = threading.Event()
+    daemon.postprocess_queue.extend([('sensor', 'seg1'), ('sensor', 'seg2')])
+    daemon.GLOB_sync_in_progress = True
+
+    def worker():
+        # The postprocess worker encodes a segment per poll, then the sync finishes its file
+        if daemon.postprocess_queue:
+            daemon.postprocess_queue.popleft()
+        else:
+            daemon.GLOB_sync_in_progress = False
+        assert commands == []
+
+    clock.on_sleep = worker
+    with pytest.raises(Rebooted):
+        daemon.maintenance_reboot(die)
+
+    assert commands == [(1000 + 3 * daemon.MAINTENANCE_POLL_S, 'sudo reboot')]
+    assert daemon.maintenance.is_set()
+    assert daemon.GLOB_reboot_attempted
+
+    with open(daemon.REBOOT_STATE_FNAME) as f:
+        state = json.load(f)
+    assert state['capture_end_utc'] == pytest.approx(1.7e9 + 1000)
+    assert state['drain_s'] == 3 * daemon.MAINTENANCE_POLL_S
+
+
+def test_reboots_after_timeouts(clock, commands):
+    # Neither the encode nor the sync ever finishes
+    daemon.postprocess_queue.append(('sensor', 'seg1'))
+    daemon.GLOB_sync_in_progress = True
+
+    with pytest.raises(Rebooted):
+        daemon.maintenance_reboot(threading.Event())
+
+    (t, cmd), = commands
+    assert cmd == 'sudo reboot'
+    timeout_s = daemon.MAINTENANCE_DRAIN_TIMEOUT_S + daemon.MAINTENANCE_SYNC_TIMEOUT_S
+    assert timeout_s <= t - 1000 < timeout_s + 2 * daemon.MAINTENANCE_POLL_S
+    assert daemon.postprocess_queue
+
+
+def test_carries_on_if_reboot_fails(clock, monkeypatch):
+    monkeypatch.setattr(daemon, 'call_cmd_line', lambda cmd: '')
+
+    daemon.maintenance_reboot(threading.Event())
+
+    # Recording starts again, and the gap isn't blamed on a reboot
+    assert not daemon.maintenance.is_set()
+    assert not os.path.exists(daemon.REBOOT_STATE_FNAME)
+    assert clock.t - 1000 >= daemon.MAINTENANCE_REBOOT_WAIT_S
+
+
+def test_stops_when_the_daemon_does(clock, commands):
+    die = threading.Event()
+    daemon.postprocess_queue.append(('sensor', 'seg1'))
+    clock.on_sleep = die.set
+
+    daemon.maintenance_reboot(die)
+
+    assert commands == []
+    assert not daemon.maintenance.is_set()
+
+
+def test_reboot_gap(clock):
+    # Recording stopped 30s before the state was saved, and the pipeline took 20s to drain
+    daemon.save_reboot_state(clock.t - 30, 20)
+    clock.t += 90
+
+    daemon.log_reboot_gap()
+
+    assert metrics.get(REBOOT_GAP_S) == pytest.approx(120)
+    assert not os.path.exists(daemon.REBOOT_STATE_FNAME)
+
+    # Only the first capture after the reboot
+    metrics.set(REBOOT_GAP_S, None)
+    daemon.log_reboot_gap()
+    assert metrics.get(REBOOT_GAP_S) is None
+
+
+def test_reboot_gap_bad_state(clock):
+    with open(daemon.REBOOT_STATE_FNAME, 'w') as f:
+        f.write('{')
+    daemon.log_reboot_gap()
+    assert not os.path.exists(daemon.REBOOT_STATE_FNAME)
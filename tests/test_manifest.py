@@ -0,0 +1,107 @@
+""" Tests of the daily manifests of recorded segments """
+
+import os
+import csv
+import time
+
+import pytest
+
+from buggd.apps.buggd.backends import LocalBackend
+from buggd.apps.buggd.manifest import ManifestStore, STATUS_PENDING, STATUS_UPLOADED, MANIFEST_KEEP_DAYS
+
+PREFIX = os.path.join('proj_test', 'bugg_test', 'conf_test')
+# Recent, so it isn't pruned
+DAY = time.strftime('%Y-%m-%d', time.gmtime())
+
+
+@pytest.fixture
+def upload_dir(tmp_path):
+    return str(tmp_path / 'audio')
+
+
+@pytest.fixture
+def store(tmp_path, upload_dir):
+    store = ManifestStore(str(tmp_path / 'manifests'))
+    store.set_upload_dir(upload_dir)
+    return store
+
+
+def segment_path(upload_dir, start, day=DAY):
+    return os.path.join(upload_dir, PREFIX, '{}T{}.000Z.mp3'.format(day, start))
+
+
+def add(store, upload_dir, start, day=DAY):
+    path = segment_path(upload_dir, start, day)
+    store.add_segment(path, os.path.basename(path)[:-4], 1200, 1, 1000, 'AAAAAA==')
+    return path
+
+
+def read(store, day=DAY):
+    with open(store._local_path((PREFIX, day)), newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def test_add_and_mark_uploaded(store, upload_dir):
+    second = add(store, upload_dir, '10_20_00')
+    first = add(store, upload_dir, '10_00_00')
+
+    rows = read(store)
+    assert [row['file'] for row in rows] == [os.path.basename(first), os.path.basename(second)]
+    assert all(row['status'] == STATUS_PENDING for row in rows)
+    assert not any(f.endswith('.part') for f in os.listdir(os.path.dirname(store._local_path((PREFIX, DAY)))))
+
+    store.mark_uploaded(first)
+    assert [row['status'] for row in read(store)] == [STATUS_UPLOADED, STATUS_PENDING]
+
+    # Files outside the upload directory, or not in a manifest, are ignored
+    store.add_segment('/elsewhere/{}T10_00_00.000Z.mp3'.format(DAY), 'x', 1200, 1, 1000, 'AAAAAA==')
+    store.mark_uploaded(segment_path(upload_dir, '11_00_00'))
+    assert len(read(store)) == 2
+
+
+def test_upload_dirty(store, upload_dir, tmp_path):
+    add(store, upload_dir, '10_00_00')
+    failing = LocalBackend(str(tmp_path / 'bucket'), failure_rate=1)
+    with pytest.raises(Exception):
+        store.upload_dirty(failing)
+    # Still to be uploaded
+    assert store.dirty == {(PREFIX, DAY)}
+
+    backend = LocalBackend(str(tmp_path / 'bucket'))
+    store.upload_dirty(backend)
+    assert store.dirty == set()
+    remote = os.path.join(backend.root_dir, PREFIX, 'manifests', DAY + '.csv')
+    with open(remote, newline='') as f:
+        assert [row['file'] for row in csv.DictReader(f)] == ['{}T10_00_00.000Z.mp3'.format(DAY)]
+
+    # Unchanged manifests aren't uploaded again
+    requests = backend.requests
+    store.upload_dirty(backend)
+    assert backend.requests == requests
+
+
+def test_restart_uploads_again(store, upload_dir, tmp_path):
+    add(store, upload_dir, '10_00_00')
+    store.upload_dirty(LocalBackend(str(tmp_path / 'bucket')))
+
+    # Whether the last changes were uploaded before a restart isn't known
+    restarted = ManifestStore(store.manifest_dir)
+    restarted.set_upload_dir(upload_dir)
+    assert restarted.dirty == {(PREFIX, DAY)}
+    assert [row['file'] for row in read(restarted)] == ['{}T10_00_00.000Z.mp3'.format(DAY)]
+
+
+def test_prune(store, upload_dir):
+    old_day = time.strftime('%Y-%m-%d', time.gmtime(time.time() - (MANIFEST_KEEP_DAYS + 1) * 86400))
+    today = time.strftime('%Y-%m-%d', time.gmtime())
+    add(store, upload_dir, '10_00_00', day=old_day)
+    add(store, upload_dir, '10_00_00', day=today)
+
+    # Not until it has been uploaded
+    store.prune()
+    assert os.path.exists(store._local_path((PREFIX, old_day)))
+
+    store.dirty.clear()
+    store.prune()
+    assert not os.path.exists(store._local_path((PREFIX, old_day)))
+    assert os.path.exists(store._local_path((PREFIX, today)))
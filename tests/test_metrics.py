@@ -0,0 +1,93 @@
+""" Tests of the metrics registry and the heartbeat """
+
+import json
+
+import pytest
+
+from buggd.apps.buggd.backends import LocalBackend
+from buggd.apps.buggd.metrics import MetricsRegistry, Histogram, send_heartbeat, HEARTBEAT_DIR_NAME
+from buggd.apps.buggd.utils import discover_serial
+
+
+@pytest.fixture
+def registry():
+    return MetricsRegistry()
+
+
+def test_histogram_buckets():
+    histogram = Histogram((1, 5, 10))
+    # An observation on a bound goes in the bucket it bounds, and anything larger overflows
+    for value in (0, 1, 1.01, 5, 10, 10.5, 1e9):
+        histogram.observe(value)
+    assert list(histogram.counts) == [2, 2, 1, 2]
+    assert histogram.snapshot() == {'bounds': [1, 5, 10], 'counts': [2, 2, 1, 2], 'sum': round(1e9 + 27.51, 3)}
+
+
+def test_counters(registry):
+    assert registry.get('files') is None
+    registry.inc('files')
+    registry.inc('files', 2)
+    assert registry.get('files') == 3
+
+
+def test_unset_gauges(registry):
+    registry.set('rssi', -71)
+    assert registry.get('rssi') == -71
+
+    # None is stored as NaN, and reads back as unset
+    registry.set('rssi', None)
+    assert registry.get('rssi') is None
+    assert registry.snapshot()['gauges'] == {'rssi': None}
+
+
+def test_add_to_gauge(registry):
+    # Adding to an unset gauge starts it from zero
+    registry.add('queue_depth', 1)
+    assert registry.get('queue_depth') == 1
+    registry.add('queue_depth', 2)
+    registry.add('queue_depth', -1)
+    assert registry.get('queue_depth') == 2
+
+    registry.set('queue_depth', None)
+    registry.add('queue_depth', -1)
+    assert registry.get('queue_depth') == -1
+
+
+def test_snapshot(registry):
+    registry.inc('uploaded_bytes', 4096)
+    registry.set('cpu_temp_c', 51.23456)
+    registry.set('rssi', None)
+    registry.observe('gap_s', 0.7, (0.5, 1))
+
+    snapshot = registry.snapshot()
+    assert snapshot == {'counters': {'uploaded_bytes': 4096},
+                        'gauges': {'cpu_temp_c': 51.235, 'rssi': None},
+                        'histograms': {'gap_s': {'bounds': [0.5, 1], 'counts': [0, 1, 0], 'sum': 0.7}}}
+    # Whole numbers are sent as ints
+    assert isinstance(snapshot['counters']['uploaded_bytes'], int)
+    json.dumps(snapshot)
+
+
+def test_send_heartbeat(registry, tmp_path):
+    backend = LocalBackend(str(tmp_path / 'bucket'))
+    registry.inc('segments_recorded', 5)
+
+    assert send_heartbeat(backend, registry)
+
+    path = tmp_path / 'bucket' / HEARTBEAT_DIR_NAME / '{}.json'.format(discover_serial())
+    with open(path) as f:
+        beat = json.load(f)
+    assert beat['serial'] == discover_serial()
+    assert beat['counters'] == {'segments_recorded': 5}
+    assert 'latency' in beat and 'utc' in beat
+
+    # Sent again over the top
+    registry.inc('segments_recorded')
+    assert send_heartbeat(backend, registry)
+    with open(path) as f:
+        assert json.load(f)['counters'] == {'segments_recorded': 6}
+
+
+def test_send_heartbeat_fails(registry, tmp_path):
+    backend = LocalBackend(str(tmp_path / 'bucket'), failure_rate=1)
+    assert not send_heartbeat(backend, registry)
@@ -0,0 +1,205 @@
+""" Tests of the virtual clock the simulation runs the daemon's threads on """
+
+import time
+import threading
+
+import pytest
+
+from buggd.apps.buggd.simulate import VirtualClock, ClockEvent, SimHalt, HALT_REBOOT, HALT_END
+
+START_T = 1.7e9
+
+
+@pytest.fixture
+def clock():
+    clock = VirtualClock(START_T, START_T + 3600)
+    yield clock
+    clock.close()
+
+
+def start(clock, *targets, exempt=()):
+    """
+    Run each target in a thread on the clock. The threads are all registered before any of
+    them sleeps, so the clock can't move on until every one of them is asleep.
+    Returns the threads, and a list of what they returned or the reason they were halted.
+    """
+    results = []
+    barrier = threading.Barrier(len(targets) + 1)
+
+    def run(target):
+        barrier.wait()
+        try:
+            results.append(target())
+        except SimHalt as e:
+            results.append(('halted', e.code))
+
+    threads = [threading.Thread(target=run, args=(target,)) for target in targets]
+    for thread, target in zip(threads, targets):
+        thread.start()
+        clock.register(thread, exempt=target in exempt)
+    barrier.wait()
+    return threads, results
+
+
+def join(threads):
+    for thread in threads:
+        thread.join(10)
+        assert not thread.is_alive()
+
+
+def test_advances_to_earliest_wakeup(clock):
+    woken = []
+
+    def a():
+        for _ in range(2):
+            clock.sleep(10)
+            woken.append(('a', clock.time() - START_T))
+
+    def b():
+        clock.sleep(30)
+        woken.append(('b', clock.time() - START_T))
+
+    threads, _ = start(clock, a, b)
+    join(threads)
+    assert woken == [('a', 10), ('a', 20), ('b', 30)]
+    assert clock.monotonic() == 30
+
+
+def test_waits_for_busy_thread(clock):
+    busy = threading.Event()
+    woken = []
+
+    def sleeper():
+        clock.sleep(10)
+        woken.append(clock.time() - START_T)
+
+    def worker():
+        # Real work takes no virtual time, however long it takes
+        busy.wait(10)
+        clock.sleep(5)
+        woken.append(clock.time() - START_T)
+
+    threads, _ = start(clock, sleeper, worker)
+    time.sleep(0.3)
+    assert woken == []
+    assert clock.time() == START_T
+
+    busy.set()
+    join(threads)
+    assert woken == [5, 10]
+
+
+def test_event_wakes_waiter(clock):
+    event = ClockEvent(clock)
+
+    def waiter():
+        return event.wait(100), clock.time() - START_T
+
+    def setter():
+        clock.sleep(5)
+        event.set()
+
+    threads, results = start(clock, waiter, setter)
+    join(threads)
+    assert (True, 5) in results
+
+
+def test_event_timeout(clock):
+    event = ClockEvent(clock)
+
+    def waiter():
+        return event.wait(20), clock.time() - START_T
+
+    threads, results = start(clock, waiter)
+    join(threads)
+    assert results == [(False, 20)]
+
+    # Already set, so no wait
+    event.set()
+    threads, results = start(clock, waiter)
+    join(threads)
+    assert results == [(True, 20)]
+    event.clear()
+    assert not event.is_set()
+
+
+def test_set_event_holds_the_clock(clock):
+    # A thread whose event is set is awake until it runs, so the others don't jump ahead of it
+    event = ClockEvent(clock)
+    woken = []
+
+    def waiter():
+        event.wait()
+        woken.append(('waiter', clock.time() - START_T))
+        clock.sleep(1)
+        woken.append(('waiter', clock.time() - START_T))
+
+    def setter():
+        clock.sleep(5)
+        event.set()
+        clock.sleep(60)
+        woken.append(('setter', clock.time() - START_T))
+
+    threads, _ = start(clock, waiter, setter)
+    join(threads)
+    assert woken == [('waiter', 5), ('waiter', 6), ('setter', 65)]
+
+
+def test_halt(clock):
+    halted = threading.Event()
+    exempt_woken = []
+
+    def sleeper():
+        clock.sleep(1000)
+
+    def exempt():
+        clock.sleep(10)
+        exempt_woken.append(clock.time() - START_T)
+        # Busy until after the halt, which holds the clock
+        halted.wait(10)
+        for _ in range(2):
+            clock.sleep(10)
+            exempt_woken.append(clock.time() - START_T)
+
+    threads, results = start(clock, sleeper, exempt, exempt=(exempt,))
+    deadline = time.monotonic() + 10
+    while not exempt_woken and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    clock.halt(HALT_REBOOT)
+    assert clock.wait_for_others(10)
+    assert results == [('halted', HALT_REBOOT)]
+
+    # The exempt thread carries on, on its own
+    halted.set()
+    join(threads)
+    assert exempt_woken == [10, 20, 30]
+
+    # Sleeping after a halt raises, until the clock is resumed
+    threads, results = start(clock, lambda: clock.sleep(0))
+    join(threads)
+    assert results == [('halted', HALT_REBOOT)]
+    clock.resume()
+    threads, results = start(clock, lambda: clock.sleep(5))
+    join(threads)
+    assert results == [None]
+
+
+def test_halts_at_end(clock):
+    def sleeper():
+        clock.sleep(7200)
+
+    threads, results = start(clock, sleeper)
+    join(threads)
+    assert results == [('halted', HALT_END)]
+    assert clock.time() == clock.end_t
+
+
+def test_close_stops_exempt_threads(clock):
+    def sleeper():
+        clock.sleep(1000)
+
+    threads, results = start(clock, sleeper, exempt=(sleeper,))
+    clock.close()
+    join(threads)
+    assert results == [('halted', 'closed')]
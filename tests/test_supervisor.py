@@ -0,0 +1,188 @@
+""" Tests of restarting, escalating and the systemd watchdog in the supervisor """
+
+import socket
+import threading
+
+import pytest
+
+from buggd.apps.buggd import supervisor as supervisor_module
+from buggd.apps.buggd.supervisor import Supervisor, watchdog_interval
+from buggd.apps.buggd.supervisor import RESTART_BACKOFF_S, FAILURE_WINDOW_S, MAX_FAILURES
+
+
+class FakeClock:
+    def __init__(self):
+        self.t = 1000.0
+
+    def monotonic(self):
+        return self.t
+
+
+class FakeThread:
+    def __init__(self, alive=True):
+        self.alive = alive
+
+    def is_alive(self):
+        return self.alive
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(supervisor_module, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def notify(tmp_path, monkeypatch):
+    """ A datagram socket standing in for systemd's, returning what is sent to it """
+    path = str(tmp_path / 'notify')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    sock.setblocking(False)
+    monkeypatch.setenv('NOTIFY_SOCKET', path)
+
+    def received():
+        messages = []
+        while True:
+            try:
+                messages.append(sock.recv(1024).decode('utf-8'))
+            except BlockingIOError:
+                return messages
+
+    yield received
+    sock.close()
+
+
+@pytest.fixture
+def sup(clock):
+    """ A supervisor with one running worker, that doesn't start real threads """
+    sup = Supervisor()
+    sup.die = threading.Event()
+    sup.escalations = []
+    sup.escalate = sup.escalations.append
+    sup.started = []
+
+    def start(worker):
+        sup.started.append(worker.name)
+        worker.restart_at = None
+        worker.last_ping = clock.monotonic()
+        worker.thread = FakeThread()
+
+    sup._start = start
+    sup.add('record', None, liveness_s=600)
+    start(sup.workers['record'])
+    return sup
+
+
+def fail(sup, clock, name='record'):
+    """ Have a worker die with an error """
+    worker = sup.workers[name]
+    worker.thread.alive = False
+    sup._failed(worker, 'RuntimeError: boom')
+
+
+def test_backoff(sup, clock):
+    worker = sup.workers['record']
+    for backoff_s in RESTART_BACKOFF_S[:MAX_FAILURES - 1]:
+        fail(sup, clock)
+        assert worker.restart_at == clock.t + backoff_s
+
+        # Not restarted before its backoff is up
+        clock.t += backoff_s - 1
+        sup.check()
+        assert not worker.thread.is_alive()
+        clock.t += 1
+        sup.check()
+        assert worker.thread.is_alive()
+
+    assert worker.restarts == MAX_FAILURES - 1
+    assert sup.escalations == []
+
+
+def test_failures_leave_the_window(sup, clock):
+    worker = sup.workers['record']
+    fail(sup, clock)
+    clock.t += FAILURE_WINDOW_S + 1
+    fail(sup, clock)
+    # Counted as a first failure again
+    assert worker.restart_at == clock.t + RESTART_BACKOFF_S[0]
+    assert len(worker.failures) == 1
+
+
+def test_escalates_after_max_failures(sup, clock):
+    for _ in range(MAX_FAILURES):
+        fail(sup, clock)
+        clock.t += 1
+
+    assert sup.check() is False
+    assert len(sup.escalations) == 1
+    assert 'failed {} times'.format(MAX_FAILURES) in sup.escalations[0]
+
+    # Only once
+    sup.check()
+    assert len(sup.escalations) == 1
+
+
+def test_stall_escalates_without_watchdog(sup, clock):
+    clock.t += 599
+    assert sup.check() is True
+    clock.t += 2
+    assert sup.check() is False
+    assert sup.workers['record'].stalled
+    assert sup.escalations == ['Worker record stalled']
+
+    # Making progress again clears the stall
+    sup.ping('record')
+    assert sup.check() is True
+    assert not sup.workers['record'].stalled
+
+
+def test_watchdog_interval(monkeypatch):
+    monkeypatch.delenv('WATCHDOG_USEC', raising=False)
+    assert watchdog_interval() is None
+    monkeypatch.setenv('WATCHDOG_USEC', '120000000')
+    monkeypatch.delenv('WATCHDOG_PID', raising=False)
+    assert watchdog_interval() == 60
+    # Meant for another process
+    monkeypatch.setenv('WATCHDOG_PID', '1')
+    assert watchdog_interval() is None
+
+
+def test_watchdog(sup, clock, notify):
+    sup.watchdog_s = 60
+    sup.check()
+    assert notify() == ['WATCHDOG=1']
+
+    # At most once per interval
+    clock.t += 30
+    sup.check()
+    assert notify() == []
+    clock.t += 30
+    sup.check()
+    assert notify() == ['WATCHDOG=1']
+
+
+def test_watchdog_fed_during_backoff(sup, clock, notify):
+    sup.watchdog_s = 60
+    sup.check()
+    notify()
+
+    # The longest backoff is longer than the watchdog timeout, so the pings must go on
+    for _ in range(MAX_FAILURES - 1):
+        fail(sup, clock)
+    notify()
+    worker = sup.workers['record']
+    while not worker.thread.is_alive():
+        clock.t += 60
+        sup.check()
+        assert 'WATCHDOG=1' in notify()
+
+
+def test_watchdog_withheld_on_stall(sup, clock, notify):
+    sup.watchdog_s = 60
+    clock.t += 601
+    assert sup.check() is False
+    assert notify() == []
+    # systemd restarts the service, so the supervisor doesn't escalate itself
+    assert sup.escalations == []
@@ -0,0 +1,146 @@
+""" Tests of syncing the upload directory to a backend """
+
+import os
+import threading
+
+import pytest
+
+from buggd.apps.buggd.backends import LocalBackend, UploadError
+from buggd.apps.buggd.checksums import stage_with_checksums, get_sidecar_path, read_sidecar, mark_upload_started
+from buggd.apps.buggd.checksums import PART_SUFFIX
+from buggd.apps.buggd.sync import sync_upload_dir
+
+DATA_DIR = os.path.join('proj_test', 'bugg_test', 'conf_test')
+
+
+@pytest.fixture
+def upload_dir(tmp_path):
+    path = tmp_path / 'audio'
+    path.mkdir()
+    return str(path)
+
+
+@pytest.fixture
+def backend(tmp_path):
+    return LocalBackend(str(tmp_path / 'bucket'))
+
+
+def stage_segment(upload_dir, name, n_bytes=4096):
+    """ Encode a fake segment into the data directory, with its sidecar, as the sensors do """
+    data_dir = os.path.join(upload_dir, DATA_DIR)
+    os.makedirs(data_dir, exist_ok=True)
+    src = os.path.join(os.path.dirname(upload_dir), name)
+    with open(src, 'wb') as f:
+        f.write(os.urandom(n_bytes))
+    dst = os.path.join(data_dir, name)
+    stage_with_checksums(src, dst)
+    return dst
+
+
+def test_several_segments_in_one_directory(upload_dir, backend):
+    # Each upload deletes a sidecar that the walk has already listed
+    paths = [stage_segment(upload_dir, 'seg{}.mp3'.format(i)) for i in range(3)]
+
+    stats = sync_upload_dir(backend, upload_dir)
+
+    assert stats.files == 3
+    for path in paths:
+        assert not os.path.exists(path)
+        assert not os.path.exists(get_sidecar_path(path))
+        assert os.path.exists(os.path.join(backend.root_dir, os.path.relpath(path, upload_dir)))
+
+
+def test_stop_after_current_file(upload_dir, backend):
+    paths = [stage_segment(upload_dir, 'seg{}.mp3'.format(i)) for i in range(3)]
+    stop = threading.Event()
+
+    # As the daily reboot does while a file is uploading
+    stats = sync_upload_dir(backend, upload_dir, progress=stop.set, stop=stop)
+
+    assert stats.files == 1
+    left = [path for path in paths if os.path.exists(path)]
+    assert len(left) == 2
+    for path in left:
+        assert os.path.exists(get_sidecar_path(path))
+
+
+def test_skips_file_already_in_bucket(upload_dir, backend):
+    # buggd died after the upload, before deleting the file
+    path = stage_segment(upload_dir, 'seg0.mp3')
+    remote_path = os.path.relpath(path, upload_dir)
+    hashes = read_sidecar(path)
+    mark_upload_started(path, hashes)
+    backend.upload_file(path, remote_path, hashes)
+    uploaded = backend.bytes_uploaded
+
+    stats = sync_upload_dir(backend, upload_dir)
+
+    assert stats.skipped == 1 and stats.files == 0
+    assert backend.bytes_uploaded == uploaded
+    assert not os.path.exists(path) and not os.path.exists(get_sidecar_path(path))
+
+
+def test_uploads_again_if_bucket_differs(upload_dir, backend):
+    # buggd died during the upload, which never completed
+    path = stage_segment(upload_dir, 'seg0.mp3')
+    mark_upload_started(path, read_sidecar(path))
+
+    stats = sync_upload_dir(backend, upload_dir)
+
+    assert stats.files == 1 and stats.skipped == 0
+    assert not os.path.exists(path)
+
+
+def test_failure_leaves_file(upload_dir, tmp_path):
+    path = stage_segment(upload_dir, 'seg0.mp3')
+    backend = LocalBackend(str(tmp_path / 'bucket'), failure_rate=1)
+
+    with pytest.raises(UploadError):
+        sync_upload_dir(backend, upload_dir)
+
+    # Kept for the next cycle, which will check the bucket before sending it again
+    assert os.path.exists(path)
+    assert read_sidecar(path)['upload_started']
+
+
+def test_orphaned_sidecars(upload_dir, backend):
+    orphan = stage_segment(upload_dir, 'seg0.mp3')
+    os.remove(orphan)
+    # A segment still being written keeps its sidecar
+    partial = stage_segment(upload_dir, 'seg1.mp3')
+    os.rename(partial, partial + PART_SUFFIX)
+
+    stats = sync_upload_dir(backend, upload_dir)
+
+    assert stats.files == 0
+    assert not os.path.exists(get_sidecar_path(orphan))
+    assert os.path.exists(get_sidecar_path(partial))
+    assert os.path.exists(partial + PART_SUFFIX)
+
+
+class PruningBackend(LocalBackend):
+    """ Deletes the other log files during the first upload, as Log.prune would """
+
+    def upload_file(self, local_path, remote_path, hashes=None):
+        super().upload_file(local_path, remote_path, hashes)
+        log_dir = os.path.dirname(local_path)
+        for f in os.listdir(log_dir):
+            if os.path.join(log_dir, f) != local_path:
+                os.remove(os.path.join(log_dir, f))
+
+
+def test_skips_file_deleted_after_listing(upload_dir, tmp_path):
+    # New, so uploaded one by one rather than bundled
+    log_dir = os.path.join(upload_dir, 'logs')
+    os.makedirs(log_dir)
+    for i in range(3):
+        with open(os.path.join(log_dir, '{}.log.gz'.format(i)), 'wb') as f:
+            f.write(b'x' * 100)
+    path = stage_segment(upload_dir, 'seg0.mp3')
+
+    stats = sync_upload_dir(PruningBackend(str(tmp_path / 'bucket')), upload_dir)
+
+    # The cycle carries on to the segment
+    assert stats.files == 2
+    assert not os.path.exists(path)
+    assert os.listdir(log_dir) == []
@@ -0,0 +1,50 @@
+""" Tests of the modem telemetry time series """
+
+import os
+import threading
+
+from buggd.apps.buggd.telemetry import ModemTelemetry, TELEMETRY_DIR_NAME, FIELDS
+from buggd.apps.buggd.checksums import PART_SUFFIX
+
+
+class FakeModem:
+    def __init__(self):
+        self.n_samples = 0
+        self.sampled = threading.Event()
+        self.cell_info_calls = 0
+
+    def enable_cell_info(self):
+        # Not answering straight after power on
+        self.cell_info_calls += 1
+        return self.cell_info_calls > 1
+
+    def get_telemetry(self):
+        # The first sample has been recorded by the time the second is asked for
+        self.n_samples += 1
+        if self.n_samples > 2:
+            self.sampled.set()
+        return {'rssi': 20, 'rssi_dbm': -73}
+
+
+def test_session_files(tmp_path):
+    upload_dir = str(tmp_path / 'audio')
+    telemetry_dir = os.path.join(upload_dir, TELEMETRY_DIR_NAME)
+    os.makedirs(telemetry_dir)
+    # Left by a session cut off by a reboot
+    with open(os.path.join(telemetry_dir, 'modem_x_20240501T100000Z.csv' + PART_SUFFIX), 'w') as f:
+        f.write(','.join(FIELDS) + '\n')
+
+    telemetry = ModemTelemetry(interval_s=0.01)
+    telemetry.set_upload_dir(upload_dir)
+    assert os.listdir(telemetry_dir) == ['modem_x_20240501T100000Z.csv']
+
+    # A session's file is only ready once the session ends
+    modem = FakeModem()
+    telemetry.start(modem)
+    assert modem.sampled.wait(5)
+    assert sum(f.endswith(PART_SUFFIX) for f in os.listdir(telemetry_dir)) == 1
+    telemetry.stop()
+    # The registration modes are set once the modem answers, and not with every sample
+    assert modem.cell_info_calls == 2
+    assert not any(f.endswith(PART_SUFFIX) for f in os.listdir(telemetry_dir))
+    assert len(os.listdir(telemetry_dir)) == 2
@@ -0,0 +1,58 @@
+""" Tests of the clock drift history """
+
+import os
+
+from buggd.apps.buggd.backends import LocalBackend
+from buggd.apps.buggd.checksums import PART_SUFFIX
+from buggd.apps.buggd.sync import sync_upload_dir
+from buggd.apps.buggd.timesync import TimeSync, HISTORY_DIR_NAME, HISTORY_FIELDS
+
+
+def read_rows(root):
+    """ The drift history rows in every CSV under a directory """
+    rows = []
+    for dirpath, _, files in os.walk(root):
+        for f in sorted(files):
+            if f.endswith('.csv'):
+                with open(os.path.join(dirpath, f), encoding='utf-8') as fh:
+                    lines = fh.read().splitlines()
+                assert lines[0] == ','.join(HISTORY_FIELDS)
+                rows.extend(lines[1:])
+    return rows
+
+
+def test_history_survives_several_syncs(tmp_path):
+    upload_dir = str(tmp_path / 'upload')
+    bucket_dir = str(tmp_path / 'bucket')
+    os.makedirs(upload_dir)
+    backend = LocalBackend(bucket_dir)
+    timesync = TimeSync()
+    timesync.set_upload_dir(upload_dir)
+
+    # A measurement at the start of each sync cycle, on the same day
+    for offset in (0.1, 0.2):
+        timesync.record(offset, 0.05, -0.3, False, False)
+        sync_upload_dir(backend, upload_dir)
+
+    rows = read_rows(bucket_dir)
+    assert [row.split(',')[1] for row in rows] == ['0.1000', '0.2000']
+    assert read_rows(upload_dir) == []
+
+
+def test_measurements_before_upload_dir(tmp_path):
+    timesync = TimeSync()
+    timesync.record(1.5, 0.05, None, True, True)
+    timesync.record(0.01, 0.05, 0.2, False, False)
+
+    history_dir = tmp_path / HISTORY_DIR_NAME
+    history_dir.mkdir()
+    # Left by a write cut off by a reboot
+    (history_dir / ('drift_old.csv' + PART_SUFFIX)).write_text(','.join(HISTORY_FIELDS) + '\n')
+
+    timesync.set_upload_dir(str(tmp_path))
+
+    assert 'drift_old.csv' in os.listdir(history_dir)
+    assert not any(f.endswith(PART_SUFFIX) for f in os.listdir(history_dir))
+    rows = read_rows(str(history_dir))
+    assert [row.split(',')[1:] for row in rows] == [['1.5000', '0.0500', '', '1', '1'],
+                                                   ['0.0100', '0.0500', '0.2000', '0', '0']]
@@ -0,0 +1,168 @@
+""" Tests of tracing segments through the pipeline, and the latency summary """
+
+import os
+
+import pytest
+
+from buggd.apps.buggd import tracing as tracing_module
+from buggd.apps.buggd import checksums as checksums_module
+from buggd.apps.buggd import sync as sync_module
+from buggd.apps.buggd import journal as journal_module
+from buggd.apps.buggd.tracing import Tracer, STAGES
+from buggd.apps.buggd.backends import LocalBackend
+from buggd.apps.buggd.checksums import stage_with_checksums, read_sidecar
+from buggd.apps.buggd.sync import sync_upload_dir
+
+
+class FakeTime:
+    """ A wall clock that can be stepped, and a monotonic clock that only moves on """
+
+    def __init__(self):
+        self.mono = 100.0
+        self.offset = 1.7e9
+
+    def time(self):
+        return self.offset + self.mono
+
+    def monotonic(self):
+        return self.mono
+
+    def step(self, s):
+        self.offset += s
+
+    def reboot(self, down_s):
+        wall = self.time() + down_s
+        self.mono = 10.0
+        self.offset = wall - self.mono
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(tracing_module, 'time', clock)
+    return clock
+
+
+def run(tracer, clock, segment, marks):
+    """ Trace a segment through the given marks, with the seconds before each """
+    tracer.start(segment)
+    for mark, s in marks:
+        clock.mono += s
+        tracer.mark(segment, mark)
+
+
+def test_stages(clock):
+    tracer = Tracer()
+    run(tracer, clock, 'seg', [('captured', 300), ('trimmed', 1), ('encode_start', 4),
+                               ('staged', 20), ('upload_start', 600)])
+    clock.mono += 30
+    result = tracer.finish('seg')
+
+    assert result['total_s'] == 955
+    assert [result['{}_s'.format(stage)] for stage in STAGES] == [300, 1, 4, 20, 600, 30]
+    assert tracer.traces == {}
+    # Not traced
+    assert tracer.finish('seg') is None
+
+
+def test_missing_marks(clock):
+    tracer = Tracer()
+    # No trim, and the upload_start stamp was lost
+    run(tracer, clock, 'seg', [('captured', 300), ('encode_start', 5), ('staged', 20)])
+    clock.mono += 100
+    result = tracer.finish('seg')
+
+    assert result['trim_s'] == 0
+    assert result['queue_wait_s'] == 5
+    assert result['wait_sync_s'] == 0
+    assert result['upload_s'] == 100
+    assert result['total_s'] == 425
+
+
+def test_out_of_order_marks(clock):
+    tracer = Tracer()
+    run(tracer, clock, 'seg', [('captured', 300), ('encode_start', 5), ('trimmed', 2), ('staged', 20)])
+    clock.mono += 10
+    result = tracer.finish('seg')
+
+    # Trimming is stamped after the encode started, so the encode is counted from the trim
+    assert result['trim_s'] == 7
+    assert result['queue_wait_s'] == 0
+    assert result['encode_s'] == 20
+    assert result['total_s'] == sum(result['{}_s'.format(stage)] for stage in STAGES) == 337
+
+
+def test_clock_step_within_boot(clock):
+    tracer = Tracer()
+    run(tracer, clock, 'seg', [('captured', 300)])
+    # The time sync steps the clock back an hour
+    clock.step(-3600)
+    clock.mono += 60
+    tracer.mark('seg', 'staged')
+    result = tracer.finish('seg')
+
+    assert result['total_s'] == 360
+    assert result['encode_s'] == 60
+
+
+def test_summary(clock):
+    tracer = Tracer()
+    assert tracer.summary() is None
+
+    for wait_s in (100, 200, 300, 400):
+        run(tracer, clock, 'seg', [('captured', 300), ('staged', 10), ('upload_start', wait_s)])
+        clock.mono += 20
+        tracer.finish('seg')
+
+    summary = tracer.summary()
+    assert summary['n'] == 4
+    assert summary['p50_s'] == 630
+    assert summary['max_s'] == 730
+    assert summary['dominant'] == 'capture'
+    assert summary['dominant_share'] == round(1200 / 2320, 3)
+    assert summary['mean_stage_s']['wait_sync'] == 250
+
+
+def test_resume(clock):
+    tracer = Tracer()
+    run(tracer, clock, 'seg', [('captured', 300)])
+    saved = tracer.get('seg')
+    clock.mono += 50
+    tracer.mark('seg', 'staged')
+
+    # Already being traced, so the saved copy doesn't replace it
+    tracer.resume('seg', saved)
+    assert 'staged' in tracer.traces['seg']
+
+    tracer.discard('seg')
+    tracer.resume('seg', None)
+    assert tracer.traces == {}
+
+
+def test_resume_from_sidecar_after_reboot(clock, tmp_path, monkeypatch):
+    upload_dir = tmp_path / 'audio'
+    data_dir = upload_dir / 'proj_test' / 'bugg_test' / 'conf_test'
+    data_dir.mkdir(parents=True)
+    src = tmp_path / 'seg1.mp3'
+    src.write_bytes(os.urandom(1024))
+
+    # Recorded and staged, then the device reboots before the sync reaches it
+    before = Tracer()
+    monkeypatch.setattr(checksums_module, 'tracer', before)
+    run(before, clock, 'seg1', [('captured', 300), ('trimmed', 1), ('encode_start', 4)])
+    clock.mono += 20
+    stage_with_checksums(str(src), str(data_dir / 'seg1.mp3'))
+    assert read_sidecar(str(data_dir / 'seg1.mp3'))['trace']['id'] == before.get('seg1')['id']
+
+    clock.reboot(90)
+    after = Tracer()
+    monkeypatch.setattr(sync_module, 'tracer', after)
+    monkeypatch.setattr(journal_module, 'tracer', after)
+    sync_upload_dir(LocalBackend(str(tmp_path / 'bucket')), str(upload_dir))
+
+    trace, = after.completed
+    total, stages = trace
+    assert stages['encode'] == 20
+    # The time the device was down, and no time for the upload itself
+    assert stages['wait_sync'] == pytest.approx(90)
+    assert total == pytest.approx(415)